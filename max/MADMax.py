@@ -2,15 +2,152 @@
 #MADMax  Mongo Access Delegate for Max
 
 from max.exceptions import ObjectNotFound
+from max.queryplans import explain_enabled
+from max.queryplans import query_plans
+from max.unitofwork import QUEUED_WRITE_METHODS
+from max.unitofwork import UnitOfWork
+from max.unitofwork import unit_of_work_enabled
+from max.utils.cursors import encode_cursor
+from max.utils.cursors import sort_key_values
 
 from bson.objectid import ObjectId
 from pymongo import ASCENDING
 from pymongo import DESCENDING
+from pymongo.collection import Collection
 
+from functools import partial
 from max.utils.dicts import deepcopy
 import sys
 
 UNDEF = "__NO_DEFINED_VALUE_FOR_GETATTR__"
+BULK_WRAPPING_BATCH_SIZE = 200
+
+# Collections whose documents are kept on the request identity map
+IDENTITY_MAP_COLLECTIONS = ['users', 'contexts', 'conversations']
+
+# Collection methods that modify documents, and invalidate the identity map
+COLLECTION_WRITE_METHODS = [
+    'insert', 'save', 'update', 'remove', 'find_and_modify',
+    'initialize_ordered_bulk_op', 'initialize_unordered_bulk_op', 'drop'
+]
+
+
+def get_collection_model(collection):
+    """
+        Returns the model class mapped to a collection
+    """
+    CLASS_COLLECTION_MAPPING = getattr(sys.modules['max.models'], 'CLASS_COLLECTION_MAPPING', {})
+    return getattr(sys.modules['max.models'], CLASS_COLLECTION_MAPPING[collection], None)
+
+
+class IdentityMap(object):
+    """
+        Raw documents of the IDENTITY_MAP_COLLECTIONS read during a request, indexed
+        by its _id and its model unique field, so each one is read at most once per request.
+
+        Documents are copied when stored and when returned, so the changes made on the
+        models that wrap them are not seen by other readers until saved. Any write on a
+        collection made through the request database discards the documents of that collection.
+    """
+
+    def __init__(self):
+        self.documents = {}
+
+    def identity_fields(self, collection):
+        if collection not in IDENTITY_MAP_COLLECTIONS:
+            return []
+        return list(set(['_id', get_collection_model(collection).unique]))
+
+    def identity(self, collection, query):
+        """
+            Returns the (field, value) pair that identifies the document of a query,
+            or None if the query is not a plain lookup by an identity field.
+        """
+        if len(query) != 1:
+            return None
+        field, value = query.items()[0]
+        if field not in self.identity_fields(collection) or isinstance(value, (dict, list)):
+            return None
+        return field, value
+
+    def loaded(self, collection, field, value):
+        return (field, value) in self.documents.get(collection, {})
+
+    def get(self, collection, field, value):
+        document = self.documents.get(collection, {}).get((field, value))
+        return deepcopy(document) if document is not None else None
+
+    def add(self, collection, document):
+        fields = self.identity_fields(collection)
+        if not fields:
+            return
+        document = deepcopy(document)
+        entries = self.documents.setdefault(collection, {})
+        for field in fields:
+            if field in document:
+                entries[(field, document[field])] = document
+
+    def invalidate(self, collection):
+        self.documents.pop(collection, None)
+
+
+class IdentityMapDatabase(object):
+    """
+        Wraps a pymongo database, returning collections that
+        invalidate the identity map when written, and queue
+        the writes on the unit of work if enabled.
+    """
+
+    def __init__(self, database, identity_map, unit_of_work=None):
+        self.database = database
+        self.identity_map = identity_map
+        self.unit_of_work = unit_of_work
+
+    def __getitem__(self, name):
+        return IdentityMapCollection(self.database[name], self.identity_map, self.unit_of_work)
+
+    def __getattr__(self, name):
+        attribute = getattr(self.database, name)
+        if isinstance(attribute, Collection):
+            return IdentityMapCollection(attribute, self.identity_map, self.unit_of_work)
+        return attribute
+
+
+class IdentityMapCollection(object):
+    """
+        Wraps a pymongo collection, discarding its documents from
+        the identity map before any write.
+
+        With an enabled unit of work, writes are queued on it, and
+        any other operation flushes the pending writes first.
+    """
+
+    def __init__(self, collection, identity_map, unit_of_work=None):
+        self.collection = collection
+        self.identity_map = identity_map
+        self.unit_of_work = unit_of_work
+
+    @property
+    def database(self):
+        return IdentityMapDatabase(self.collection.database, self.identity_map, self.unit_of_work)
+
+    def immediate(self):
+        """
+            Returns the pymongo collection, to write on it right away
+        """
+        if self.unit_of_work is not None:
+            self.unit_of_work.flush()
+        self.identity_map.invalidate(self.collection.name)
+        return self.collection
+
+    def __getattr__(self, name):
+        if name in COLLECTION_WRITE_METHODS:
+            self.identity_map.invalidate(self.collection.name)
+        if self.unit_of_work is not None and self.unit_of_work.enabled:
+            if name in QUEUED_WRITE_METHODS:
+                return partial(getattr(self.unit_of_work, name), self.collection)
+            self.unit_of_work.flush()
+        return getattr(self.collection, name)
 
 
 def ItemWrapper(item, request, collection, flatten=0, **kwargs):
@@ -19,8 +156,7 @@ def ItemWrapper(item, request, collection, flatten=0, **kwargs):
         the appropiate class, mapped by the origin collection of the item.
         Flattened or not by demand
     """
-    CLASS_COLLECTION_MAPPING = getattr(sys.modules['max.models'], 'CLASS_COLLECTION_MAPPING', {})
-    model = getattr(sys.modules['max.models'], CLASS_COLLECTION_MAPPING[collection], None)
+    model = get_collection_model(collection)
     wrapped = model.from_object(request, item)
 
     # Also wrap subobjects, only if we are not flattening
@@ -34,12 +170,27 @@ def ItemWrapper(item, request, collection, flatten=0, **kwargs):
         return wrapped
 
 
+def PageWrapper(items, request, collection, **kwargs):
+    """
+        Transforms a page of mongoDB items to its flattened representation.
+
+        The model class is resolved once for the whole page, and the raw items
+        are flattened through a single model instance, sharing the fields
+        permissions evaluated for the page, as they're never saved back.
+    """
+    model = get_collection_model(collection)
+    return model.flatten_page(request, items, **kwargs)
+
+
 class ResultsWrapper(object):
     """
         Wraps a list of results to provide a flag
         showing if there are more items left to show.
     """
-    def __init__(self, request, cursor, limit, flatten, keep_private_fields):
+    # Wrap flattened results a page at a time with PageWrapper
+    bulk_wrapping = True
+
+    def __init__(self, request, cursor, limit, flatten, keep_private_fields, keyset=None):
         """
             Slice the results, and set remaining flag if there are more items
             in the results that the limit specified.
@@ -51,8 +202,12 @@ class ResultsWrapper(object):
             Returns a generator that yields wrapped results until limit. If limit overpassed at
             least by one item, remaining flat will be set True
 
+            If keyset sort params are given, the sort key of the last yielded item is
+            kept, to provide a continuation cursor for the next page.
         """
         self.remaining = False
+        self.keyset = keyset
+        self.last = None
         self.collection = cursor.collection.name
         self.yielded = 0
         self.limit = limit
@@ -63,11 +218,17 @@ class ResultsWrapper(object):
         self.generator = self.results()
 
     def results(self):
+        if self.flatten and self.bulk_wrapping:
+            for result in self.bulk_results():
+                yield result
+            return
+
         for result in self.cursor:
             self.yielded += 1
             if self.limit > 0 and self.yielded > self.limit:
                 self.remaining = True
                 break
+            self.last = result
             yield ItemWrapper(
                 result,
                 self.request,
@@ -75,6 +236,36 @@ class ResultsWrapper(object):
                 flatten=self.flatten,
                 keep_private_fields=self.keep_private_fields)
 
+    def bulk_results(self):
+        """
+            Fetches a whole page of raw items before wrapping and flattening
+            them in one go. Results without limit are processed in batches
+            of BULK_WRAPPING_BATCH_SIZE items.
+        """
+        page = []
+        for result in self.cursor:
+            self.yielded += 1
+            if self.limit > 0 and self.yielded > self.limit:
+                self.remaining = True
+                break
+            self.last = result
+            page.append(result)
+            if not self.limit > 0 and len(page) == BULK_WRAPPING_BATCH_SIZE:
+                for wrapped in PageWrapper(page, self.request, self.collection, keep_private_fields=self.keep_private_fields):
+                    yield wrapped
+                page = []
+
+        for wrapped in PageWrapper(page, self.request, self.collection, keep_private_fields=self.keep_private_fields):
+            yield wrapped
+
+    @property
+    def continuation(self):
+        """
+            Opaque cursor pointing to the next page of results, if any.
+        """
+        if self.keyset and self.remaining and self.last is not None:
+            return encode_cursor(sort_key_values(self.last, self.keyset))
+
     def __iter__(self):
         return self.generator.__iter__()
 
@@ -133,6 +324,7 @@ class MADMaxCollection(object):
                 tags: A list of tags to filter contexts
                 object_tags: A list of tags to filter context activities
                 twitter_enabled: Boolean for returning objects Twitter attributes
+                keyset: Sort params used to build the continuation cursor of keyset paginated results
         """
         search_query = deepcopy(query)
 
@@ -155,6 +347,7 @@ class MADMaxCollection(object):
         show_fields = kwargs.get('show_fields', None)
         offset_field = kwargs.get('offset_field', None)
         max_users = kwargs.get('max_users', None)
+        keyset = kwargs.get('keyset', None)
 
         sort_by_field = kwargs.get('sort_by_field', None)
         if sort_by_field:
@@ -267,6 +460,7 @@ class MADMaxCollection(object):
             if limit:
                 cursor = cursor.limit(limit + 1)
 
+        query_plans.capture(self.request, cursor)
 
         # If it's a count search, return the cursor's count before sorting and limiting
         if count:
@@ -277,7 +471,7 @@ class MADMaxCollection(object):
         # Wrap the result in its Mad Class,
         # and flattens it if specified
 
-        return ResultsWrapper(self.request, cursor, flatten=flatten, keep_private_fields=keep_private_fields, limit=limit)
+        return ResultsWrapper(self.request, cursor, flatten=flatten, keep_private_fields=keep_private_fields, limit=limit, keyset=keyset)
 
     def _getQuery(self, itemID):
         """
@@ -300,8 +494,43 @@ class MADMaxCollection(object):
         query[fieldname] = value
         return self.search(query)
 
+    def load(self, field, value):
+        """
+            Returns the raw document with a unique field value, or None if it doesn't exist.
+
+            Documents of the IDENTITY_MAP_COLLECTIONS are read from the database
+            at most once per request.
+        """
+        identity_map = self.request.db.identity_map
+        item = identity_map.get(self.collection.name, field, value)
+        if item is None:
+            query = {field: value}
+            if explain_enabled(self.request):
+                query_plans.capture(self.request, self.collection.find(query).limit(-1))
+            item = self.collection.find_one(query)
+            if item:
+                identity_map.add(self.collection.name, item)
+        return item
+
+    def prefetch(self, field, values):
+        """
+            Loads on the identity map the documents with any of the unique field values
+            that are not yet loaded, with a single query.
+        """
+        identity_map = self.request.db.identity_map
+        missing = [value for value in set(values) if not identity_map.loaded(self.collection.name, field, value)]
+        if missing:
+            for item in self.collection.find({field: {'$in': missing}}):
+                identity_map.add(self.collection.name, item)
+
     def wrapped_find_one(self, query, wrap=True, **kwargs):
-        item = self.collection.find_one(query, self.show_fields, **kwargs)
+        identity = self.request.db.identity_map.identity(self.collection.name, query)
+        if identity is not None and self.show_fields is None and not kwargs:
+            item = self.load(*identity)
+        else:
+            if explain_enabled(self.request):
+                query_plans.capture(self.request, self.collection.find(query, self.show_fields, **kwargs).limit(-1))
+            item = self.collection.find_one(query, self.show_fields, **kwargs)
         if item:
             if wrap:
                 wrapped = ItemWrapper(item, self.request, self.collection.name)
@@ -366,9 +595,21 @@ class MADMaxDB(object):
 
     def __init__(self, request, db):
         """
+            Writes made through db discard the documents
+            kept on the identity map of the request, and are queued
+            on its unit of work if enabled.
         """
         self.request = request
-        self.db = db
+        self.identity_map = IdentityMap()
+        enabled = request is not None and unit_of_work_enabled(request.registry.max_settings)
+        self.unit_of_work = UnitOfWork(enabled)
+        self.db = IdentityMapDatabase(db, self.identity_map, self.unit_of_work)
+
+    def flush(self):
+        """
+            Sends the writes queued on the unit of work of the request, if any
+        """
+        self.unit_of_work.flush()
 
     def __getattr__(self, name):
         """
@@ -1,9 +1,14 @@
 # -*- coding: utf-8 -*-
+from max.MADMax import MADMaxCollection
+from max.MADMax import UNDEF
+from max.exceptions import ConcurrentModification
 from max.exceptions import DuplicatedItemError
 from max.exceptions import MissingField
 from max.exceptions import ObjectNotSupported
 from max.exceptions import ValidationError
 from max.utils.dicts import RUDict
+from max.utils.dicts import apply_changes
+from max.utils.dicts import document_changes
 from max.utils.dicts import flatten
 from pyramid.security import ACLAllowed
 
@@ -168,18 +173,26 @@ class MADBase(MADDict):
         Provides the methods to validate and construct an object according to activitystrea.ms
         specifications by subclassing it and providing an schema with the required fields,
         and a structure builder function 'buildObject'
+
+        Objects read from the database keep a snapshot of the stored document, so saving
+        them only sets and unsets the changed fields. Fields listed on volatile_fields are
+        computed when read and never saved. If version_field is set, saves increment it,
+        and fail with ConcurrentModification if someone else saved the object meanwhile.
     """
     default_field_view_permission = None
     default_field_edit_permission = None
     unique = ''
     collection = ''
     mdb_collection = None
-    old = {}
+    volatile_fields = []
+    version_field = None
+    saved = None
     data = {}
     __parent__ = None
 
     def __init__(self, request):
-        self.old = {}
+        self.saved = None
+        self._old = None
         self.request = request
         # When called from outside a pyramyd app, we have no request
         try:
@@ -235,19 +248,72 @@ class MADBase(MADDict):
 
     @classmethod
     def from_object(cls, request, source):
+        """
+            Wraps an object already read from the database.
+        """
         instance = cls(request)
         instance.update(source)
-        instance.old.update(source)
-        instance.old = deepcopy(flatten(instance.old))
+        instance.track(source)
         if 'id' in source:
             instance['_id'] = source['id']
         instance._post_init_from_object(source)
         instance.asleep = True
         return instance
 
+    @classmethod
+    def flatten_page(cls, request, sources, **kwargs):
+        """
+            Flattens a page of objects read from the database, as from_object
+            and flatten would do for each one.
+
+            A single instance is reused for the whole page, so no instance nor
+            change tracking copy is made per object, and the fields permissions
+            are evaluated once for all the objects sharing a permissions key.
+        """
+        instance = cls(request)
+        instance.asleep = True
+        flattened = []
+        for source in sources:
+            instance.clear()
+            instance.__dict__.pop('__acl__', None)
+            instance.__dict__.pop('_field_permissions', None)
+            instance.update(source)
+            if 'id' in source:
+                instance['_id'] = source['id']
+            instance._post_init_from_object(source)
+            flattened.append(instance.flatten(**kwargs))
+        return flattened
+
+    def track(self, document):
+        """
+            Keeps a snapshot of the stored document, to detect the changed fields
+        """
+        self.saved = deepcopy(document)
+        self._old = None
+
+    @property
+    def old(self):
+        """
+            The flattened values of the stored document, built on first use
+        """
+        if self._old is None:
+            self._old = deepcopy(flatten(self.saved)) if self.saved is not None else {}
+        return self._old
+
+    @old.setter
+    def old(self, value):
+        self._old = value
+
     def field_changed(self, field):
         return self.get(field, None) != self.old.get(field, None)
 
+    def changes(self):
+        """
+            Returns the fields to $set and $unset to save the object
+        """
+        skip = ['_id', self.version_field] + self.volatile_fields
+        return document_changes(self.saved, self, skip=skip)
+
     def setDates(self):
         self['published'] = datetime.datetime.utcnow()
 
@@ -280,8 +346,7 @@ class MADBase(MADDict):
             obj = self.alreadyExists()
             if obj:
                 self.update(obj)
-                self.old.update(obj)
-                self.old = deepcopy(flatten(self.old))
+                self.track(obj)
 
     def format_unique(self, key):
         return key if isinstance(key, ObjectId) else ObjectId(key)
@@ -293,9 +358,12 @@ class MADBase(MADDict):
             query = {unique: value}
             reloaded = self.mdb_collection.find_one(query)
             self.update(reloaded)
+            if self.saved is not None:
+                self.saved = deepcopy(reloaded)
 
     def reload__acl__(self):
         self.__acl__ = self.__class__.__acl__.wrapped(self)
+        self.__dict__.pop('_field_permissions', None)
 
     def insert(self, **kwargs):
         """
@@ -308,13 +376,72 @@ class MADBase(MADDict):
 
     def save(self):
         """
-            Updates itself to the database
+            Updates itself to the database.
+
+            Objects read from the database only update their changed fields,
+            and the whole object is saved otherwise.
         """
         self._before_saving_object()
-        oid = self.mdb_collection.save(self)
+        if self.saved is None or '_id' not in self.saved:
+            oid = self.mdb_collection.save(self)
+        else:
+            oid = self.saved['_id']
+            self.save_changes()
         self._after_saving_object(oid)
         return str(oid)
 
+    def save_changes(self):
+        """
+            Sets and unsets the fields changed since read or last saved, if any,
+            and updates the snapshot with them.
+        """
+        sets, unsets = self.changes()
+        if not sets and not unsets:
+            return
+
+        query = {'_id': self.saved['_id']}
+        update = {}
+        if sets:
+            update['$set'] = sets
+        if unsets:
+            update['$unset'] = dict.fromkeys(unsets, '')
+        if self.version_field:
+            query[self.version_field] = self.saved.get(self.version_field)
+            update['$inc'] = {self.version_field: 1}
+
+        # Versioned saves need to know if they were applied
+        collection = self.mdb_collection.immediate() if self.version_field else self.mdb_collection
+        result = collection.update(query, update)
+        if self.version_field and result is not None and not result.get('n'):
+            raise ConcurrentModification('{} {} has been modified by someone else'.format(self.__class__.__name__, self[self.unique]))
+
+        # Changed fields are checked against the values read after saving
+        self.old
+        apply_changes(self.saved, sets, unsets)
+        if self.version_field:
+            self.saved[self.version_field] = self[self.version_field] = (self.saved.get(self.version_field) or 0) + 1
+
+    def mark_saved(self, fields):
+        """
+            Updates the snapshot with the current values of some fields, after writing
+            them with an atomic update, so a later save doesn't send them again and
+            overwrite the concurrent updates made meanwhile. Fields may be dotted paths.
+        """
+        if self.saved is None:
+            return
+        sets = {}
+        unsets = []
+        for field in fields:
+            value = self
+            for part in field.split('.'):
+                value = value.get(part, UNDEF) if isinstance(value, dict) else UNDEF
+            if value is UNDEF:
+                unsets.append(field)
+            else:
+                sets[field] = value
+        self.old
+        apply_changes(self.saved, sets, unsets)
+
     def _before_delete(self):
         """
             Executed before an object removal
@@ -383,6 +510,23 @@ class MADBase(MADDict):
 
         self.mdb_collection.update({'_id': self['_id']}, {'$pull': {field: obj}})
 
+    def get_identity_map(self):
+        """
+            Returns the identity map of the request, if any
+        """
+        db = getattr(self.request, 'db', None)
+        return getattr(db, 'identity_map', None)
+
+    def find_unique(self, value):
+        """
+            Returns the raw document with value on the unique field, read
+            through the identity map of the request if there's one.
+        """
+        identity_map = self.get_identity_map()
+        if identity_map is not None and identity_map.identity(self.collection, {self.unique: value}):
+            return MADMaxCollection(self.request, self.collection).load(self.unique, value)
+        return self.mdb_collection.find_one({self.unique: value})
+
     def alreadyExists(self):
         """
             Checks if there's an object with the value specified in the unique field.
@@ -391,8 +535,7 @@ class MADBase(MADDict):
         unique = self.unique
         value = self.data.get(unique)
         if value:
-            query = {unique: value}
-            return self.mdb_collection.find_one(query)
+            return self.find_unique(value)
         else:
             # in the case that we don't have the unique value in the request data
             # Assume that the object doesn't exist
@@ -405,11 +548,16 @@ class MADBase(MADDict):
             $oid and $data BISON structures. Intended for final output
             Also removes fields starting with underscore _fieldname
         """
+        visible = self.get_fields_with_permission('view')
+
         def permission_filter(field):
             """
                 Is the field NOT visible on the current request?
             """
-            return not(self.has_field_permission(field, 'view') or field == 'objectType')
+            if field not in self.schema:
+                # Unknown fields fail as they did when checked one by one
+                self.get_field_permission_for(field, 'view')
+            return not(field in visible or field == 'objectType')
 
         return_dict = flatten(self, filter_method=permission_filter, **kwargs)
         return return_dict
@@ -466,13 +614,53 @@ class MADBase(MADDict):
         permission_name = self.get_field_permission_for(field, mode)
         return isinstance(self.request.has_permission(permission_name, self), ACLAllowed)
 
+    def _field_permissions_key(self):
+        """
+            Returns a hashable key describing the state of the object that its __acl__
+            depends on. Objects of the same class with the same key share the fields
+            permissions computed for a request.
+
+            By default there's no key, and permissions are computed for each object.
+        """
+        return None
+
+    def get_fields_with_permission(self, mode):
+        """
+            Returns the set of schema fields on which the current request
+            has permission in the specified mode (view, edit).
+
+            Each distinct permission is evaluated once against the object's __acl__,
+            and the resulting set is cached on the request for all objects with the
+            same class, principals and permissions key, or on the object itself if
+            it has no key or it's placed under a parent that could inherit permissions.
+        """
+        key = self._field_permissions_key() if self.__parent__ is None else None
+        if key is None:
+            cache = self.__dict__.setdefault('_field_permissions', {})
+        else:
+            cache_key = (self.__class__, tuple(self.request.effective_principals), key)
+            cache = self.request.field_permissions.setdefault(cache_key, {})
+
+        if mode not in cache:
+            granted = {}
+            fields = set()
+            for field in self.schema:
+                permission_name = self.get_field_permission_for(field, mode)
+                if permission_name not in granted:
+                    granted[permission_name] = isinstance(self.request.has_permission(permission_name, self), ACLAllowed)
+                if granted[permission_name]:
+                    fields.add(field)
+            cache[mode] = frozenset(fields)
+        return cache[mode]
+
     def get_editable_fields(self):
         """
             Returns the real fieldname (without leading _) on which
             the current authenticated userhas permission to edit
         """
+        editable = self.get_fields_with_permission('edit')
         for fieldName in self.schema:
-            if self.has_field_permission(fieldName, 'edit'):
+            if fieldName in editable:
                 yield fieldName.lstrip('_')
 
     def getMutablePropertiesFromRequest(self, request):
@@ -13,8 +13,13 @@ else:
 
 from max import debug
 from max import mongoprobe
+from max.contextcache import context_cache
+from max.indexes import ensure_indexes
+from max.outbox import outbox_enabled
+from max.outbox import start_publisher_thread
 from max.request import extract_post_data
 from max.request import get_database
+from max.request import get_field_permissions_cache
 from max.request import get_oauth_headers
 from max.request import get_request_actor
 from max.request import get_request_actor_username
@@ -23,10 +28,14 @@ from max.resources import Root
 from max.resources import loadCloudAPISettings
 from max.resources import loadMAXSecurity
 from max.resources import loadMAXSettings
+from max.resources import SecurityRefresher
+from max.resources import loadMAXStore
 from max.routes import RESOURCES
 from max.security.authentication import MaxAuthenticationPolicy
+from max.security.oauth import token_cache
+from max.security.signedtokens import signed_tokens
 from max.tweens import set_signal
-from maxutils import mongodb
+from max.utils.cache import VERSION_POLL_INTERVAL
 
 from pyramid.authorization import ACLAuthorizationPolicy
 from pyramid.config import Configurator
@@ -77,10 +86,13 @@ def main(*args, **settings):
         'max.tweens.compatibility_checker_factory',
         'max.tweens.post_tunneling_factory',
         'max.tweens.deprecation_wrapper_factory',
+        'max.tweens.unit_of_work_factory',
     ]
 
     debug.setup(settings)
     mongoprobe.setup(settings)
+    token_cache.configure(settings)
+    signed_tokens.configure(settings)
 
     config = Configurator(
         settings=settings,
@@ -92,35 +104,37 @@ def main(*args, **settings):
     config.add_request_method(get_request_actor, name='actor', reify=True)
     config.add_request_method(get_request_creator, name='creator', reify=True)
     config.add_request_method(get_database, name='db', reify=True)
+    config.add_request_method(get_field_permissions_cache, name='field_permissions', reify=True)
     config.add_request_method(extract_post_data, name='decoded_payload', reify=True)
     config.add_request_method(get_oauth_headers, name='auth_headers', reify=True)
 
     # Mongodb connection initialization
-    cluster_enabled = asbool(settings.get('mongodb.cluster', False))
-    auth_enabled = asbool(settings.get('mongodb.auth', False))
-    mongodb_uri = settings.get('mongodb.hosts') if cluster_enabled else settings['mongodb.url']
-
-    conn = mongodb.get_connection(
-        mongodb_uri,
-        use_greenlets=GEVENT_AVAILABLE,
-        cluster=settings.get('mongodb.replica_set', None))
-    db = mongodb.get_database(
-        conn,
-        settings['mongodb.db_name'],
-        username=settings.get('mongodb.username', None) if auth_enabled else None,
-        password=settings.get('mongodb.password', None) if auth_enabled else None,
-        authdb=settings.get('mongodb.authdb', None) if auth_enabled else None)
+    db = loadMAXStore(settings)
 
     config.registry.max_store = db
 
+    # Create the indexes declared on models that are missing on the database
+    if asbool(max_settings.get('max_ensure_indexes', False)):
+        for action, collection_name, description in ensure_indexes(db):
+            if action != 'unknown':
+                maxlogger.info('[indexes] {} {}: {}'.format(action, collection_name, description))
+
     # Set MAX settings
     config.registry.max_settings = max_settings
+    context_cache.configure(max_settings)
+
+    # Publish the notifications outbox from this process
+    if outbox_enabled(max_settings) and max_settings.get('max_notifications_outbox_publisher') == 'thread':
+        start_publisher_thread(max_settings, db)
 
     # Set Twitter settings
     config.registry.cloudapis_settings = loadCloudAPISettings(config.registry)
 
     # Set security
     config.registry.max_security = loadMAXSecurity(config.registry)
+    config.registry.max_security_refresher = SecurityRefresher(
+        config.registry,
+        float(max_settings.get('max_security_refresh_interval', VERSION_POLL_INTERVAL)))
 
     # Load cache settings
     set_cache_regions_from_settings(settings)
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+    Context metadata cache
+
+    When ``max.context_cache`` is enabled, each process keeps the context documents
+    used to check permissions, and the sets of contexts with public policies, in an
+    LRU cache keyed by hash:
+
+        - the context documents, by hash
+        - the hashes and urls of the contexts with a public read policy
+        - the hashes and urls of the contexts with a public write policy
+
+    Entries expire after ``max.context_cache_ttl`` seconds (300 by default). Saving,
+    creating or deleting a context through its model bumps the ``contexts`` version on
+    the ``cache_versions`` collection and clears the cache of the process. The other
+    processes poll that version every ``max.context_cache_poll_interval`` seconds
+    (5 by default), and clear their cache when it changes.
+"""
+from max.utils.cache import LRUCache
+from max.utils.cache import VERSION_POLL_INTERVAL
+from max.utils.cache import VersionTracker
+from max.utils.dicts import deepcopy
+
+from pyramid.settings import asbool
+
+CONTEXT_CACHE_SIZE = 1000
+CONTEXT_CACHE_TTL = 300
+
+
+def context_cache_enabled(settings):
+    """
+        Checks if contexts are cached
+    """
+    return asbool(settings.get('max_context_cache', False))
+
+
+class ContextCache(object):
+    """
+        Process wide cache of contexts metadata
+    """
+
+    def __init__(self, size=CONTEXT_CACHE_SIZE, ttl=CONTEXT_CACHE_TTL, poll_interval=VERSION_POLL_INTERVAL):
+        self.contexts = LRUCache(size, ttl)
+        self.policies = LRUCache(8, ttl)
+        self.tracker = VersionTracker('contexts', poll_interval)
+        self.version = None
+
+    def configure(self, settings):
+        ttl = int(settings.get('max_context_cache_ttl', CONTEXT_CACHE_TTL))
+        self.contexts.size = int(settings.get('max_context_cache_size', CONTEXT_CACHE_SIZE))
+        self.contexts.ttl = self.policies.ttl = ttl
+        self.tracker.poll_interval = float(settings.get('max_context_cache_poll_interval', VERSION_POLL_INTERVAL))
+
+    def check_version(self, database):
+        """
+            Discards the cached contexts if another process changed any
+        """
+        version = self.tracker.current(database)
+        if version != self.version:
+            self.contexts.clear()
+            self.policies.clear()
+            self.version = version
+
+    def get(self, database, chash):
+        """
+            Returns a copy of the context document with a hash, or None if it doesn't exist
+        """
+        self.check_version(database)
+        context = self.contexts.get(chash)
+        if context is None:
+            context = database.contexts.find_one({'hash': chash})
+            if context is None:
+                return None
+            self.contexts.set(chash, context)
+        return deepcopy(context)
+
+    def public_contexts(self, database, permission):
+        """
+            Returns a dict of hash -> url of the contexts with a public policy
+            for a permission (read, write). The dict is shared, don't modify it.
+        """
+        self.check_version(database)
+        contexts = self.policies.get(permission)
+        if contexts is None:
+            query = {'permissions.{}'.format(permission): 'public'}
+            contexts = dict([(context['hash'], context['url']) for context in database.contexts.find(query, {'hash': 1, 'url': 1})])
+            self.policies.set(permission, contexts)
+        return contexts
+
+    def url(self, database, chash):
+        context = self.get(database, chash)
+        return context['url'] if context else None
+
+    def invalidate(self, database):
+        """
+            Discards the cached contexts of all processes
+        """
+        self.version = self.tracker.bump(database)
+        self.contexts.clear()
+        self.policies.clear()
+
+    def clear(self):
+        self.contexts.clear()
+        self.policies.clear()
+        self.tracker.reset()
+        self.version = None
+
+
+context_cache = ContextCache()
+
+
+def get_context_cache(request):
+    """
+        Returns the context cache if enabled
+    """
+    return context_cache if context_cache_enabled(request.registry.max_settings) else None
+
+
+def invalidate_context_cache(request):
+    """
+        Discards the cached contexts after a change, if the cache is enabled
+    """
+    if context_cache_enabled(request.registry.max_settings):
+        # Other processes must find the changes once they see the new version
+        request.db.flush()
+        context_cache.invalidate(request.registry.max_store)
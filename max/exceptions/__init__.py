@@ -47,3 +47,11 @@ class Forbidden(Exception):
 
 class ConnectionError(Exception):
     pass
+
+
+class ConcurrentModification(Exception):
+    pass
+
+
+class ActivityPending(Exception):
+    pass
@@ -45,6 +45,10 @@ class JSONHTTPNotFound(JSONHTTPException):
     code = 404
 
 
+class JSONHTTPConflict(JSONHTTPException):
+    code = 409
+
+
 class JSONHTTPNotImplemented(JSONHTTPException):
     code = 501
 
@@ -3,6 +3,8 @@
     Views to catch different exceptions across execution of a request
 """
 
+from max.exceptions import ActivityPending
+from max.exceptions import ConcurrentModification
 from max.exceptions import DuplicatedItemError
 from max.exceptions import Forbidden
 from max.exceptions import InvalidPermission
@@ -14,6 +16,7 @@ from max.exceptions import Unauthorized
 from max.exceptions import UnknownUserError
 from max.exceptions import ValidationError
 from max.exceptions.http import JSONHTTPBadRequest
+from max.exceptions.http import JSONHTTPConflict
 from max.exceptions.http import JSONHTTPForbidden
 from max.exceptions.http import JSONHTTPInternalServerError
 from max.exceptions.http import JSONHTTPNotFound
@@ -68,6 +71,16 @@ def duplicated_item_error(exc, request):
     return JSONHTTPBadRequest(error=dict(objectType='error', error=DuplicatedItemError.__name__, error_description=exc.message))
 
 
+@view_config(context=ConcurrentModification)
+def concurrent_modification(exc, request):
+    return JSONHTTPConflict(error=dict(objectType='error', error=ConcurrentModification.__name__, error_description=exc.message))
+
+
+@view_config(context=ActivityPending)
+def activity_pending(exc, request):
+    return JSONHTTPConflict(error=dict(objectType='error', error=ActivityPending.__name__, error_description=exc.message))
+
+
 @view_config(context=InvalidSearchParams)
 def invalid_search_params(exc, request):
     return JSONHTTPBadRequest(error=dict(objectType='error', error=InvalidSearchParams.__name__, error_description=exc.message))
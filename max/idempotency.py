@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+    Activity idempotency keys
+
+    Posting the same activity twice returns the first one, instead of creating a
+    duplicate. Each new activity stores a key on the ``activity_keys`` collection:
+
+        {
+            '_id': 'key:5f6b...' | 'content:91ac...',
+            'activity': ObjectId,
+            'expires': datetime,
+            'pending': True
+        }
+
+    The key is made from the ``Idempotency-Key`` header of the request, if any, and
+    lasts for ``max.idempotency_key_ttl`` seconds (a day by default). Otherwise it's
+    made from the content of the activity and where it's posted, and lasts for a
+    minute, so the same content posted again within a minute is a duplicate. Both are
+    scoped to the actor of the activity. Activities posted on a user timeline on
+    behalf of contexts are only deduplicated by ``Idempotency-Key``.
+
+    Keys are claimed with a single upsert on ``_id`` before inserting the activity,
+    so finding a duplicate costs one index lookup. A key is pending until its
+    activity is inserted, and a retry arriving meanwhile gets a conflict, instead of
+    creating the activity again. Only expired keys, and keys of deleted activities,
+    are taken over by new activities. Expired keys are removed by a TTL index on
+    ``expires``.
+"""
+from bson import ObjectId
+from max.exceptions import ActivityPending
+
+from datetime import datetime
+from datetime import timedelta
+
+import hashlib
+
+ACTIVITY_KEYS_COLLECTION = 'activity_keys'
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+IDEMPOTENCY_KEY_TTL = 24 * 60 * 60
+CONTENT_KEY_TTL = 60
+
+
+def hash_parts(*parts):
+    encoded = [part.encode('utf-8') if isinstance(part, unicode) else str(part) for part in parts]
+    return hashlib.sha1('\n'.join(encoded)).hexdigest()
+
+
+def activity_key(request, activity, scope):
+    """
+        Returns the key of a new activity and the seconds it lasts.
+
+        ``scope`` identifies where the activity is posted, as the context hash.
+        Activities without scope only have a key if the client provides it,
+        and (None, None) is returned otherwise.
+    """
+    actor = request.actor.get(request.actor.unique)
+    client_key = request.headers.get(IDEMPOTENCY_HEADER)
+    if client_key:
+        ttl = int(request.registry.max_settings.get('max_idempotency_key_ttl', IDEMPOTENCY_KEY_TTL))
+        return 'key:' + hash_parts(actor, client_key), ttl
+
+    if scope is None:
+        return None, None
+
+    content = activity['object'].get('content', u'')
+    return 'content:' + hash_parts(actor, scope, content), CONTENT_KEY_TTL
+
+
+def claim_activity_key(request, key, ttl, activity_id):
+    """
+        Assigns a key to a new activity, unless it's assigned to an existing one.
+
+        Returns the existing activity the key is assigned to, if any, or None if the
+        key has been assigned to the new activity. Raises ActivityPending if the
+        activity the key is assigned to is still being created.
+    """
+    keys = request.registry.max_store[ACTIVITY_KEYS_COLLECTION]
+    now = datetime.utcnow()
+    claim = {'activity': activity_id, 'expires': now + timedelta(seconds=ttl), 'pending': True}
+
+    existing = keys.find_and_modify(
+        query={'_id': key},
+        update={'$setOnInsert': claim},
+        upsert=True,
+        new=False
+    )
+    if existing is None:
+        return None
+
+    if existing['expires'] > now:
+        duplicated = request.db.activity.wrapped_find_one({'_id': ObjectId(existing['activity'])})
+        if duplicated is not None:
+            return duplicated
+        if existing.get('pending'):
+            raise ActivityPending('An activity with the same key is still being created, retry later')
+
+    # The key expired, but it's not removed yet, or its activity was deleted.
+    # Take it over, unless someone else did meanwhile
+    taken = keys.find_and_modify(
+        query={'_id': key, 'activity': existing['activity'], 'pending': existing.get('pending')},
+        update={'$set': claim},
+        new=True
+    )
+    if taken is not None:
+        return None
+    return claim_activity_key(request, key, ttl, activity_id)
+
+
+def complete_activity_key(request, key, activity_id):
+    """
+        Marks the key of an inserted activity as no longer pending
+    """
+    request.registry.max_store[ACTIVITY_KEYS_COLLECTION].update({'_id': key, 'activity': activity_id}, {'$unset': {'pending': ''}})
+
+
+def release_activity_key(request, key, activity_id):
+    """
+        Frees a key whose activity couldn't be created
+    """
+    request.registry.max_store[ACTIVITY_KEYS_COLLECTION].remove({'_id': key, 'activity': activity_id})
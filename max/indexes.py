@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+    Declarative mongodb indexes
+
+    Each model declares the indexes its queries rely on in an ``indexes`` class
+    attribute, next to its schema, as a list of ``Index`` objects. Collections not
+    backed by a model declare theirs in ``EXTRA_INDEXES``.
+
+    Every index records the REST routes (as named in ``max.routes.RESOURCES``) whose
+    queries depend on it, so the impact of a missing index can be reported.
+
+    Declarations are compared against the live database with ``diff_indexes``, and
+    applied with ``ensure_indexes``, either from the ``max.mongoindexes`` script or
+    on startup when ``max.ensure_indexes`` is enabled.
+"""
+from max.idempotency import ACTIVITY_KEYS_COLLECTION
+from max.jobs import FINISHED_JOBS_EXPIRATION
+from max.jobs import JOBS_COLLECTION
+from max.outbox import OUTBOX_COLLECTION
+from max.timelines import TIMELINES_COLLECTION
+
+from pymongo import ASCENDING
+from pymongo import DESCENDING
+from pymongo.errors import OperationFailure
+
+import logging
+
+logger = logging.getLogger('max')
+
+INDEX_OPTIONS = ['unique', 'sparse', 'expireAfterSeconds']
+
+
+class Index(object):
+    """
+        A mongodb index declaration.
+
+        ``keys`` is a list of (field, direction) tuples, or a single field name for an
+        ascending index on one field. Options not known by ``INDEX_OPTIONS`` are ignored
+        when comparing with existing indexes.
+    """
+
+    def __init__(self, keys, routes=[], name=None, **options):
+        if isinstance(keys, basestring):
+            keys = [(keys, ASCENDING)]
+        self.keys = list(keys)
+        self.routes = list(routes)
+        self.options = options
+        self.name = name if name else '_'.join(['{}_{}'.format(field, direction) for field, direction in self.keys])
+
+    def matches(self, info):
+        """
+            Checks if an existing index, as returned by ``index_information``,
+            has the same keys and options than this declaration
+        """
+        existing_keys = [(field, int(direction)) for field, direction in info.get('key', [])]
+        if existing_keys != self.keys:
+            return False
+        for option in INDEX_OPTIONS:
+            if bool(info.get(option, False)) != bool(self.options.get(option, False)):
+                return False
+        return True
+
+    def create(self, collection):
+        """
+            Creates the index on a pymongo collection
+        """
+        options = dict(self.options)
+        options.setdefault('background', True)
+        collection.create_index(self.keys, name=self.name, **options)
+
+    def describe(self):
+        """
+            Returns a human readable description of the index
+        """
+        keys = ', '.join(['{} {}'.format(field, 'desc' if direction == DESCENDING else 'asc') for field, direction in self.keys])
+        options = ''.join([' {}'.format(option) for option in sorted(self.options)])
+        return '{} ({}){}'.format(self.name, keys, options)
+
+    def __repr__(self):
+        return '<Index {}>'.format(self.describe())
+
+
+EXTRA_INDEXES = {
+    TIMELINES_COLLECTION: [
+        Index([('owner', ASCENDING), ('activity', DESCENDING)], routes=['user_activities', 'timeline']),
+        Index([('context', ASCENDING), ('owner', ASCENDING)], routes=['subscriptions', 'context_subscriptions', 'subscription']),
+        Index('activity', routes=['activity'])
+    ],
+    OUTBOX_COLLECTION: [
+        Index([('status', ASCENDING), ('_id', ASCENDING)], routes=['maintenance_outbox']),
+        Index([('key', ASCENDING), ('_id', ASCENDING)])
+    ],
+    JOBS_COLLECTION: [
+        Index([('status', ASCENDING), ('_id', ASCENDING)], routes=['job']),
+        Index('finished', routes=['job'], expireAfterSeconds=FINISHED_JOBS_EXPIRATION)
+    ],
+    ACTIVITY_KEYS_COLLECTION: [
+        Index('expires', routes=['context_activities', 'user_activities'], expireAfterSeconds=0)
+    ]
+}
+
+
+def declared_indexes():
+    """
+        Returns the declared indexes of all collections, as a dict of
+        collection name -> list of Index
+    """
+    from max.models import CLASS_COLLECTION_MAPPING
+    import max.models
+
+    indexes = {}
+    for collection, class_name in CLASS_COLLECTION_MAPPING.items():
+        model = getattr(max.models, class_name)
+        indexes[collection] = list(getattr(model, 'indexes', []))
+
+    for collection, extra in EXTRA_INDEXES.items():
+        indexes.setdefault(collection, []).extend(extra)
+    return indexes
+
+
+def diff_indexes(database, indexes=None):
+    """
+        Compares the declared indexes with the ones existing on the database.
+
+        Returns a dict of collection name -> dict with:
+
+            missing: declared indexes that don't exist
+            outdated: (declared index, existing info) with the same name but different definition
+            unknown: names of existing indexes not declared (excluding _id)
+    """
+    indexes = declared_indexes() if indexes is None else indexes
+    report = {}
+    for collection_name, declared in indexes.items():
+        existing = database[collection_name].index_information()
+        existing.pop('_id_', None)
+
+        missing, outdated = [], []
+        for index in declared:
+            info = existing.pop(index.name, None)
+            if info is None:
+                matching = [name for name, other in existing.items() if index.matches(other)]
+                if matching:
+                    # Same index created with another name, don't recreate it
+                    existing.pop(matching[0])
+                else:
+                    missing.append(index)
+            elif not index.matches(info):
+                outdated.append((index, info))
+
+        report[collection_name] = {
+            'missing': missing,
+            'outdated': outdated,
+            'unknown': sorted(existing.keys())
+        }
+    return report
+
+
+def ensure_indexes(database, drop_unknown=False, dry_run=False, indexes=None):
+    """
+        Creates missing indexes and recreates outdated ones. Unknown indexes are only
+        dropped if ``drop_unknown`` is set. With ``dry_run`` the database is not modified.
+
+        Returns the list of (action, collection, index description) performed.
+        Failures creating an index are logged and reported as ``failed``,
+        so one bad index doesn't prevent the others from being created.
+    """
+    actions = []
+    report = diff_indexes(database, indexes)
+    for collection_name, changes in sorted(report.items()):
+        collection = database[collection_name]
+
+        pending = [('create', index) for index in changes['missing']]
+        pending += [('recreate', index) for index, info in changes['outdated']]
+        for action, index in pending:
+            if dry_run:
+                actions.append((action, collection_name, index.describe()))
+                continue
+            try:
+                if action == 'recreate':
+                    collection.drop_index(index.name)
+                index.create(collection)
+            except OperationFailure as exc:
+                logger.error('Could not create index {} on {}: {}'.format(index.name, collection_name, exc))
+                actions.append(('failed', collection_name, index.describe()))
+            else:
+                actions.append((action, collection_name, index.describe()))
+
+        for name in changes['unknown']:
+            if drop_unknown:
+                actions.append(('drop', collection_name, name))
+                if not dry_run:
+                    collection.drop_index(name)
+            else:
+                actions.append(('unknown', collection_name, name))
+
+    return actions
@@ -0,0 +1,403 @@
+# -*- coding: utf-8 -*-
+"""
+    Jobs
+
+    Operations that have to go through whole collections, as the maintenance rebuilds
+    or the propagation of context changes to subscriptions and activities, are defined
+    as jobs. A job is made of steps, and each step processes the documents of a collection
+    matching a query, in ``_id`` order and in batches:
+
+        register_job('rebuild_users', [
+            JobStep('users', {}, rebuild_user)
+        ])
+
+    Steps without a collection run its process function once, and get a ``JobCheckpoint``
+    instead of a document, so long running steps that iterate on their own can store
+    their progress and resume from it.
+
+    Each job run is stored on the ``jobs`` collection:
+
+        {
+            'name': 'rebuild_users',
+            'params': {},
+            'status': 'queued' | 'running' | 'done' | 'failed',
+            'step': 0,
+            'steps': 1,
+            'last_id': ObjectId,
+            'processed': 200,
+            'total': 1000,
+            'throughput': 850.5,
+            'worker': 'hostname:pid',
+            'heartbeat': datetime,
+            'created': datetime,
+            'started': datetime,
+            'finished': datetime,
+            'error': 'message'
+        }
+
+    The step and last processed ``_id`` are stored after each batch, so a job resumes
+    where it was left if the worker running it dies. While a job runs, its heartbeat is
+    also updated from a timer, so long steps keep it alive. Running jobs whose heartbeat
+    is older than ``max.jobs_heartbeat_timeout`` seconds (``HEARTBEAT_TIMEOUT`` by
+    default) are considered abandoned and claimed again. Writes on a job are made on
+    behalf of its worker, and a worker whose job has been claimed by another one stops
+    running it.
+
+    By default jobs run inline, inside the request that dispatches them. When
+    ``max.background_jobs`` is enabled, requests only queue them, and they're run
+    by the processes of the ``max.jobs`` script.
+"""
+from max.MADMax import get_collection_model
+
+from pyramid.settings import asbool
+
+from bson import ObjectId
+from datetime import datetime
+from datetime import timedelta
+from pymongo import ASCENDING
+
+import logging
+import os
+import socket
+import threading
+
+logger = logging.getLogger('max')
+
+JOBS_COLLECTION = 'jobs'
+BATCH_SIZE = 100
+HEARTBEAT_TIMEOUT = 300
+WORKER_INTERVAL = 2
+FINISHED_JOBS_EXPIRATION = 7 * 24 * 60 * 60
+
+JOBS = {}
+
+
+class JobReclaimed(Exception):
+    """
+        The job has been claimed by another worker
+    """
+
+
+class JobStep(object):
+    """
+        A step of a job.
+
+        ``query`` is a dict, or a function that returns it from the job params.
+        ``process`` is called with the request, each document and the job params.
+        Documents are wrapped in its model class, unless ``wrap`` is False.
+    """
+
+    def __init__(self, collection, query, process, wrap=True, batch_size=BATCH_SIZE):
+        self.collection = collection
+        self.query = query
+        self.process = process
+        self.wrap = wrap
+        self.batch_size = batch_size
+
+    def get_query(self, params):
+        query = self.query(params) if callable(self.query) else self.query
+        return dict(query or {})
+
+
+class JobCheckpoint(object):
+    """
+        Progress of a step without collection, as stored on its job
+    """
+
+    def __init__(self, job, update):
+        self.job = job
+        self.update = update
+
+    @property
+    def last_id(self):
+        return self.job.get('last_id')
+
+    @property
+    def processed(self):
+        return self.job.get('processed', 0)
+
+    def save(self, last_id, processed, **fields):
+        """
+            Stores the last _id and the total number of documents processed, along with
+            any other progress field.
+        """
+        fields.update({'last_id': last_id, 'processed': processed})
+        self.update(**fields)
+
+
+def register_job(name, steps):
+    """
+        Registers the steps of a job
+    """
+    JOBS[name] = list(steps)
+
+
+def background_jobs_enabled(settings):
+    """
+        Checks if jobs are run by workers instead of inline
+    """
+    return asbool(settings.get('max_background_jobs', False))
+
+
+def worker_id():
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+def heartbeat_timeout(settings):
+    """
+        Returns the seconds after which a running job without heartbeat is abandoned
+    """
+    return int(settings.get('max_jobs_heartbeat_timeout', HEARTBEAT_TIMEOUT))
+
+
+class JobHeartbeat(threading.Thread):
+    """
+        Updates the heartbeat of a running job periodically, until stopped
+        or until the job is claimed by another worker.
+    """
+
+    def __init__(self, jobs, job, interval):
+        super(JobHeartbeat, self).__init__(name='max-job-heartbeat')
+        self.daemon = True
+        self.jobs = jobs
+        self.job = job
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                result = self.jobs.update(
+                    {'_id': self.job['_id'], 'worker': self.job.get('worker')},
+                    {'$set': {'heartbeat': datetime.utcnow()}})
+            except Exception as exc:
+                logger.error('Job {} heartbeat error: {}'.format(self.job['_id'], exc))
+                continue
+            if not result.get('n'):
+                return
+
+    def stop(self):
+        self.stopped.set()
+
+
+def create_job(database, name, params={}, status='queued'):
+    """
+        Stores a new job run. Returns the job document.
+    """
+    if name not in JOBS:
+        raise KeyError('Unknown job {}'.format(name))
+
+    now = datetime.utcnow()
+    job = {
+        'name': name,
+        'params': params,
+        'status': status,
+        'step': 0,
+        'steps': len(JOBS[name]),
+        'last_id': None,
+        'processed': 0,
+        'total': None,
+        'created': now
+    }
+    if status == 'running':
+        job.update({'worker': worker_id(), 'started': now, 'heartbeat': now})
+    job['_id'] = database[JOBS_COLLECTION].insert(job)
+    return job
+
+
+def dispatch_job(request, name, params={}):
+    """
+        Runs a job inline, or queues it for the workers if background jobs are enabled.
+
+        Returns the job document. Inline jobs that fail are marked as failed
+        and raise the original exception.
+    """
+    database = request.registry.max_store
+
+    # Jobs read the database directly, so they need the writes made before
+    request.db.flush()
+    if background_jobs_enabled(request.registry.max_settings):
+        return create_job(database, name, params)
+
+    job = create_job(database, name, params, status='running')
+    return run_job(request, job, reraise=True)
+
+
+def get_job(database, job_id):
+    """
+        Returns a job document, or None if the id is not valid or the job doesn't exist
+    """
+    try:
+        job_id = ObjectId(job_id)
+    except Exception:
+        return None
+    return database[JOBS_COLLECTION].find_one({'_id': job_id})
+
+
+def job_info(job):
+    """
+        Returns a json friendly representation of a job
+    """
+    def format_date(value):
+        return value.strftime('%Y/%m/%d %H:%M:%S') if value else None
+
+    total = job.get('total')
+    return {
+        'id': str(job['_id']),
+        'name': job['name'],
+        'params': job.get('params', {}),
+        'status': job['status'],
+        'step': job.get('step', 0),
+        'steps': job.get('steps', 0),
+        'processed': job.get('processed', 0),
+        'total': total,
+        'throughput': job.get('throughput'),
+        'progress': round(job.get('processed', 0) * 100.0 / total, 2) if total else None,
+        'worker': job.get('worker'),
+        'created': format_date(job.get('created')),
+        'started': format_date(job.get('started')),
+        'finished': format_date(job.get('finished')),
+        'error': job.get('error')
+    }
+
+
+def run_job(request, job, reraise=False):
+    """
+        Runs the pending steps of a claimed job, from its checkpoint.
+
+        Returns the updated job document.
+    """
+    # Steps read the database directly, so writes are made right away
+    with request.db.unit_of_work.suspended():
+        return run_job_steps(request, job, reraise)
+
+
+def run_job_steps(request, job, reraise=False):
+    jobs = request.registry.max_store[JOBS_COLLECTION]
+
+    def update(**fields):
+        fields['heartbeat'] = datetime.utcnow()
+        result = jobs.update({'_id': job['_id'], 'worker': job.get('worker')}, {'$set': fields})
+        if not result.get('n'):
+            raise JobReclaimed('Job {} {} has been claimed by another worker'.format(job['name'], job['_id']))
+        job.update(fields)
+
+    heartbeat = JobHeartbeat(jobs, job, heartbeat_timeout(request.registry.max_settings) / 5.0)
+    heartbeat.start()
+    try:
+        return run_claimed_job_steps(request, job, update, reraise)
+    except JobReclaimed as exc:
+        logger.warning(str(exc))
+        return job
+    finally:
+        heartbeat.stop()
+
+
+def run_claimed_job_steps(request, job, update, reraise=False):
+    database = request.registry.max_store
+    steps = JOBS[job['name']]
+    params = job.get('params', {})
+
+    try:
+        for index in range(job.get('step', 0), len(steps)):
+            step = steps[index]
+            last_id = job.get('last_id')
+
+            if step.collection is None:
+                step.process(request, JobCheckpoint(job, update), params)
+            else:
+                query = step.get_query(params)
+                if last_id is None:
+                    update(total=database[step.collection].find(query).count(), processed=0)
+                model = get_collection_model(step.collection) if step.wrap else None
+
+                while True:
+                    batch_query = dict(query)
+                    if last_id is not None:
+                        batch_query['_id'] = {'$gt': last_id}
+                    batch = list(database[step.collection].find(batch_query).sort([('_id', ASCENDING)]).limit(step.batch_size))
+                    if not batch:
+                        break
+
+                    for item in batch:
+                        step.process(request, model.from_object(request, item) if model else item, params)
+
+                    last_id = batch[-1]['_id']
+                    update(last_id=last_id, processed=job.get('processed', 0) + len(batch))
+
+            update(step=index + 1, last_id=None)
+
+    except JobReclaimed:
+        raise
+    except Exception as exc:
+        logger.exception('Job {} {} failed'.format(job['name'], job['_id']))
+        update(status='failed', error=str(exc), finished=datetime.utcnow())
+        if reraise:
+            raise
+        return job
+
+    update(status='done', finished=datetime.utcnow())
+    return job
+
+
+class JobRunner(object):
+    """
+        Claims queued and abandoned jobs and runs them
+    """
+
+    def __init__(self, registry):
+        self.registry = registry
+        self.jobs = registry.max_store[JOBS_COLLECTION]
+        self.worker = worker_id()
+
+    def claim(self):
+        """
+            Marks the oldest queued or abandoned job as run by this worker and returns it
+        """
+        now = datetime.utcnow()
+        timeout = heartbeat_timeout(self.registry.max_settings)
+        return self.jobs.find_and_modify(
+            query={'$or': [
+                {'status': 'queued'},
+                {'status': 'running', 'heartbeat': {'$lt': now - timedelta(seconds=timeout)}}
+            ]},
+            update={'$set': {'status': 'running', 'worker': self.worker, 'heartbeat': now, 'started': now}},
+            sort=[('_id', ASCENDING)],
+            new=True
+        )
+
+    def run_next(self):
+        """
+            Runs the next claimable job. Returns the job run, if any.
+        """
+        from pyramid.scripting import prepare
+
+        job = self.claim()
+        if job is None:
+            return None
+
+        env = prepare(registry=self.registry)
+        request = env['request']
+        # Jobs run on behalf of no one
+        request.actor = None
+        request.creator = None
+        try:
+            run_job(request, job)
+        finally:
+            request._process_finished_callbacks()
+            env['closer']()
+        return job
+
+    def run(self, stop_event, interval=WORKER_INTERVAL):
+        """
+            Runs jobs until stop_event is set, waiting interval seconds
+            when there are no jobs to run.
+        """
+        while not stop_event.is_set():
+            try:
+                job = self.run_next()
+            except Exception as exc:
+                logger.error('Jobs worker error: {}'.format(exc))
+                job = None
+            if job is None:
+                stop_event.wait(interval)
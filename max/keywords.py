@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+    Keywords reindexer
+
+    Recomputes the ``_keywords`` of all posted activities, as the activity models do
+    when an activity or comment is created, but working on raw documents: activities
+    are read in ``_id`` ranges with only the fields keywords depend on, keywords are
+    computed for each range, optionally on a pool of processes, and only the keyword
+    fields are written back, with unordered bulk updates.
+
+    After each range is written, the last ``_id`` processed is reported, so an
+    interrupted reindex can be resumed from it.
+"""
+from max.utils.formatting import findKeywords
+
+from pymongo import ASCENDING
+
+import multiprocessing
+import time
+
+REINDEX_BATCH_SIZE = 1000
+REINDEX_QUERY = {'verb': 'post'}
+REINDEX_FIELDS = {
+    'object.content': 1,
+    'object._keywords': 1,
+    'actor': 1,
+    'replies.actor': 1,
+    'replies._keywords': 1,
+    'repliesCount': 1
+}
+
+
+def activity_keywords(activity):
+    """
+        Returns the keywords of an activity, made of the keywords of its object,
+        the username and displayName of its actor, and the keywords and actors
+        of its comments. Actors are only accounted if they are persons.
+    """
+    keywords = []
+    keywords.extend(activity['object'].get('_keywords', []))
+    if activity['actor']['objectType'] == 'person':
+        keywords.append(activity['actor']['username'])
+        keywords.extend(activity['actor']['username'].split('.'))
+        keywords.extend(activity['actor'].get('displayName', '').lower().split())
+
+    # Add keywords from comment objects
+    for comment in activity.get('replies', []):
+        keywords.extend(comment_keywords(comment))
+
+    # delete duplicates
+    return list(set(keywords))
+
+
+def comment_keywords(comment):
+    """
+        Returns the keywords a comment adds to its activity, made of the
+        keywords of the comment and the username and displayName of its actor.
+    """
+    keywords = list(comment.get('_keywords', []))
+    keywords.append(comment['actor']['username'])
+    keywords.extend(comment['actor']['username'].split('.'))
+    keywords.extend(comment['actor'].get('displayName', '').lower().split())
+    return keywords
+
+
+def document_keywords(document):
+    """
+        Returns the object and activity keywords of a raw activity document.
+
+        Object keywords are found on the object content. Objects without
+        content keep the keywords they have.
+    """
+    activity_object = document.get('object', {})
+    if 'content' in activity_object:
+        object_keywords = findKeywords(activity_object['content'])
+    else:
+        object_keywords = activity_object.get('_keywords', [])
+
+    keywords = activity_keywords(dict(document, object={'_keywords': object_keywords}))
+    return object_keywords, keywords
+
+
+def compute_keywords(documents):
+    """
+        Returns a list of (_id, object keywords, activity keywords) of a batch of
+        raw activity documents. Runs on the pool processes, so it must be picklable.
+    """
+    return [(document['_id'], ) + document_keywords(document) for document in documents]
+
+
+class KeywordReindexer(object):
+    """
+        Reindexes the keywords of the activities of a database.
+
+        With ``processes`` greater than 0, keywords are computed on a pool of
+        processes, otherwise on the current one.
+    """
+
+    def __init__(self, database, processes=0, batch_size=REINDEX_BATCH_SIZE):
+        self.collection = database.activity
+        self.processes = processes
+        self.batch_size = batch_size
+
+    def count(self, last_id=None):
+        return self.collection.find(self.query(last_id)).count()
+
+    def query(self, last_id=None):
+        query = dict(REINDEX_QUERY)
+        if last_id is not None:
+            query['_id'] = {'$gt': last_id}
+        return query
+
+    def batches(self, last_id=None):
+        """
+            Yields the activities to reindex, in ranges of consecutive _id
+        """
+        while True:
+            cursor = self.collection.find(self.query(last_id), REINDEX_FIELDS)
+            batch = list(cursor.sort([('_id', ASCENDING)]).limit(self.batch_size))
+            if not batch:
+                return
+            yield self.with_comments(batch)
+            last_id = batch[-1]['_id']
+
+    def with_comments(self, batch):
+        """
+            Activities only keep a preview of their last replies, so the replies
+            of the activities with more comments are read from their comment
+            activities, all of the batch at once.
+        """
+        truncated = dict([(document['_id'], document) for document in batch if document.get('repliesCount', 0) > len(document.get('replies', []))])
+        if not truncated:
+            return batch
+
+        for document in truncated.values():
+            document['replies'] = []
+        query = {'verb': 'comment', 'object.inReplyTo._id': {'$in': truncated.keys()}}
+        fields = {'actor': 1, 'object._keywords': 1, 'object.inReplyTo._id': 1}
+        for comment in self.collection.find(query, fields).sort([('_id', ASCENDING)]):
+            document = truncated[comment['object']['inReplyTo'][0]['_id']]
+            document['replies'].append({'actor': comment['actor'], '_keywords': comment['object'].get('_keywords', [])})
+        return batch
+
+    def windows(self, last_id=None):
+        """
+            Groups batches in windows of one batch per process, so reading
+            doesn't get ahead of the computation.
+        """
+        window = []
+        for batch in self.batches(last_id):
+            window.append(batch)
+            if len(window) >= max(self.processes, 1):
+                yield window
+                window = []
+        if window:
+            yield window
+
+    def write(self, results):
+        """
+            Writes the keywords of a batch, updating only the keywords fields
+        """
+        bulk = self.collection.initialize_unordered_bulk_op()
+        for activity_id, object_keywords, keywords in results:
+            bulk.find({'_id': activity_id}).update_one({'$set': {
+                'object._keywords': object_keywords,
+                '_keywords': keywords
+            }})
+        bulk.execute()
+
+    def run(self, last_id=None, checkpoint=None):
+        """
+            Reindexes the activities after last_id, or all of them.
+
+            After each written batch, checkpoint is called with the last _id written,
+            the number of activities processed and the throughput in activities per
+            second. Returns the same values at the end.
+        """
+        pool = multiprocessing.Pool(self.processes) if self.processes > 0 else None
+        mapper = pool.map if pool is not None else map
+
+        started = time.time()
+        processed = 0
+        throughput = 0.0
+        try:
+            for window in self.windows(last_id):
+                for results in mapper(compute_keywords, window):
+                    self.write(results)
+                    processed += len(results)
+                    last_id = results[-1][0]
+                    throughput = round(processed / max(time.time() - started, 0.001), 2)
+                    if checkpoint is not None:
+                        checkpoint(last_id, processed, throughput)
+        except:
+            if pool is not None:
+                pool.terminate()
+            raise
+        else:
+            if pool is not None:
+                pool.close()
+        finally:
+            if pool is not None:
+                pool.join()
+
+        return last_id, processed, throughput
@@ -1,6 +1,10 @@
 # -*- coding: utf-8 -*-
 from max import DEFAULT_CONTEXT_PERMISSIONS
 from max.MADObjects import MADBase
+from max.contextcache import get_context_cache
+from max.indexes import Index
+from max.keywords import activity_keywords
+from max.keywords import comment_keywords
 from max.models.context import Context
 from max.models.user import User
 from max.rabbitmq import RabbitNotifications
@@ -21,6 +25,8 @@ from max.security.permissions import unfavorite
 from max.security.permissions import unflag
 from max.security.permissions import unlike
 from max.security.permissions import view_activity
+from max.timelines import TimelineFeeds
+from max.timelines import materialized_timelines_enabled
 from max.utils import getMaxModelByObjectType
 from max.utils import hasPermission
 from max.utils.dates import rfc3339_parse
@@ -32,6 +38,8 @@ from pyramid.security import Authenticated
 
 from PIL import Image
 from bson import ObjectId
+from pymongo import ASCENDING
+from pymongo import DESCENDING
 
 import datetime
 import json
@@ -40,6 +48,26 @@ import re
 import requests
 
 ACTIVITY_CONTEXT_FIELDS = ['displayName', 'tags', 'hash', 'url', 'objectType', 'notifications']
+COMMENT_ACTOR_EXCLUDED_FIELDS = ['talkingIn', 'subscribedTo', 'following', 'last_login', '_id', 'published', 'twitterUsername']
+
+# Number of the last comments kept on the activity replies
+REPLIES_PREVIEW_SIZE = 5
+
+
+def comment_from_activity(activity, actor=None):
+    """
+        Returns a comment, as shown on the replies of its activity, from its comment activity.
+    """
+    comment = dict(activity['object'])
+    comment.pop('inReplyTo', None)
+    comment['published'] = activity['published']
+    comment['actor'] = dict(actor if actor is not None else activity['actor'])
+    comment['id'] = activity['_id']
+
+    # Clean innecessary fields
+    for fieldname in COMMENT_ACTOR_EXCLUDED_FIELDS:
+        comment['actor'].pop(fieldname, None)
+    return comment
 
 
 class BaseActivity(MADBase):
@@ -75,6 +103,9 @@ class BaseActivity(MADBase):
         'replies': {
             'default': []
         },
+        'repliesCount': {
+            'default': 0
+        },
         'generator': {
             'default': None
         },
@@ -153,69 +184,118 @@ class BaseActivity(MADBase):
         self.save()
 
     def get_comment(self, commentid):
-        comments = [comment for comment in self['replies'] if comment['id'] == commentid]
-        return comments[0] if comments is not [] else False
+        """
+            Returns a comment of the activity, from the replies preview if there,
+            or from its comment activity otherwise. Returns None if not found.
+        """
+        comments = [comment for comment in self.get('replies', []) if str(comment['id']) == str(commentid)]
+        if comments:
+            return comments[0]
+
+        try:
+            query = {'_id': ObjectId(commentid), 'verb': 'comment', 'object.inReplyTo._id': self['_id']}
+        except Exception:
+            return None
+        comment_activity = self.mdb_collection.find_one(query)
+        return comment_from_activity(comment_activity) if comment_activity else None
 
     def setKeywords(self):
-        # Append actor as username if object has keywords and actor is a Person
-        self['_keywords'] = []
-        self['_keywords'].extend(self['object'].get('_keywords', []))
-        if self['actor']['objectType'] == 'person':
-            self['_keywords'].append(self['actor']['username'])
-            self['_keywords'].extend(self['actor']['username'].split('.'))
-            self['_keywords'].extend(self['actor'].get('displayName', '').lower().split())
-
-        # Add keywords from comment objects
-        replies = self.get('replies', [])
-        for comment in replies:
-            self['_keywords'].extend(comment.get('_keywords', []))
-            self['_keywords'].append(comment['actor']['username'])
-            self['_keywords'].extend(comment['actor']['username'].split('.'))
-            self['_keywords'].extend(comment['actor'].get('displayName', '').lower().split())
-
-        # delete duplicates
-        self['_keywords'] = list(set(self['_keywords']))
+        self['_keywords'] = activity_keywords(self)
 
     def addComment(self, comment):
         """
             Adds a comment to an existing activity and updates refering activity keywords and hashtags
-        """
-
-        # Clean innecessary fields
-        non_needed_actor_fields = ['talkingIn', 'subscribedTo', 'following', 'last_login', '_id', 'published', 'twitterUsername']
-        for fieldname in non_needed_actor_fields:
-            if fieldname in comment['actor']:
-                del comment['actor'][fieldname]
 
-        self.add_to_list('replies', comment, allow_duplicates=True)
-        self.setKeywords()
-
-        activity_hashtags = self['object'].setdefault('_hashtags', [])
-        activity_hashtags.extend(comment.get('_hashtags', []))
-        self['object']['_hashtags'] = list(set(activity_hashtags))
-        self['lastComment'] = ObjectId(comment['id'])
-
-        self.save()
+            The comment itself is stored as a comment activity. The activity only keeps
+            the count of comments, the last one and a preview of the latest, and
+            gets the keywords and hashtags of the comment, in a single update.
+        """
+        update = {
+            '$push': {'replies': {'$each': [comment], '$slice': -REPLIES_PREVIEW_SIZE}},
+            '$set': {'lastComment': ObjectId(comment['id'])},
+            '$addToSet': {'_keywords': {'$each': comment_keywords(comment)}}
+        }
+        if 'repliesCount' in self:
+            update['$inc'] = {'repliesCount': 1}
+        else:
+            # Activities from before the count was kept
+            update['$set']['repliesCount'] = len(self.get('replies', [])) + 1
+        if comment.get('_hashtags'):
+            update['$addToSet']['object._hashtags'] = {'$each': comment['_hashtags']}
+
+        updated = self.mdb_collection.find_and_modify(
+            query={'_id': self['_id']},
+            update=update,
+            fields=['replies', 'repliesCount', 'lastComment', '_keywords', 'object._hashtags'],
+            new=True
+        )
+        self._refresh_fields(updated, ['replies', 'repliesCount', 'lastComment', '_keywords'])
+        self['object']['_hashtags'] = (updated or {}).get('object', {}).get('_hashtags', [])
+        self.mark_saved(['object._hashtags'])
 
         notify = self.get('contexts', [{}])[0].get('notifications', False)
         if notify in ['comments']:
             notifier = RabbitNotifications(self.request)
             notifier.notify_context_activity_comment(self, comment)
 
-    def delete_comment(self, commentid):
+    def rebuild_replies(self):
         """
+            Rebuilds the replies preview, the count of comments, the last one and the
+            keywords of the activity from its comment activities, reading only the
+            preview comments whole.
+
+            The rebuilt fields are only written if the count and the last comment stored
+            didn't change meanwhile. Otherwise a comment was added or deleted concurrently,
+            and they're rebuilt again.
         """
-        self.delete_from_list('replies', {'id': commentid})
-        self['replies'] = [comment for comment in self['replies'] if comment.get('id', comment.get('_id')) != commentid]
-        if self['replies'] == []:
-            self['lastComment'] = self['_id']
-        else:
-            self['lastComment'] = ObjectId(str(self['replies'][-1]['id']))
+        fields = ['replies', 'repliesCount', 'lastComment', '_keywords']
+        query = {'verb': 'comment', 'object.inReplyTo._id': self['_id']}
+        while True:
+            stored = self.mdb_collection.find_one({'_id': self['_id']}, ['repliesCount', 'lastComment'])
+            if stored is None:
+                return
 
-        self.setKeywords()
-        self.save()
+            last_activities = self.mdb_collection.find(query, {'actor': 1, 'object': 1, 'published': 1})
+            last_comments = [comment_from_activity(comment) for comment in last_activities.sort([('_id', DESCENDING)]).limit(REPLIES_PREVIEW_SIZE)]
+
+            # The keywords of all the comments are read from the fields they're made of
+            keyword_activities = self.mdb_collection.find(query, {'actor.username': 1, 'actor.displayName': 1, 'object._keywords': 1})
+            keyword_comments = [{'actor': comment['actor'], '_keywords': comment.get('object', {}).get('_keywords', [])} for comment in keyword_activities]
+
+            self['replies'] = last_comments[::-1]
+            self['repliesCount'] = self.mdb_collection.find(query).count()
+            self['lastComment'] = ObjectId(last_comments[0]['id']) if last_comments else self['_id']
+            self['_keywords'] = activity_keywords(dict(self, replies=keyword_comments))
+
+            updated = self.mdb_collection.find_and_modify(
+                query={'_id': self['_id'], 'repliesCount': stored.get('repliesCount'), 'lastComment': stored.get('lastComment')},
+                update={'$set': dict([(field, self[field]) for field in fields])},
+                fields=['_id']
+            )
+            if updated is not None:
+                self.mark_saved(fields)
+                return
+
+    def delete_comment(self, commentid):
+        """
+            Deletes a comment activity and rebuilds the replies of the activity
+        """
+        comment_activity = self.mdb_collection.find_one({'_id': ObjectId(commentid), 'verb': 'comment'})
+        if comment_activity is not None:
+            self.__class__.from_object(self.request, comment_activity).delete()
+        self.rebuild_replies()
         # XXX TODO Update hastags
 
+    def mark_deletable_comments(self, comments):
+        """
+            Marks the comments the actor of the request can delete: all of them
+            if the activity is deletable, or its own ones otherwise.
+        """
+        actor_id_field = 'username' if isinstance(self.request.actor, User) else 'url'
+        for comment in comments:
+            comment['deletable'] = self['deletable'] or self.request.actor[actor_id_field] == comment['actor'].get('username')
+        return comments
+
     def extract_file_from_activity(self):
         file_activity = self['object']['file']
         del self['object']['file']
@@ -346,6 +426,7 @@ class Activity(BaseActivity):
     context_class = Context
     resource_root = 'activities'
     unique = '_id'
+    volatile_fields = ['deletable', 'comments', 'liked', 'favorited']
     schema = dict(BaseActivity.schema)
     schema['deletable'] = {}
     schema['comments'] = {}
@@ -358,6 +439,21 @@ class Activity(BaseActivity):
     schema['favorites'] = {'default': []}
     schema['favoritesCount'] = {'default': 0}
 
+    indexes = [
+        Index([('actor.username', ASCENDING), ('_id', DESCENDING)], routes=['user_activities', 'timeline', 'timeline_authors', 'user_comments']),
+        Index([('contexts.hash', ASCENDING), ('_id', DESCENDING)], routes=['timeline', 'context_activities', 'context_comments', 'context_activities_authors', 'subscriptions']),
+        Index('contexts.url', routes=['context_activities', 'context_comments', 'context_activities_authors']),
+        Index('object._hashtags', routes=['activities', 'timeline', 'context_activities']),
+        Index('_keywords', routes=['activities', 'timeline', 'context_activities']),
+        Index('favorites.username', routes=['user_favorites', 'timeline', 'context_activities']),
+        Index([('object.inReplyTo._id', ASCENDING), ('_id', DESCENDING)], routes=['activity_comments', 'activity_comment']),
+        Index('likes.username', routes=['user_likes']),
+        Index([('published', DESCENDING)], routes=['activities', 'timeline', 'context_activities']),
+        Index([('lastComment', DESCENDING)], routes=['comments', 'timeline', 'context_activities']),
+        Index([('likesCount', DESCENDING), ('lastLike', DESCENDING), ('_id', DESCENDING)], routes=['timeline', 'context_activities']),
+        Index([('flagged', DESCENDING), ('_id', DESCENDING)], routes=['timeline', 'context_activities'])
+    ]
+
     @reify
     def __acl__(self):
         acl = [
@@ -430,8 +526,11 @@ class Activity(BaseActivity):
 
             # If no susbcription found, check context policy
             else:
-                # XXX This should be cached at resource level
-                context.wake()
+                context_cache = get_context_cache(self.request)
+                if context_cache is not None:
+                    context = context_cache.get(self.request.registry.max_store, context['hash']) or {}
+                else:
+                    context.wake()
                 if context.get('permissions', {}).get('read', DEFAULT_CONTEXT_PERMISSIONS['read']) == 'public':
                     acl.append((Allow, self.request.authenticated_userid, view_activity))
                     if is_self_operation(self.request):
@@ -466,6 +565,19 @@ class Activity(BaseActivity):
 
         return acl
 
+    def _field_permissions_key(self):
+        """
+            The activity acl depends on its ownership, its context and the
+            likes and favorites of the actor.
+        """
+        contexts = self.get('contexts', [])
+        return (
+            is_owner(self, self.request.authenticated_userid),
+            contexts[0].get('hash') if contexts else None,
+            self.has_favorite_from(self.request.actor),
+            self.has_like_from(self.request.actor)
+        )
+
     def flatten(self, *args, **kwargs):
         self.pop('comments', None)
         return super(Activity, self).flatten(*args, **kwargs)
@@ -477,18 +589,28 @@ class Activity(BaseActivity):
     def _before_insert_object(self):
         # Remove comments traverser before inserting
         self.pop('comments', None)
+        # The id is known beforehand, so lastComment is stored with the activity
+        self.setdefault('_id', ObjectId())
+        self['lastComment'] = self['_id']
 
     def _after_insert_object(self, oid):
         # notify activity if the activity is from a context
         # with enabled notifications
-        self['lastComment'] = oid
-        self.save()
-
         notify = self.get('contexts', [{}])[0].get('notifications', False)
         if notify in ['posts', 'comments', True]:
             notifier = RabbitNotifications(self.request)
             notifier.notify_context_activity(self)
 
+        if materialized_timelines_enabled(self.request):
+            TimelineFeeds(self.db).fanout(self)
+
+    def _after_delete(self):
+        """
+            Removes the deleted activity from the materialized timelines
+        """
+        if materialized_timelines_enabled(self.request):
+            TimelineFeeds(self.db).remove_activities([self['_id']])
+
     def _post_init_from_object(self, source):
         """
             * Set the deletable flag on the object. If user is the owner don't check anything else,
@@ -507,8 +629,7 @@ class Activity(BaseActivity):
                 self['deletable'] = context['hash'] in subscriptions_with_delete_permission
 
         # Mark the comments with the deletable flag too
-        for comment in self.get('replies', []):
-            comment['deletable'] = self['deletable'] or self.request.actor[actor_id_field] == comment['actor']['username']
+        self.mark_deletable_comments(self.get('replies', []))
 
         self['favorited'] = self.has_favorite_from(self.request.actor)
         self['liked'] = self.has_like_from(self.request.actor)
@@ -517,56 +638,124 @@ class Activity(BaseActivity):
 
     def flag(self):
         """
+            Flags the activity, if not flagged yet.
+
+            Returns True if the activity has been flagged now.
         """
-        self['flagged'] = datetime.datetime.utcnow()
+        updated = self.mdb_collection.find_and_modify(
+            query={'_id': self['_id'], 'flagged': None},
+            update={'$set': {'flagged': datetime.datetime.utcnow()}},
+            new=True
+        )
+        if updated is None:
+            return False
+        self.update(updated)
+        self.mark_saved([field for field in updated if field in self.schema])
+        return True
 
     def unflag(self):
         """
+            Removes the flag of the activity
         """
+        self.mdb_collection.update({'_id': self['_id']}, {'$set': {'flagged': None}})
         self['flagged'] = None
+        self.mark_saved(['flagged'])
 
-    def add_favorite_from(self, actor):
+    def _refresh_fields(self, updated, fields):
         """
-            Adds a favorite mark from somebody to an activity
+            Updates fields of the activity with the values of a stored document,
+            or with the currently stored ones if no document is given, and marks
+            them as saved.
+        """
+        if updated is None:
+            updated = self.mdb_collection.find_one({'_id': self['_id']}, fields) or {}
+        for field in fields:
+            self[field] = updated.get(field)
+        self.mark_saved(fields)
+
+    def _add_mark_from(self, actor, field, count_field, **fields):
+        """
+            Adds a mark (like, favorite) from somebody to an activity, and increments
+            the count of marks, in a single atomic update. The update is guarded
+            against duplicates, so concurrent marks from the same actor are only
+            counted once, and concurrent marks from different actors are not lost.
+
+            Any other field to set along the mark can be given as keyword arguments.
+            The marks of the activity are refreshed with the stored ones.
+
+            Returns True if the mark was added, False if it was already there.
         """
         prepared_actor = {
             actor.unique: actor.get(actor.unique),
             'objectType': actor['objectType']
         }
-        self.add_to_list('favorites', prepared_actor, allow_duplicates=False)
-        self['favoritesCount'] = len(self['favorites'])
-        self.save()
+        update = {
+            '$addToSet': {field: prepared_actor},
+            '$inc': {count_field: 1}
+        }
+        if fields:
+            update['$set'] = fields
+
+        refreshed_fields = [field, count_field] + fields.keys()
+        updated = self.mdb_collection.find_and_modify(
+            query={'_id': self['_id'], '{}.{}'.format(field, actor.unique): {'$ne': actor[actor.unique]}},
+            update=update,
+            fields=refreshed_fields,
+            new=True
+        )
+        self._refresh_fields(updated, refreshed_fields)
+        return updated is not None
+
+    def _delete_mark_from(self, actor, field, count_field):
+        """
+            Deletes the mark (like, favorite) from somebody from an activity, and
+            decrements the count of marks, in a single atomic update.
+
+            Returns True if the mark was deleted, False if it wasn't there.
+        """
+        refreshed_fields = [field, count_field]
+        updated = self.mdb_collection.find_and_modify(
+            query={'_id': self['_id'], '{}.{}'.format(field, actor.unique): actor[actor.unique]},
+            update={
+                '$pull': {field: {actor.unique: actor[actor.unique]}},
+                '$inc': {count_field: -1}
+            },
+            fields=refreshed_fields,
+            new=True
+        )
+        self._refresh_fields(updated, refreshed_fields)
+        return updated is not None
+
+    def add_favorite_from(self, actor):
+        """
+            Adds a favorite mark from somebody to an activity
+        """
+        return self._add_mark_from(actor, 'favorites', 'favoritesCount')
 
     def add_like_from(self, actor):
         """
             Adds a like mark from somebody to an activity
         """
-        prepared_actor = {
-            actor.unique: actor.get(actor.unique),
-            'objectType': actor['objectType']
-        }
-        self.add_to_list('likes', prepared_actor, allow_duplicates=False)
-        self['likesCount'] = len(self['likes'])
-        self['lastLike'] = datetime.datetime.utcnow()
-        self.save()
+        return self._add_mark_from(actor, 'likes', 'likesCount', lastLike=datetime.datetime.utcnow())
 
     def delete_favorite_from(self, actor):
         """
             Deletes the favorite mark from somebody from an activity
         """
-        self.delete_from_list('favorites', {actor.unique: actor.get(actor.unique)})
-        self['favorites'] = [favorite for favorite in self['favorites'] if favorite[actor.unique] != actor[actor.unique]]
-        self['favoritesCount'] = len(self['favorites'])
-        self.save()
+        return self._delete_mark_from(actor, 'favorites', 'favoritesCount')
 
     def delete_like_from(self, actor):
         """
             Deletes the like mark from somebody from an activity
         """
-        self.delete_from_list('likes', {actor.unique: actor.get(actor.unique)})
-        self['likes'] = [like for like in self['likes'] if like[actor.unique] != actor[actor.unique]]
-        self['likesCount'] = len(self['likes'])
-        self.save()
+        deleted = self._delete_mark_from(actor, 'likes', 'likesCount')
+        # Activities without likes must sort as never liked ones. The update is
+        # conditional so a like arrived meanwhile keeps its date
+        if deleted and not self['likesCount']:
+            self.mdb_collection.update({'_id': self['_id'], 'likesCount': 0}, {'$set': {'lastLike': None}})
+            self['lastLike'] = None
+            self.mark_saved(['lastLike'])
+        return deleted
 
     def has_like_from(self, actor):
         """
@@ -2,12 +2,15 @@
 from max import DEFAULT_CONTEXT_PERMISSIONS
 from max.MADMax import MADMaxCollection
 from max.MADObjects import MADBase
-from max.models.user import User
+from max.contextcache import invalidate_context_cache
+from max.indexes import Index
 from max.rabbitmq import RabbitNotifications
 from max.security import Manager
 from max.security import Owner
 from max.security import is_self_operation
 from max.security import permissions
+from max.timelines import TimelineFeeds
+from max.timelines import materialized_timelines_enabled
 from max.utils.twitter import get_twitter_api
 from max.utils.twitter import get_userid_from_twitter
 
@@ -17,6 +20,8 @@ from pyramid.security import Authenticated
 
 from hashlib import sha1
 
+SUBSCRIPTIONS_BULK_SIZE = 1000
+
 
 class BaseContext(MADBase):
     """
@@ -191,66 +196,123 @@ class BaseContext(MADBase):
         # Construct a list of all updatable fields that has changes. On force_update=True, all
         # fields with requested update will pass trough
 
-        if must_update_fields:
-            for user in self.subscribedUsers():
-                user_object = User.from_object(self.request, user)
-                criteria = {'_id': user['_id'], '{}.{}'.format(self.user_subscription_storage, self.unique.lstrip('_')): self.getIdentifier()}
-                updates = {}
+        if not must_update_fields:
+            return
 
-                if 'url' in must_update_fields:
-                    updates.update({'{}.$.url'.format(self.user_subscription_storage): self['url']})
-                    updates.update({'{}.$.hash'.format(self.user_subscription_storage): self['hash']})
+        storage = self.user_subscription_storage
+        subscription_key = self.unique.lstrip('_')
+        criteria = {'{}.{}'.format(storage, subscription_key): self.getIdentifier()}
+        usersdb = self.mdb_collection.database.users
 
-                if 'displayName' in must_update_fields:
-                    updates.update({'{}.$.displayName'.format(self.user_subscription_storage): self['displayName']})
+        # Fields copied as is to the subscriptions are updated on all users at once,
+        # each user gets its subscription to this context updated through the positional operator
+        updates = {}
 
-                if 'tags' in must_update_fields:
-                    updates.update({'{}.$.tags'.format(self.user_subscription_storage): self.get('tags', [])})
+        if 'url' in must_update_fields:
+            updates.update({'{}.$.url'.format(storage): self['url']})
+            updates.update({'{}.$.hash'.format(storage): self['hash']})
 
-                if 'notifications' in must_update_fields:
-                    updates.update({'{}.$.notifications'.format(self.user_subscription_storage): self.get('notifications', False)})
+        if 'displayName' in must_update_fields:
+            updates.update({'{}.$.displayName'.format(storage): self['displayName']})
 
-                if 'participants' in must_update_fields:
-                    updates.update({'{}.$.participants'.format(self.user_subscription_storage): self['participants']})
+        if 'tags' in must_update_fields:
+            updates.update({'{}.$.tags'.format(storage): self.get('tags', [])})
 
-                if 'permissions' in must_update_fields:
-                    subscription = user_object.getSubscription(self)
-                    _vetos = subscription.get('_vetos', [])
-                    _grants = subscription.get('_grants', [])
+        if 'notifications' in must_update_fields:
+            updates.update({'{}.$.notifications'.format(storage): self.get('notifications', False)})
 
-                    # The default permissions from the new configured context
-                    new_permissions = self.subscription_permissions()
+        if 'participants' in must_update_fields:
+            updates.update({'{}.$.participants'.format(storage): self['participants']})
 
-                    # First add the persistent granted permissions
-                    for granted_permission in _grants:
-                        if granted_permission not in new_permissions:
-                            new_permissions.append(granted_permission)
+        # Subscribers are looked up by the identifier the subscriptions still have,
+        # so it has to be done before the subscriptions get the new hash
+        url_changed = self.field_changed('url')
+        if url_changed:
+            subscribed_usernames = [user['username'] for user in usersdb.find(criteria, {'username': 1})]
 
-                    # Then rebuild list excluding the vetted permissions
-                    # except if the permission is also granted
-                    # This way, the vetted permissions will disappear, and the plain ones
-                    # will remain untouched
-                    new_permissions = [permission for permission in new_permissions if (permission not in _vetos or permission in _grants)]
+        if 'permissions' in must_update_fields:
+            self.updateUsersSubscriptionsPermissions()
 
-                    updates.update({'{}.$.permissions'.format(self.user_subscription_storage): new_permissions})
+        if updates:
+            usersdb.update(criteria, {'$set': updates}, multi=True)
 
-                if updates:
-                    combined_updates = {'$set': updates}
-                    self.mdb_collection.database.users.update(criteria, combined_updates, multi=True)
+        # update original subscriptions related to the subscribed users when changing url
+        if url_changed:
+            self.mdb_collection.database.activity.update(
+                {'actor.username': {'$in': subscribed_usernames}, 'object.url': self.old['url']},
+                {'$set': {
+                    'object.url': self['url'],
+                    'object.hash': self['hash'],
+                }},
+                multi=True
+            )
 
-                # update original subscriptions related to this user when changing url
-                if self.field_changed('url'):
-                    self.field_changed('url')
-                    self.mdb_collection.database.activity.update(
-                        {'actor.username': user['username'], 'object.url': self.old['url']},
-                        {'$set': {
-                            'object.url': self['url'],
-                            'object.hash': self['hash'],
-                        }},
-                        multi=True
-                    )
+        self.save()
 
-                self.save()
+    def updateUsersSubscriptionsPermissions(self):
+        """
+            Updates the permissions of the users subscriptions with the current context permissions.
+
+            All the subscriptions without granted or vetoed permissions get the same permissions,
+            so they're updated at once. The rest are computed for each user and written
+            in batched bulk operations.
+        """
+        storage = self.user_subscription_storage
+        subscription_key = self.unique.lstrip('_')
+        usersdb = self.mdb_collection.database.users
+        permissions_field = '{}.$.permissions'.format(storage)
+
+        # The default permissions from the new configured context
+        default_permissions = self.subscription_permissions()
+
+        usersdb.update(
+            {storage: {'$elemMatch': {
+                subscription_key: self.getIdentifier(),
+                '_grants.0': {'$exists': False},
+                '_vetos.0': {'$exists': False}
+            }}},
+            {'$set': {permissions_field: default_permissions}},
+            multi=True
+        )
+
+        users_with_overrides = usersdb.find(
+            {storage: {'$elemMatch': {
+                subscription_key: self.getIdentifier(),
+                '$or': [{'_grants.0': {'$exists': True}}, {'_vetos.0': {'$exists': True}}]
+            }}},
+            {storage: {'$elemMatch': {subscription_key: self.getIdentifier()}}}
+        )
+
+        bulk = None
+        pending = 0
+        for user in users_with_overrides:
+            subscription = user[storage][0]
+            _vetos = subscription.get('_vetos', [])
+            _grants = subscription.get('_grants', [])
+
+            # First add the persistent granted permissions
+            new_permissions = list(default_permissions)
+            for granted_permission in _grants:
+                if granted_permission not in new_permissions:
+                    new_permissions.append(granted_permission)
+
+            # Then rebuild list excluding the vetted permissions
+            # except if the permission is also granted
+            # This way, the vetted permissions will disappear, and the plain ones
+            # will remain untouched
+            new_permissions = [permission for permission in new_permissions if (permission not in _vetos or permission in _grants)]
+
+            if bulk is None:
+                bulk = usersdb.initialize_unordered_bulk_op()
+            bulk.find({'_id': user['_id'], '{}.{}'.format(storage, subscription_key): self.getIdentifier()}).update({'$set': {permissions_field: new_permissions}})
+            pending += 1
+
+            if pending == SUBSCRIPTIONS_BULK_SIZE:
+                bulk.execute()
+                bulk, pending = None, 0
+
+        if bulk is not None:
+            bulk.execute()
 
     def removeUserSubscriptions(self, users_to_delete=[]):
         """
@@ -341,6 +403,13 @@ class Context(BaseContext):
 
     schema['uploadURL'] = {}
 
+    indexes = [
+        Index('hash', routes=['context', 'context_activities', 'context_subscriptions'], unique=True),
+        Index('url', routes=['context_activities', 'contexts', 'public_contexts']),
+        Index('tags', routes=['contexts', 'public_contexts']),
+        Index('permissions.read', routes=['context_activities', 'public_contexts'])
+    ]
+
     @reify
     def __acl__(self):
         acl = [
@@ -400,6 +469,12 @@ class Context(BaseContext):
 
         return acl
 
+    def _field_permissions_key(self):
+        """
+            The context acl depends on the context policy and the actor subscription to it
+        """
+        return (self.get('hash'), tuple(sorted(self.get('permissions', {}).items())))
+
     def alreadyExists(self):
         """
             Checks if there's an object with the value specified in the unique field.
@@ -415,8 +490,7 @@ class Context(BaseContext):
             value = self.data.get(unique)
 
         if value:
-            query = {unique: value}
-            return self.mdb_collection.find_one(query)
+            return self.find_unique(value)
         else:
             # in the case that we don't have the unique value in the request data
             # Assume that the object doesn't exist
@@ -490,16 +564,31 @@ class Context(BaseContext):
 
         self.save()
 
+    def updateContextActivities(self, force_update=False):
+        """
+            Updates context's activities with changes of the original context,
+            and keeps the materialized timelines pointing to the new hash
+            if the url changed.
+        """
+        super(Context, self).updateContextActivities(force_update=force_update)
+        if self.field_changed('url') and materialized_timelines_enabled(self.request):
+            TimelineFeeds(self.db).rename_context(self.old['hash'], self['hash'])
+
     def _after_insert_object(self, oid):
+        invalidate_context_cache(self.request)
         if self.field_changed('twitterUsername'):
             notifier = RabbitNotifications(self.request)
             notifier.restart_tweety()
 
     def _after_saving_object(self, oid):
+        invalidate_context_cache(self.request)
         if self.field_changed('twitterUsername'):
             notifier = RabbitNotifications(self.request)
             notifier.restart_tweety()
 
+    def _after_delete(self):
+        invalidate_context_cache(self.request)
+
     def _after_subscription_add(self, username):
         """
             Creates rabbitmq bindings after new subscription
@@ -508,9 +597,19 @@ class Context(BaseContext):
             notifier = RabbitNotifications(self.request)
             notifier.bind_user_to_context(self, username)
 
+        if materialized_timelines_enabled(self.request):
+            TimelineFeeds(self.db).add_context(username, self.getIdentifier())
+
     def _after_subscription_remove(self, username):
         """
             Removes rabbitmq bindings after new subscription
         """
         notifier = RabbitNotifications(self.request)
         notifier.unbind_user_from_context(self, username)
+
+        if materialized_timelines_enabled(self.request):
+            # Activities from followed users must stay in the timeline
+            user = self.mdb_collection.database.users.find_one({'username': username}, {'following': 1}) or {}
+            followed_usernames = [followed['username'] for followed in user.get('following', [])]
+            followed_usernames.append(username)
+            TimelineFeeds(self.db).remove_context(username, self.getIdentifier(), keep_actors=followed_usernames)
@@ -1,5 +1,5 @@
 # -*- coding: utf-8 -*-
-from max.MADMax import MADMaxCollection
+from max.indexes import Index
 from max.models.context import BaseContext
 from max.rabbitmq import RabbitNotifications
 from max.security import Manager
@@ -20,6 +20,77 @@ from max.utils.dicts import flatten
 from pyramid.decorator import reify
 from pyramid.security import Allow
 
+from bson import ObjectId
+from pymongo import ASCENDING
+from pymongo import DESCENDING
+
+
+def last_message_summary(message):
+    """
+        Builds the summary of a message that is stored on its conversation as lastMessage
+    """
+    actor = message['actor']
+    summary = {
+        'published': message['published'],
+        'content': message['object'].get('content', ''),
+        'objectType': message['object']['objectType'],
+        'actor': actor['displayName'] if actor.get('displayName', '') != '' else actor['username']
+    }
+
+    # Set object urls for media types
+    if summary['objectType'] in ['file', 'image']:
+        summary['fullURL'] = message['object'].get('fullURL', '')
+        if summary['objectType'] == 'image':
+            summary['thumbURL'] = message['object'].get('thumbURL', '')
+
+    return summary
+
+
+def update_last_message(database, message):
+    """
+        Stores a message as the last message of its conversation, unless the
+        conversation already has a newer one. Returns the stored summary.
+    """
+    summary = last_message_summary(message)
+    conversation_id = ObjectId(message['contexts'][0]['id'])
+    database.conversations.update(
+        {
+            '_id': conversation_id,
+            '$or': [
+                {'lastMessageAt': {'$lte': message['published']}},
+                {'lastMessageAt': None}
+            ]
+        },
+        {'$set': {'lastMessage': summary, 'lastMessageAt': message['published']}}
+    )
+    return summary
+
+
+def refresh_last_message(database, conversation_id):
+    """
+        Recomputes the last message of a conversation from its messages and stores it.
+        Conversations without messages keep its published date as lastMessageAt, so they
+        still sort among the others. Returns the stored summary, if any.
+    """
+    conversation_id = ObjectId(conversation_id)
+    message = database.messages.find_one(
+        {'objectType': 'message', 'contexts.id': str(conversation_id)},
+        sort=[('_id', DESCENDING)])
+
+    if message is None:
+        conversation = database.conversations.find_one({'_id': conversation_id}, {'published': 1})
+        published = conversation.get('published') if conversation else None
+        database.conversations.update(
+            {'_id': conversation_id},
+            {'$set': {'lastMessageAt': published}, '$unset': {'lastMessage': 1}})
+        return None
+
+    summary = last_message_summary(message)
+    database.conversations.update(
+        {'_id': conversation_id},
+        {'$set': {'lastMessage': summary, 'lastMessageAt': message['published']}})
+    return summary
+
 
 class Conversation(BaseContext):
     """
@@ -37,6 +108,14 @@ class Conversation(BaseContext):
     schema['participants'] = {'required': 1}
     schema['tags'] = {'default': []}
     schema['objectType'] = {'default': 'conversation'}
+    schema['lastMessage'] = {}
+    schema['lastMessageAt'] = {}
+
+    indexes = [
+        Index('participants.username', routes=['conversations', 'conversations_active', 'participants']),
+        Index('published', routes=['conversations', 'user_conversations']),
+        Index([('participants.username', ASCENDING), ('lastMessageAt', DESCENDING)], routes=['conversations', 'user'])
+    ]
 
     @reify
     def __acl__(self):
@@ -89,6 +168,13 @@ class Conversation(BaseContext):
 
         return acl
 
+    def _field_permissions_key(self):
+        """
+            The conversation acl depends on the creator subscription to it,
+            and on its archived state
+        """
+        return (self.get('_id'), 'archive' in self.get('tags', []))
+
     def buildObject(self):
         super(Conversation, self).buildObject()
 
@@ -98,7 +184,7 @@ class Conversation(BaseContext):
     def prepareUserSubscription(self):
         """
         """
-        fields_to_squash = ['published', 'owner', 'creator', 'participants', 'tags', 'displayName']
+        fields_to_squash = ['published', 'owner', 'creator', 'participants', 'tags', 'displayName', 'lastMessage', 'lastMessageAt']
         if '_id' != self.unique:
             fields_to_squash.append('_id')
         subscription = flatten(self, squash=fields_to_squash)
@@ -115,34 +201,19 @@ class Conversation(BaseContext):
 
     def lastMessage(self):
         """
-            Retrieves last conversation message
+            Retrieves last conversation message, as stored on the conversation
+            when messages are added. Conversations that don't have it yet, get it
+            computed from its messages and stored.
         """
-        query = {
-            'objectType': 'message',
-            'contexts.id': self.getIdentifier()
-        }
-
-        message = MADMaxCollection(self.request, 'messages').last(query, flatten=True)
-
-        if message['actor']['displayName'] != '':
-            name_actor = message['actor']['displayName']
-        else:
-            name_actor = message['actor']['username']
-
-        lastMessage = {
-            'published': message['published'],
-            'content': message['object'].get('content', ''),
-            'objectType': message['object']['objectType'],
-            'actor': name_actor
-        }
-
-        # Set object urls for media types
-        if message['object']['objectType'] in ['file', 'image']:
-            lastMessage['fullURL'] = message['object'].get('fullURL', '')
-            if message['object']['objectType'] == 'image':
-                lastMessage['thumbURL'] = message['object'].get('thumbURL', '')
-
-        return lastMessage
+        last_message = self.get('lastMessage')
+        if last_message is None:
+            last_message = refresh_last_message(self.mdb_collection.database, self['_id'])
+            if last_message is None:
+                return None
+            self['lastMessage'] = last_message
+            self['lastMessageAt'] = last_message['published']
+
+        return flatten(last_message)
 
     def getInfo(self, username):
         """
@@ -1,6 +1,10 @@
 # -*- coding: utf-8 -*-
+from max.indexes import Index
 from max.models.activity import BaseActivity
 from max.models.conversation import Conversation
+from max.models.conversation import last_message_summary
+from max.models.conversation import refresh_last_message
+from max.models.conversation import update_last_message
 from max.security import Manager
 from max.security import Owner
 from max.security.permissions import modify_message
@@ -10,6 +14,10 @@ from max.utils.dicts import flatten
 from pyramid.decorator import reify
 from pyramid.security import Allow
 
+from bson import ObjectId
+from pymongo import ASCENDING
+from pymongo import DESCENDING
+
 
 MESSAGE_CONTEXT_FIELDS = ['displayName', '_id', 'objectType']
 
@@ -28,6 +36,11 @@ class Message(BaseActivity):
     schema = dict(BaseActivity.schema)
     schema['objectType'] = {'default': 'message'}
 
+    indexes = [
+        Index([('contexts.id', ASCENDING), ('_id', DESCENDING)], routes=['conversation_messages', 'user_conversation_messages', 'conversations', 'user_conversations']),
+        Index('actor.username', routes=['messages'])
+    ]
+
     @reify
     def __acl__(self):
         acl = [
@@ -45,6 +58,44 @@ class Message(BaseActivity):
 
         return acl
 
+    def _field_permissions_key(self):
+        """
+            The message acl depends only on the conversation it belongs to
+        """
+        contexts = self.get('contexts', [])
+        return (contexts[0].get('id') if contexts else None, )
+
+    def _after_insert_object(self, oid, **kwargs):
+        """
+            Stores the new message as the last one of its conversation,
+            also on the conversation object the message was built with, if any.
+        """
+        if not self.get('contexts'):
+            return
+        summary = update_last_message(self.mdb_collection.database, self)
+        conversation = (self.data.get('contexts') or [None])[0]
+        if isinstance(conversation, Conversation):
+            conversation['lastMessage'] = summary
+            conversation['lastMessageAt'] = self['published']
+
+    def _after_saving_object(self, oid):
+        """
+            Keeps the last message of the conversation updated when the message
+            changes after insertion, as media urls are set once the file is stored.
+        """
+        if not self.get('contexts'):
+            return
+        self.mdb_collection.database.conversations.update(
+            {'_id': ObjectId(self['contexts'][0]['id']), 'lastMessageAt': self['published']},
+            {'$set': {'lastMessage': last_message_summary(self)}})
+
+    def _after_delete(self):
+        """
+            Recomputes the last message of the conversation
+        """
+        if self.get('contexts'):
+            refresh_last_message(self.mdb_collection.database, self['contexts'][0]['id'])
+
     def buildObject(self):
         """
             Updates the dict content with the activity structure,
@@ -27,9 +27,39 @@ class Security(MADBase):
         'roles': {}
     }
 
+    def __init__(self, request):
+        super(Security, self).__init__(request)
+        # Inverted index of the roles, built from self['roles']
+        self.role_users = {}
+        self.user_roles = {}
+
+    def _post_init_from_object(self, source):
+        self.reindex()
+        return True
+
+    def _after_saving_object(self, oid):
+        refresher = getattr(self.request.registry, 'max_security_refresher', None)
+        if refresher is not None:
+            refresher.saved()
+        return True
+
     def _ensure_security(self):
         self.setdefault('roles', {})
 
+    def reindex(self):
+        """
+            Builds the role -> users and user -> roles indexes
+        """
+        self._ensure_security()
+        role_users = {}
+        user_roles = {}
+        for role, users in self['roles'].items():
+            role_users[role] = set(users)
+            for user in role_users[role]:
+                user_roles.setdefault(user, []).append(role)
+        self.role_users = role_users
+        self.user_roles = user_roles
+
     def add_user_to_role(self, user, role):
         """
             Grants a role to an user.
@@ -44,6 +74,7 @@ class Security(MADBase):
 
         if user not in self['roles'][role]:
             self['roles'][role].append(user)
+            self.reindex()
             return True
 
         return False
@@ -62,6 +93,7 @@ class Security(MADBase):
 
         if user in self['roles'][role]:
             self['roles'][role].remove(user)
+            self.reindex()
             return True
 
         return False
@@ -77,12 +109,10 @@ class Security(MADBase):
         """
             Get a list of all the roles that a user has.
         """
-        self._ensure_security()
-        return [role for role, users in self["roles"].items() if user in users]
+        return list(self.user_roles.get(user, []))
 
     def has_role(self, user, role):
         """
             Check if an user has a particular role
         """
-        self._ensure_security()
-        return user in self.get_role_users(role)
+        return user in self.role_users.get(role, ())
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 from max.MADObjects import MADBase
+from max.indexes import Index
 from max.exceptions import ValidationError
 from max.security import Manager
 from max.security import Owner
@@ -71,6 +72,11 @@ class Token(MADBase):
         },
     }
 
+    indexes = [
+        Index('token', routes=['token', 'tokens'], unique=True),
+        Index('_owner', routes=['user_tokens', 'user_platform_tokens', 'context_push_tokens', 'conversation_push_tokens'])
+    ]
+
     def format_unique(self, key):
         return key
 
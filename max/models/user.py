@@ -2,7 +2,10 @@
 from max import DEFAULT_CONTEXT_PERMISSIONS_PERMANENCY
 from max.MADMax import MADMaxCollection
 from max.MADObjects import MADBase
+from max.indexes import Index
+from max.peoplesearch import search_field
 from max.rabbitmq import RabbitNotifications
+from max.resources import get_max_security
 from max.security import Manager
 from max.security import Owner
 from max.security import is_self_operation
@@ -20,6 +23,8 @@ from max.security.permissions import view_private_fields
 from max.security.permissions import view_subscriptions
 from max.security.permissions import view_user_profile
 from max.security.permissions import view_timeline
+from max.timelines import TimelineFeeds
+from max.timelines import materialized_timelines_enabled
 from max.utils import getMaxModelByObjectType
 from max.utils.dicts import flatten
 
@@ -29,6 +34,7 @@ from pyramid.security import Authenticated
 from pyramid.settings import asbool
 
 from bson import ObjectId
+from pymongo import DESCENDING
 
 import datetime
 
@@ -89,8 +95,21 @@ class User(MADBase):
             'formatters': ['stripTwitterUsername'],
             'validators': ['isValidTwitterUsername']
         },
+        '_search': {
+            'view': modify_immutable_fields,
+            'edit': modify_immutable_fields
+        },
     }
 
+    indexes = [
+        Index('username', routes=['user', 'users', 'timeline', 'subscriptions'], unique=True),
+        Index('_search.words', routes=['users']),
+        Index('_search.grams', routes=['users']),
+        Index('subscribedTo.hash', routes=['context_subscriptions', 'context_push_tokens', 'timeline']),
+        Index('talkingIn.id', routes=['participants', 'conversation_push_tokens', 'conversations']),
+        Index('following.username', routes=['follows', 'timeline'])
+    ]
+
     @reify
     def __acl__(self):
         acl = [
@@ -125,6 +144,12 @@ class User(MADBase):
 
         return acl
 
+    def _field_permissions_key(self):
+        """
+            The user acl doesn't depend on the user itself, only on the request
+        """
+        return ()
+
     def format_unique(self, key):
         return key
 
@@ -401,9 +426,9 @@ class User(MADBase):
 
         in_restricted_visibility_mode = asbool(self.request.registry.max_settings.get('max_restricted_user_visibility_mode', False))
 
-        non_visible_user_list = self.request.registry.max_security.get_role_users('NonVisible')
-        i_am_visible = self['username'] not in non_visible_user_list
-        user_is_visible = user['username'] not in non_visible_user_list
+        security = get_max_security(self.request.registry)
+        i_am_visible = not security.has_role(self['username'], 'NonVisible')
+        user_is_visible = not security.has_role(user['username'], 'NonVisible')
 
         # I'm a visible person, so i should not see NonVisible persons,
         # regardless of the subscriptions we share
@@ -429,6 +454,24 @@ class User(MADBase):
         # We are in restricted mode without shared contexts with the user
         return False
 
+    def visible_users_query(self):
+        """
+        Returns the conditions of a users query to get only the people
+        this user is allowed to see, as defined in is_allowed_to_see
+        """
+        query = {}
+        in_restricted_visibility_mode = asbool(self.request.registry.max_settings.get('max_restricted_user_visibility_mode', False))
+
+        security = get_max_security(self.request.registry)
+        if not security.has_role(self['username'], 'NonVisible'):
+            query['$and'] = [{'username': {'$nin': security.get_role_users('NonVisible')}}]
+
+        if in_restricted_visibility_mode:
+            my_subcriptions = [subscription['hash'] for subscription in self.get('subscribedTo', [])]
+            query['subscribedTo.hash'] = {'$in': my_subcriptions}
+
+        return query
+
     def getInfo(self):
         actor = self.flatten()
         if self.has_field_permission('talkingIn', 'view'):
@@ -437,53 +480,47 @@ class User(MADBase):
             if actor['talkingIn']:
                 conversation_objectids = [ObjectId(conv['id']) for conv in actor['talkingIn']]
                 conversations_collection = MADMaxCollection(self.request, 'conversations')
-                conversations = conversations_collection.search({'_id': {'$in': conversation_objectids}})
-                conversations_by_id = {str(conv['_id']): conv for conv in conversations}
-
-                messages_collection = MADMaxCollection(self.request, 'messages').collection
-
-                pipeline = [
-                    {"$match": {"contexts.id": {"$in": conversations_by_id.keys()}}},
-                    {"$sort": {"_id": 1}},
-                    {"$group": {
-                        "_id": "$contexts.id",
-                        "object": {"$last": "$object"},
-                        "published": {"$last": "$published"}
-                    }}
-                ]
-                messages = messages_collection.aggregate(pipeline)['result']
-
-                def format_message(db_message):
-                    message_object = db_message.get('object', {})
+                conversations = conversations_collection.search(
+                    {'_id': {'$in': conversation_objectids}},
+                    sort_params=[('lastMessageAt', DESCENDING), ('_id', DESCENDING)])
+
+                def format_message(last_message):
                     message = dict(
-                        objectType=message_object.get('objectType', 'note'),
-                        content=message_object.get('content', ''),
-                        published=db_message.get('published', '')
+                        objectType=last_message.get('objectType', 'note'),
+                        content=last_message.get('content', ''),
+                        published=last_message.get('published', '')
                     )
 
                     if isinstance(message['published'], datetime.datetime):
-                        try:
-                            message['published'] = message['published'].isoformat()
-                        except:
-                            message['published'] = message['published']
+                        message['published'] = message['published'].isoformat()
 
                     # Set object urls for media types
                     if message['objectType'] in ['file', 'image']:
-                        message['fullURL'] = message_object.get('fullURL', '')
+                        message['fullURL'] = last_message.get('fullURL', '')
                         if message['objectType'] == 'image':
-                            message['thumbURL'] = message_object.get('thumbURL', '')
+                            message['thumbURL'] = last_message.get('thumbURL', '')
 
                     return message
-                messages_by_conversation = {message['_id'][0]: format_message(message) for message in messages}
-                for subscription in actor['talkingIn']:
-                    conversation_object = conversations_by_id[subscription['id']]
+
+                # Conversations come sorted by its last message, so subscriptions
+                # are listed in the same order
+                subscriptions_by_id = {subscription['id']: subscription for subscription in actor['talkingIn']}
+                talking_in = []
+                for conversation_object in conversations:
+                    subscription = subscriptions_by_id.pop(str(conversation_object['_id']))
+                    last_message = conversation_object.get('lastMessage')
+                    if last_message is None:
+                        conversation_object.lastMessage()
+                        last_message = conversation_object.get('lastMessage', {})
+
                     subscription['displayName'] = conversation_object.realDisplayName(self['username'])
-                    subscription['lastMessage'] = messages_by_conversation[subscription['id']]
+                    subscription['lastMessage'] = format_message(last_message)
                     subscription['participants'] = conversation_object['participants']
                     subscription['tags'] = conversation_object['tags']
                     subscription['messages'] = 0
+                    talking_in.append(subscription)
 
-                actor['talkingIn'] = sorted(actor['talkingIn'], reverse=True, key=lambda conv: conv['lastMessage']['published'])
+                actor['talkingIn'] = talking_in + subscriptions_by_id.values()
 
         return actor
 
@@ -500,10 +537,18 @@ class User(MADBase):
                  '_id': {'$in': subscribed_conversations}
                  }
 
-        conversations_search = self.request.db.conversations.search(query, sort_by_field="published")
+        conversations_search = self.request.db.conversations.search(query, sort_params=[('lastMessageAt', DESCENDING), ('_id', DESCENDING)])
 
         return conversations_search
 
+    def _before_insert_object(self):
+        self['_search'] = search_field(self)
+        return True
+
+    def _before_saving_object(self):
+        self['_search'] = search_field(self)
+        return True
+
     def _after_insert_object(self, oid, notifications=True):
         """
             Create user exchanges just after user creation on the database
@@ -526,6 +571,10 @@ class User(MADBase):
             notifier = RabbitNotifications(self.request)
             notifier.add_user(self['username'])
 
+        # New users start with an empty materialized timeline
+        if materialized_timelines_enabled(self.request):
+            TimelineFeeds(self.db).create(self['username'])
+
     def _before_delete(self):
         """
             Executed before an object removal
@@ -561,3 +610,6 @@ class User(MADBase):
             fake_deleted_context = Context.from_object(self.request, subscription)
             self.removeSubscription(fake_deleted_context)
 
+        if materialized_timelines_enabled(self.request):
+            TimelineFeeds(self.db).remove(self['username'])
+
@@ -1,53 +1,59 @@
 # -*- coding: utf-8 -*-
+"""
+    In-memory mongodb query profiler
+
+    Patches pymongo cursors to measure the time spent fetching results from mongodb,
+    and aggregates the measures in memory by route, collection and normalized query
+    shape, so queries that only differ in their values are accounted together.
+
+    For each shape we keep the number of queries, total, max and p95 latency, documents
+    returned and a sampled stack of the max code that originated the query.
+
+    Enabled by default, can be disabled with ``max.query_profiler = false``. Results are
+    per process, and can be inspected and reset on ``/admin/maintenance/queries``.
+"""
 from pyramid.threadlocal import get_current_request
 
-from copy import deepcopy
+from collections import deque
 from datetime import datetime
-from hashlib import sha1
 from pymongo.cursor import Cursor
 from pyramid.settings import asbool
 
 import json
 import os
-import re
+import threading
+import time
 import traceback
 
-original_Cursor__init__ = Cursor.__init__
-original_Cursornext = Cursor.next
+original_Cursor_refresh = Cursor._refresh
 
 IGNORE_COLLECTIONS = ['$cmd']
-REQUEST_REPORT = '/tmp/mongo_probe/requests'
-QUERIES_REPORT = '/tmp/mongo_probe/queries'
-
-
-def get_probe_data():
-    """
-        Get probe data from current request
-    """
-    request = get_current_request()
-    if request:
-        return request.mongodb_probe
+MAX_PACKAGE_FOLDER = os.path.dirname(os.path.abspath(__file__))
+PROBE_MODULE = os.path.splitext(os.path.abspath(__file__))[0]
+LATENCY_SAMPLES = 500
+STACK_SAMPLE_RATE = 100
+STACK_DEPTH = 10
+NO_ROUTE = '-'
 
 
 def get_originator():
     """
         Get clean traceback of which max code originated the pymongo query.
     """
-    stack = traceback.extract_stack()
     clean = []
 
-    for file, line, method, code in stack[::-1]:
-        if 'max/max' not in file:
-            continue
-        if file.endswith('mongoprobe.py'):
+    for file, line, method, code in traceback.extract_stack()[::-1]:
+        path = os.path.splitext(os.path.abspath(file))[0]
+        if not path.startswith(MAX_PACKAGE_FOLDER) or path == PROBE_MODULE:
             continue
-        module = re.search('src/max/(.*?)\.py', file).groups()[0].replace('/', '.')
+        module = 'max' + path[len(MAX_PACKAGE_FOLDER):].replace(os.sep, '.')
         if module in ['max.tweens']:
             break
-        mid = '{}.{}:{}'.format(module, method, line)
-        clean.append(mid)
-    clean = clean[::-1]
-    return clean
+        clean.append('{}.{}:{}'.format(module, method, line))
+        if len(clean) == STACK_DEPTH:
+            break
+
+    return clean[::-1]
 
 
 def format_spec(spec, normalize=False):
@@ -58,7 +64,6 @@ def format_spec(spec, normalize=False):
         and lists will be normalized to a mock 'VALUE', to be able
         to identify similar queries that only differ in particular values
     """
-    from_spec = deepcopy(spec)
     newspec = {}
 
     def _format(value):
@@ -90,104 +95,143 @@ def format_spec(spec, normalize=False):
         else:
             return _format(value)
 
-    for key, value in from_spec.items():
+    for key, value in (spec or {}).items():
         newspec[key] = format_value(value)
 
     return newspec
 
 
-def patched_Cursor__init__(self, collection, spec={}, *args, **kwargs):
+def percentile(values, percent):
     """
-        Patch for Cursor initialization.
+        Returns the value at the given percent of the sorted values
+    """
+    if not values:
+        return 0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100.0))]
+
 
-        It takes care of creating the probe entry for this cursor, that will be
-        populated on the next patch
+class QueryStats(object):
     """
-    original_Cursor__init__(self, collection, spec, *args, **kwargs)
-    if collection.name not in IGNORE_COLLECTIONS:
-        probe_data = get_probe_data()
-        if probe_data:
-            cursor_id = id(self)
-            normalized_spec = format_spec(spec, normalize=True)
-            cursor_hash = sha1(collection.name + json.dumps(normalized_spec)).hexdigest()
-
-            probe_data['cursors'][cursor_id] = {
-                'used': False,
-                'collection': collection.name,
-                'spec': normalized_spec,
-                'hash': cursor_hash,
-                'order': probe_data['cursor_count']
-            }
-            probe_data['cursor_count'] += 1
-
-
-def patched_Cursornext(self):
+        Aggregated measures of a query shape.
+
+        Latency percentiles are computed over the last LATENCY_SAMPLES queries, using
+        the time of the first roundtrip of each query, as getmores are not measured apart.
     """
-        Patch for the next iterator method of Cursor.
 
-        The first invocation of Cursor.next() is the one that fetches data from
-        mongodb, so we get the originating traceback here.
+    def __init__(self, route, collection, shape):
+        self.route = route
+        self.collection = collection
+        self.shape = shape
+        self.count = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.documents = 0
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+        self.originator = []
+
+    def add(self, elapsed, documents):
+        self.total_time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+        self.documents += documents
+
+    def info(self):
+        return {
+            'route': self.route,
+            'collection': self.collection,
+            'shape': json.loads(self.shape),
+            'count': self.count,
+            'documents': self.documents,
+            'total_time': round(self.total_time * 1000, 3),
+            'avg_time': round(self.total_time * 1000 / self.count, 3) if self.count else 0,
+            'p95_time': round(percentile(list(self.latencies), 95) * 1000, 3),
+            'max_time': round(self.max_time * 1000, 3),
+            'originator': self.originator
+        }
+
+
+class QueryProfiler(object):
     """
-    probe_data = get_probe_data()
-    if probe_data:
-        cursor_id = id(self)
-        if cursor_id in probe_data['cursors']:
-            if not probe_data['cursors'][cursor_id]['used']:
-                probe_data['cursors'][cursor_id]['used'] = True
-                probe_data['cursors'][cursor_id]['originator'] = get_originator()
-
-    data = original_Cursornext(self)
-    return data
-
-
-def mongodb_probe_factory(handler, registry):
-    def mongodb_probe_tween(request):
-        if not hasattr(request, 'mongodb_probe'):
-            request.mongodb_probe = {
-                'cursors': {},
-                'cursor_count': 0
-            }
-        response = handler(request)
-        if request.matched_route:
-            endpoint = request.matched_route.path.strip('/').replace('/', '_')
-            method = request.method
-            request_folder = '{}/{}___{}'.format(REQUEST_REPORT, endpoint, method)
-            if not os.path.exists(request_folder):
-                os.makedirs(request_folder)
-            count = len(os.listdir(request_folder))
-            request_queries = []
-            for cursorid, cursor in sorted(request.mongodb_probe.get('cursors', []).items(), key=lambda x: x[1]['order']):
-                del cursor['order']
-                del cursor['used']
-                request_queries.append(cursor)
-                if not os.path.exists(QUERIES_REPORT):
-                    os.makedirs(QUERIES_REPORT)
-                if not os.path.exists('{}/{collection}_{hash}'.format(QUERIES_REPORT, **cursor)):
-                    dumped = deepcopy(cursor)
-                    del dumped['originator']
-                    del dumped['hash']
-                    open('{}/{collection}_{hash}'.format(QUERIES_REPORT, **cursor), 'w').write(json.dumps(dumped, indent=4))
-
-            output = {
-                'queries': request_queries,
-                'request': request.url
-            }
-
-            test_name = [a[2] for a in traceback.extract_stack() if a[2].startswith('test_')]
-            if test_name:
-                output['test'] = test_name
-
-            open('{}/{}'.format(request_folder, count), 'w').write(json.dumps(output, indent=4))
-
-        return response
-    return mongodb_probe_tween
+        Process wide registry of query stats.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.started = datetime.utcnow()
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    def record(self, cursor, elapsed, documents):
+        """
+            Accounts a roundtrip to mongodb of a cursor.
+
+            The first roundtrip of a cursor counts as a new query, and the following
+            ones (getmores) are added to the time and documents of the same query.
+        """
+        stats = getattr(cursor, '_probe_stats', None)
+        if stats is not None:
+            with self.lock:
+                stats.add(elapsed, documents)
+            return
+
+        request = get_current_request()
+        route = NO_ROUTE
+        if request is not None and getattr(request, 'matched_route', None) is not None:
+            route = '{} {}'.format(request.method, request.matched_route.name)
+
+        collection = cursor.collection.name
+        shape = json.dumps(format_spec(cursor._Cursor__spec, normalize=True), sort_keys=True)
+        key = (route, collection, shape)
+
+        with self.lock:
+            stats = self.stats.get(key)
+            if stats is None:
+                stats = self.stats[key] = QueryStats(route, collection, shape)
+            stats.count += 1
+            sample_stack = stats.count % STACK_SAMPLE_RATE == 1
+            stats.add(elapsed, documents)
+            stats.latencies.append(elapsed)
+
+        if sample_stack:
+            stats.originator = get_originator()
+        cursor._probe_stats = stats
+
+    def report(self):
+        """
+            Returns the stats of all query shapes, most time consuming first
+        """
+        with self.lock:
+            stats = [query.info() for query in self.stats.values()]
+        return sorted(stats, key=lambda query: query['total_time'], reverse=True)
+
+    def reset(self):
+        with self.lock:
+            self.stats = {}
+            self.started = datetime.utcnow()
+
+
+profiler = QueryProfiler()
+
+
+def patched_Cursor_refresh(self):
+    """
+        Patch for the method of Cursor that fetches a batch of results from mongodb.
+
+        Returns the number of documents fetched, as the original method.
+    """
+    if not profiler.enabled or self.collection.name in IGNORE_COLLECTIONS:
+        return original_Cursor_refresh(self)
+
+    start = time.time()
+    documents = original_Cursor_refresh(self)
+    profiler.record(self, time.time() - start, documents)
+    return documents
 
 
 def setup(settings):
     """
-        Enable mongo probe patches and tweens
+        Enable or disable the query profiler
     """
-    if asbool(settings.get('max.enable_mongodb_probe', False)) or asbool(os.environ.get('mongoprobe', False)):
-        settings['pyramid.tweens'].insert(1, 'max.mongoprobe.mongodb_probe_factory')
-        Cursor.__init__ = patched_Cursor__init__
-        Cursor.next = patched_Cursornext
+    profiler.enabled = asbool(settings.get('max.query_profiler', True))
+    if profiler.enabled:
+        Cursor._refresh = patched_Cursor_refresh
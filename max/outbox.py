@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+"""
+    Notifications outbox
+
+    When ``max.notifications_outbox`` is enabled, rabbitmq notifications and bindings
+    are not sent during the request. Each call on the rabbitmq client is stored on the
+    ``outbox`` collection instead:
+
+        {
+            'path': 'activity.bind_user',
+            'args': ['context hash', 'username'],
+            'kwargs': {},
+            'key': 'context hash',
+            'status': 'pending',
+            'attempts': 0,
+            'next_attempt': datetime,
+            'created': datetime,
+            'owner': 'host:pid:publisher',
+            'lease': datetime
+        }
+
+    Entries are stored through the request database, so with ``max.unit_of_work``
+    enabled they're flushed together with the rest of the request writes, and
+    discarded with them if the request fails.
+
+    An ``OutboxPublisher`` drains the collection in batches, either from a thread
+    started with the application (``max.notifications_outbox_publisher = thread``) or
+    from the ``max.outbox`` script.
+
+    Entries are published in insertion order. When an entry fails, it's retried later
+    with an increasing delay, and the following entries with the same key (the context,
+    conversation or user the call refers to) wait until it's published, so the order of
+    the operations on each of them is preserved. Entries of other keys go on being
+    published meanwhile. Entries are removed once the broker has accepted them, so each
+    one is published at least once.
+
+    Publishers claim each entry before publishing it, setting its ``owner`` and a
+    ``lease`` after which other publishers can claim it, so several of them can drain
+    the same outbox. An entry claimed while an earlier one with the same key is still
+    pending is given back, and its key skipped until the next batch.
+"""
+from pyramid.settings import asbool
+
+from datetime import datetime
+from datetime import timedelta
+from functools import partial
+from pymongo import ASCENDING
+
+import logging
+import os
+import socket
+import threading
+
+logger = logging.getLogger('max')
+
+OUTBOX_COLLECTION = 'outbox'
+BATCH_SIZE = 100
+MAX_ATTEMPTS = 10
+RETRY_DELAY = 5
+PUBLISHER_INTERVAL = 1
+CLAIM_LEASE = 60
+
+
+def outbox_enabled(settings):
+    """
+        Checks if notifications go through the outbox
+    """
+    return asbool(settings.get('max_notifications_outbox', False))
+
+
+def outbox_key(path, args, kwargs):
+    """
+        Returns the key that identifies the object a client call operates on.
+
+        Sends use the first part of their routing key, as conversation notifications are
+        routed to '<conversation id>.notifications', other operations their first argument.
+    """
+    if path == 'send':
+        routing_key = kwargs.get('routing_key', args[2] if len(args) > 2 else '')
+        return routing_key.split('.')[0]
+    return args[0] if args else None
+
+
+class OutboxClient(object):
+    """
+        Stand-in of a rabbitmq client that stores the calls on the outbox
+    """
+
+    def __init__(self, database):
+        self.collection = database[OUTBOX_COLLECTION]
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return OutboxCall(self.collection, name)
+
+
+class OutboxCall(object):
+    """
+        Resolves nested attributes of the client until called
+    """
+
+    def __init__(self, collection, path):
+        self.collection = collection
+        self.path = path
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return OutboxCall(self.collection, '{}.{}'.format(self.path, name))
+
+    def __call__(self, *args, **kwargs):
+        now = datetime.utcnow()
+        self.collection.insert({
+            'path': self.path,
+            'args': list(args),
+            'kwargs': kwargs,
+            'key': outbox_key(self.path, args, kwargs),
+            'status': 'pending',
+            'attempts': 0,
+            'next_attempt': now,
+            'created': now
+        })
+
+
+class OutboxPublisher(object):
+    """
+        Publishes the calls stored on the outbox through a rabbitmq client,
+        got from connect when the first entry is published.
+    """
+
+    def __init__(self, database, connect):
+        self.collection = database[OUTBOX_COLLECTION]
+        self.connect = connect
+        self.client = None
+        self.owner = '{}:{}:{}'.format(socket.gethostname(), os.getpid(), id(self))
+
+    def invoke(self, entry):
+        if self.client is None:
+            self.client = self.connect()
+        target = self.client
+        for name in entry['path'].split('.'):
+            target = getattr(target, name)
+        target(*entry['args'], **dict([(str(key), value) for key, value in entry['kwargs'].items()]))
+
+    def claim(self, skipped_keys):
+        """
+            Claims the oldest pending entry due to be published, out of the skipped keys
+        """
+        now = datetime.utcnow()
+        return self.collection.find_and_modify(
+            query={
+                'status': 'pending',
+                'next_attempt': {'$lte': now},
+                'key': {'$nin': skipped_keys},
+                '$or': [{'lease': None}, {'lease': {'$lte': now}}]
+            },
+            update={'$set': {'owner': self.owner, 'lease': now + timedelta(seconds=CLAIM_LEASE)}},
+            sort=[('_id', ASCENDING)],
+            new=True
+        )
+
+    def unclaim(self, entry):
+        self.collection.update({'_id': entry['_id'], 'owner': self.owner}, {'$set': {'owner': None, 'lease': None}})
+
+    def drain(self, batch_size=BATCH_SIZE):
+        """
+            Publishes a batch of pending entries. Returns the number of entries published.
+        """
+        published = []
+        skipped_keys = []
+        for position in range(batch_size):
+            entry = self.claim(skipped_keys)
+            if entry is None:
+                break
+
+            # An earlier entry with the same key is waiting for a retry, or being published by someone else
+            earlier = self.collection.find_one({
+                'status': 'pending',
+                'key': entry['key'],
+                '_id': {'$lt': entry['_id'], '$nin': published}
+            }, {'_id': 1})
+            if earlier is not None:
+                self.unclaim(entry)
+                skipped_keys.append(entry['key'])
+                continue
+
+            try:
+                self.invoke(entry)
+            except Exception as exc:
+                skipped_keys.append(entry['key'])
+                self.failed(entry, exc)
+            else:
+                published.append(entry['_id'])
+
+        if published:
+            self.collection.remove({'_id': {'$in': published}})
+        return len(published)
+
+    def failed(self, entry, exc):
+        """
+            Schedules the retry of a failed entry, or marks it as failed if
+            it has been tried too many times.
+        """
+        attempts = entry['attempts'] + 1
+        update = {
+            'attempts': attempts,
+            'error': str(exc),
+            'next_attempt': datetime.utcnow() + timedelta(seconds=RETRY_DELAY * 2 ** min(attempts, 8)),
+            'owner': None,
+            'lease': None
+        }
+        if attempts >= MAX_ATTEMPTS:
+            update['status'] = 'failed'
+            logger.error('Outbox entry {} {} failed after {} attempts: {}'.format(entry['_id'], entry['path'], attempts, exc))
+        self.collection.update({'_id': entry['_id'], 'owner': self.owner}, {'$set': update})
+
+    def run(self, stop_event, interval=PUBLISHER_INTERVAL, batch_size=BATCH_SIZE):
+        """
+            Drains the outbox until stop_event is set, waiting interval seconds
+            when there's nothing left to publish.
+        """
+        while not stop_event.is_set():
+            try:
+                published = self.drain(batch_size)
+            except Exception as exc:
+                logger.error('Outbox publisher error: {}'.format(exc))
+                published = 0
+            if not published:
+                stop_event.wait(interval)
+
+
+def get_outbox_publisher(settings, database):
+    """
+        Returns a publisher to the rabbitmq broker in settings. It connects
+        to the broker when it has something to publish.
+    """
+    from max.rabbitmq import RabbitLease
+    from max.rabbitmq import get_client_properties
+    from max.rabbitmq import get_rabbit_pool
+
+    pool = get_rabbit_pool(settings.get('max_rabbitmq', ''), get_client_properties(settings))
+    return OutboxPublisher(database, partial(RabbitLease, pool))
+
+
+def start_publisher_thread(settings, database):
+    """
+        Starts a daemon thread that publishes the outbox of this process database
+    """
+    publisher = get_outbox_publisher(settings, database)
+    stop_event = threading.Event()
+    thread = threading.Thread(target=publisher.run, args=(stop_event, ), name='max-outbox-publisher')
+    thread.daemon = True
+    thread.start()
+    return thread, stop_event
+
+
+def outbox_backlog(database):
+    """
+        Returns the state of the outbox
+    """
+    collection = database[OUTBOX_COLLECTION]
+    oldest = collection.find_one({'status': 'pending'}, sort=[('_id', ASCENDING)])
+    return {
+        'pending': collection.find({'status': 'pending'}).count(),
+        'retrying': collection.find({'status': 'pending', 'attempts': {'$gt': 0}}).count(),
+        'failed': collection.find({'status': 'failed'}).count(),
+        'oldest_pending': oldest['created'].strftime('%Y/%m/%d %H:%M:%S') if oldest else None
+    }
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+    People search index
+
+    Users store a ``_search`` field with the data needed to find them by username
+    or displayName without scanning the whole collection:
+
+        {
+            'text': 'sheldon.cooper sheldon cooper coupe',
+            'words': ['coupe', 'cooper', 'sheldon', 'sheldon.cooper'],
+            'grams': ['s', 'sh', 'c', 'co', 'she', 'hel', ...]
+        }
+
+    ``text`` is the lowercased and accent folded username and displayName, ``words``
+    its distinct words, and ``grams`` has the one and two letter prefixes of each
+    word, and all the trigrams of ``text``.
+
+    Searches find people in order of relevance, a tier after the other, each one
+    sorted by username:
+
+        1. The username starts with the search, on the username index. As the
+           username index is sorted, the exact username always comes first.
+        2. Each word of the search starts a word of the user, an anchored lookup
+           on the ``words`` index.
+        3. The search is found anywhere else: all its trigrams, or the word prefix
+           for one or two letter searches, are looked up on the ``grams`` index, and
+           only the candidates found are checked against ``text``.
+
+    The field is computed when users are inserted or saved, and by the rebuild
+    users maintenance job for existing users. Until then, users without it are
+    found by a regex on their username and displayName on the last tier. Those
+    are looked up on the ``grams`` index too, as users without grams, so once all
+    users have the field the fallback costs nothing.
+"""
+from max.exceptions import InvalidSearchParams
+from max.utils.cursors import encode_cursor
+from max.utils.cursors import keyset_condition
+from max.utils.cursors import sort_key_values
+
+from pymongo import ASCENDING
+
+import re
+import unicodedata
+
+SEARCH_FIELD = '_search'
+WORD_SEPARATORS = re.compile(r'[\W_]+', re.UNICODE)
+
+
+def fold(text):
+    """
+        Lowercases a text and removes its accents
+    """
+    if not isinstance(text, unicode):
+        text = text.decode('utf-8')
+    decomposed = unicodedata.normalize('NFKD', text.lower())
+    return u''.join([char for char in decomposed if not unicodedata.combining(char)])
+
+
+def words(text):
+    return [word for word in WORD_SEPARATORS.split(text) if word]
+
+
+def trigrams(text):
+    return set([text[index:index + 3] for index in range(len(text) - 2)])
+
+
+def search_field(user):
+    """
+        Returns the search field of a user
+    """
+    username = fold(user.get('username', ''))
+    display_name = fold(user.get('displayName', '') or '')
+    text = u' '.join([username] + words(username) + [display_name]).strip()
+
+    grams = set()
+    for word in words(text):
+        grams.update([word[:1], word[:2]])
+    grams.update(trigrams(text))
+    return {'text': text, 'words': sorted(set(text.split() + words(text))), 'grams': sorted(grams)}
+
+
+def username_prefix_query(search):
+    """
+        Returns the query conditions to find the users whose username starts with a search
+    """
+    return {'username': {'$regex': '^' + re.escape(search.strip().lower())}}
+
+
+def word_prefix_query(search):
+    """
+        Returns the query conditions to find the users with a word starting
+        with each word of a search
+    """
+    folded = fold(search).strip()
+    prefixes = [re.compile('^' + re.escape(word)) for word in words(folded) or [folded]]
+    return {'{}.words'.format(SEARCH_FIELD): {'$all': prefixes}}
+
+
+def search_query(search):
+    """
+        Returns the query conditions to find the users matching a search anywhere
+    """
+    folded = fold(search).strip()
+    if not folded:
+        return {}
+    grams = sorted(trigrams(folded)) if len(folded) > 2 else [folded]
+    unindexed_search = re.escape(search.strip())
+    return {'$or': [
+        {
+            '{}.grams'.format(SEARCH_FIELD): {'$all': grams},
+            '{}.text'.format(SEARCH_FIELD): {'$regex': re.escape(folded)}
+        },
+        {
+            '{}.grams'.format(SEARCH_FIELD): None,
+            '$or': [
+                {'username': {'$regex': unindexed_search, '$options': 'i'}},
+                {'displayName': {'$regex': unindexed_search, '$options': 'i'}}
+            ]
+        }
+    ]}
+
+
+def search_tiers(search):
+    """
+        Returns the query conditions of each relevance tier of a search,
+        excluding the users found on the previous ones.
+    """
+    username_prefix = username_prefix_query(search)
+    word_prefix = word_prefix_query(search)
+    anywhere = search_query(search)
+    return [
+        username_prefix,
+        {'$and': [word_prefix], '$nor': [username_prefix]},
+        {'$and': [anywhere], '$nor': [username_prefix, word_prefix]}
+    ]
+
+
+class SearchResults(list):
+    """
+        A page of people found, with the flag and the cursor to get the next one
+    """
+    remaining = False
+    continuation = None
+
+
+def search_people(users, query, search, cursor=None, limit=None, **kwargs):
+    """
+        Searches the users matching a query and a search, the most relevant first.
+
+        Tiers are queried in order until the page is full. Pages are keyset paginated,
+        the continuation cursor has the tier and the username of the last user of the
+        page, or no username if the next page starts on the next tier.
+    """
+    sort_params = [('username', ASCENDING)]
+    tiers = search_tiers(search)
+
+    first, last = 0, None
+    if cursor is not None:
+        if len(cursor) != 2 or cursor[0] not in range(len(tiers)):
+            raise InvalidSearchParams('cursor does not match the requested search')
+        first, last = cursor
+
+    results = SearchResults()
+    for tier in range(first, len(tiers)):
+        conditions = [query, tiers[tier]]
+        if tier == first and last is not None:
+            conditions.append(keyset_condition(sort_params, [last]))
+        tier_query = {'$and': conditions}
+
+        # Once the page is full, only check if there's anyone else on the next tiers
+        if limit and len(results) == limit:
+            if users.collection.find_one(tier_query, {'_id': 1}) is not None:
+                results.remaining = True
+                results.continuation = encode_cursor([tier, None])
+                break
+            continue
+
+        found = users.search(
+            tier_query,
+            sort_params=sort_params,
+            limit=limit - len(results) if limit else None,
+            **kwargs)
+        results.extend(found)
+        if found.remaining:
+            results.remaining = True
+            results.continuation = encode_cursor([tier] + sort_key_values(found.last, sort_params))
+            break
+
+    return results
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+    Query plans capture
+
+    When ``max.explain_queries`` is enabled, the first time a query with a new shape
+    is executed on a route by ``MADMaxCollection.search`` or ``wrapped_find_one``, it is
+    explained, and the winning plan is stored along with the keys and documents examined
+    to return the results.
+
+    A plan is flagged when it scans the whole collection, or when the number of documents
+    examined is too high compared with the ones returned. Flagged plans are logged as
+    warnings, and all plans are available grouped by route on
+    ``/admin/maintenance/queries/plans``.
+
+    Both the legacy explain format (mongodb < 3.0) and the queryPlanner / executionStats
+    format are understood.
+"""
+from max import maxlogger
+from max.mongoprobe import format_spec
+
+from pyramid.settings import asbool
+from pyramid.threadlocal import get_current_request
+
+from datetime import datetime
+
+import json
+import threading
+
+EXAMINED_RATIO_THRESHOLD = 10
+MIN_DOCS_EXAMINED = 100
+NO_ROUTE = '-'
+
+
+def explain_enabled(request):
+    """
+        Checks if query plans capture is enabled on settings
+    """
+    registry = getattr(request, 'registry', None)
+    settings = getattr(registry, 'max_settings', {})
+    return asbool(settings.get('max_explain_queries', False))
+
+
+def plan_stages(plan):
+    """
+        Returns the names of all stages of a queryPlanner plan tree
+    """
+    stages = [plan.get('stage')]
+    children = plan.get('inputStages', [])
+    if 'inputStage' in plan:
+        children = children + [plan['inputStage']]
+    for child in children + plan.get('shards', []):
+        stages.extend(plan_stages(child.get('winningPlan', child)))
+    return [stage for stage in stages if stage]
+
+
+def parse_explain(explain):
+    """
+        Extracts the winning plan and examined counters of an explain() output
+    """
+    if 'queryPlanner' in explain:
+        winning_plan = explain['queryPlanner'].get('winningPlan', {})
+        stats = explain.get('executionStats', {})
+        stages = plan_stages(winning_plan)
+        return {
+            'winning_plan': ' > '.join(reversed(stages)),
+            'collection_scan': 'COLLSCAN' in stages,
+            'keys_examined': stats.get('totalKeysExamined', 0),
+            'docs_examined': stats.get('totalDocsExamined', 0),
+            'returned': stats.get('nReturned', 0)
+        }
+
+    # Legacy explain output, with a clause for each branch of $or queries
+    clauses = explain.get('clauses', [explain])
+    cursors = [clause.get('cursor', '') for clause in clauses]
+    return {
+        'winning_plan': ', '.join(cursors),
+        'collection_scan': True in [cursor.startswith('BasicCursor') for cursor in cursors],
+        'keys_examined': explain.get('nscanned', 0),
+        'docs_examined': explain.get('nscannedObjects', 0),
+        'returned': explain.get('n', 0)
+    }
+
+
+class QueryPlans(object):
+    """
+        Process wide registry of the plans of the query shapes seen on each route
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.plans = {}
+
+    def capture(self, request, cursor):
+        """
+            Explains the query of a not yet executed cursor, if its shape hasn't
+            been explained before on the current route.
+        """
+        request = request if request is not None else get_current_request()
+        if not explain_enabled(request):
+            return
+
+        route, method = NO_ROUTE, None
+        if getattr(request, 'matched_route', None) is not None:
+            route, method = request.matched_route.name, request.method
+
+        collection = cursor.collection.name
+        ordering = cursor._Cursor__ordering
+        shape = json.dumps({
+            'query': format_spec(cursor._Cursor__spec, normalize=True),
+            'sort': list(ordering.items()) if ordering else []
+        }, sort_keys=True)
+        key = (route, collection, shape)
+
+        with self.lock:
+            if key in self.plans:
+                return
+            # Reserve the shape so concurrent requests don't explain it again
+            self.plans[key] = None
+
+        plan = {
+            'route': route,
+            'method': method,
+            'collection': collection,
+            'shape': json.loads(shape),
+            'date': datetime.utcnow().strftime('%Y/%m/%d %H:%M:%S')
+        }
+        try:
+            plan.update(parse_explain(cursor.explain()))
+        except Exception as exc:
+            plan['error'] = str(exc)
+        else:
+            ratio = plan['docs_examined'] / float(max(plan['returned'], 1))
+            plan['examined_ratio'] = round(ratio, 2)
+            plan['bad_ratio'] = ratio > EXAMINED_RATIO_THRESHOLD and plan['docs_examined'] >= MIN_DOCS_EXAMINED
+            plan['flagged'] = plan['collection_scan'] or plan['bad_ratio']
+            if plan['flagged']:
+                maxlogger.warning('Unindexed query on {} {} ({}): {} {}'.format(
+                    method, route, plan['winning_plan'], collection, json.dumps(plan['shape']['query'])))
+
+        with self.lock:
+            self.plans[key] = plan
+
+    def by_route(self):
+        """
+            Returns the captured plans grouped by route name, flagged ones first
+        """
+        grouped = {}
+        with self.lock:
+            plans = [plan for plan in self.plans.values() if plan is not None]
+        for plan in plans:
+            grouped.setdefault(plan['route'], []).append(plan)
+        for route_plans in grouped.values():
+            route_plans.sort(key=lambda plan: (not plan.get('flagged', False), plan['collection']))
+        return grouped
+
+    def reset(self):
+        with self.lock:
+            self.plans = {}
+
+
+query_plans = QueryPlans()
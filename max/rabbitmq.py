@@ -1,15 +1,31 @@
 # -*- coding: utf-8 -*-
 from max.exceptions import ConnectionError
+from max.outbox import OutboxClient
+from max.outbox import outbox_enabled
 from max.resources import getMAXSettings
 
 from maxcarrot import RabbitClient
 from maxcarrot import RabbitMessage
+from pika.exceptions import AMQPChannelError
+from pika.exceptions import AMQPConnectionError
 from socket import error as socket_error
 
+from collections import deque
+
 import datetime
 import json
 import pkg_resources
+import re
 import sys
+import threading
+import time
+
+CONNECTION_ERRORS = (socket_error, IOError, AMQPConnectionError, AMQPChannelError)
+MAX_IDLE_CLIENTS = 10
+PUBLISH_RATE_WINDOW = 60
+
+pools = {}
+pools_lock = threading.Lock()
 
 
 def noop(*args, **kwargs):
@@ -20,6 +36,226 @@ def noop(*args, **kwargs):
     pass
 
 
+class RabbitPool(object):
+    """
+        Process wide pool of rabbitmq clients connected to the same broker.
+
+        Clients are leased to requests (so to greenlets under gevent) and given back
+        to the pool when the request finishes, so their connection and channel are
+        reused by the next requests. Up to MAX_IDLE_CLIENTS are kept open.
+    """
+
+    def __init__(self, url, client_properties):
+        self.url = url
+        self.client_properties = client_properties
+        self.lock = threading.Lock()
+        self.idle = []
+        self.started = time.time()
+        self.connections = 0
+        self.leased = 0
+        self.reconnects = 0
+        self.publishes = 0
+        self.recent_publishes = deque(maxlen=10000)
+
+    def connect(self):
+        """
+            Opens a new client connection. Raises AttributeError if the broker
+            url is not defined, as RabbitClient does.
+        """
+        client = RabbitClient(self.url, client_properties=self.client_properties)
+        with self.lock:
+            self.connections += 1
+        return client
+
+    def acquire(self):
+        """
+            Returns an idle client, or a new one if there's none
+        """
+        with self.lock:
+            client = self.idle.pop() if self.idle else None
+            self.leased += 1
+        try:
+            return client if client is not None else self.connect()
+        except:
+            with self.lock:
+                self.leased -= 1
+            raise
+
+    def release(self, client):
+        """
+            Gives back a client to the pool
+        """
+        with self.lock:
+            self.leased -= 1
+            if len(self.idle) < MAX_IDLE_CLIENTS:
+                self.idle.append(client)
+                return
+        self.close(client)
+
+    def discard(self, client):
+        """
+            Closes a leased client whose connection is not usable anymore
+        """
+        with self.lock:
+            self.leased -= 1
+        self.close(client)
+
+    def close(self, client):
+        with self.lock:
+            self.connections -= 1
+        try:
+            client.disconnect()
+        except:
+            pass
+
+    def record_publish(self):
+        now = time.time()
+        with self.lock:
+            self.publishes += 1
+            self.recent_publishes.append(now)
+
+    def metrics(self):
+        """
+            Returns the pool usage counters
+        """
+        now = time.time()
+        with self.lock:
+            recent = len([published for published in self.recent_publishes if published > now - PUBLISH_RATE_WINDOW])
+            window = min(PUBLISH_RATE_WINDOW, max(now - self.started, 1))
+            return {
+                'url': re.sub(r'//[^@/]*@', '//', self.url),
+                'connections': self.connections,
+                'leased': self.leased,
+                'idle': len(self.idle),
+                'reconnects': self.reconnects,
+                'publishes': self.publishes,
+                'publishes_per_second': round(recent / float(window), 2)
+            }
+
+
+def get_client_properties(settings):
+    """
+        Returns the properties max identifies itself with on rabbitmq connections
+    """
+    return {
+        "product": "max",
+        "version": pkg_resources.require('max')[0].version,
+        "platform": 'Python {0.major}.{0.minor}.{0.micro}'.format(sys.version_info),
+        "server": settings.get('max_server', '')
+    }
+
+
+def get_rabbit_pools_metrics():
+    """
+        Returns the usage counters of all pools of this process
+    """
+    with pools_lock:
+        current_pools = [pool for url, pool in sorted(pools.items()) if url]
+    return [pool.metrics() for pool in current_pools]
+
+
+def get_rabbit_pool(url, client_properties):
+    """
+        Returns the pool of clients of a broker, creating it if needed
+    """
+    with pools_lock:
+        if url not in pools:
+            pools[url] = RabbitPool(url, client_properties)
+        return pools[url]
+
+
+class RabbitLease(object):
+    """
+        A client leased from the pool for the lifetime of a request.
+
+        Calls on the client (i.e. lease.send(), lease.activity.bind_user()) go
+        through the lease, and are retried once with a new connection if they
+        fail because the connection was lost.
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.client = pool.acquire()
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return RabbitLeaseCall(self, (name, ))
+
+    def call(self, path, args, kwargs):
+        try:
+            return self.invoke(path, args, kwargs)
+        except CONNECTION_ERRORS:
+            self.reconnect()
+            try:
+                return self.invoke(path, args, kwargs)
+            except CONNECTION_ERRORS:
+                self.reconnect()
+                raise ConnectionError("Could not connect to rabbitmq broker")
+
+    def invoke(self, path, args, kwargs):
+        if self.client is None:
+            self.reconnect()
+        target = self.client
+        for name in path:
+            target = getattr(target, name)
+        result = target(*args, **kwargs)
+        if path == ('send', ):
+            self.pool.record_publish()
+        return result
+
+    def reconnect(self):
+        """
+            Replaces the current client by a new connection. Idle clients of the
+            pool are not reused, as they're likely broken too.
+        """
+        if self.client is not None:
+            self.pool.discard(self.client)
+            self.client = None
+        try:
+            client = self.pool.connect()
+        except CONNECTION_ERRORS:
+            raise ConnectionError("Could not connect to rabbitmq broker")
+        with self.pool.lock:
+            self.pool.reconnects += 1
+            self.pool.leased += 1
+        self.client = client
+
+    def release(self, request=None):
+        if self.client is not None:
+            self.pool.release(self.client)
+            self.client = None
+
+
+class RabbitLeaseCall(object):
+    """
+        Resolves nested attributes of a leased client until called
+    """
+
+    def __init__(self, lease, path):
+        self.lease = lease
+        self.path = path
+
+    def __getattr__(self, name):
+        return RabbitLeaseCall(self.lease, self.path + (name, ))
+
+    def __call__(self, *args, **kwargs):
+        return self.lease.call(self.path, args, kwargs)
+
+
+def get_request_rabbit_client(request, pool):
+    """
+        Returns the client leased to the request, leasing one on first use.
+        The client is given back to the pool when the request finishes.
+    """
+    lease = getattr(request, 'rabbit_lease', None)
+    if lease is None or lease.client is None:
+        lease = RabbitLease(pool)
+        request.rabbit_lease = lease
+        request.add_finished_callback(lease.release)
+    return lease
+
+
 class RabbitNotifications(object):
     """
         Wrapper to access notification methods, and catch possible exceptions
@@ -32,18 +268,19 @@ class RabbitNotifications(object):
         self.message_defaults = settings.get('max_message_defaults', {})
         self.enabled = True
 
-        client_properties = {
-            "product": "max",
-            "version": pkg_resources.require('max')[0].version,
-            "platform": 'Python {0.major}.{0.minor}.{0.micro}'.format(sys.version_info),
-            "server": settings.get('max_server', '')
-        }
+        if outbox_enabled(settings):
+            # Calls are stored and published later by the outbox publisher. They're
+            # stored through the request database, so they're queued and flushed with
+            # the rest of the request writes if the unit of work is enabled
+            self.client = OutboxClient(request.db.db)
+            self.enabled = bool(self.url)
+            return
 
         try:
-            self.client = RabbitClient(self.url, client_properties=client_properties)
+            self.client = get_request_rabbit_client(request, get_rabbit_pool(self.url, get_client_properties(settings)))
         except AttributeError:
             self.enabled = False
-        except socket_error:
+        except CONNECTION_ERRORS:
             raise ConnectionError("Could not connect to rabbitmq broker")
 
     def __getattribute__(self, name):
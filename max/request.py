@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+from max.MADMax import ItemWrapper
 from max.MADMax import MADMaxDB
 from max.exceptions import Unauthorized
 from max.exceptions import UnknownUserError
@@ -173,8 +174,7 @@ def get_request_actor(request):
     if context_actor_url:
         try:
             url_hash = sha1(context_actor_url).hexdigest()
-            mmdb = request.db
-            actor = mmdb.contexts.getItemsByhash(url_hash).next()
+            actor = ItemWrapper(request.db.contexts.load('hash', url_hash), request, 'contexts')
             actor.setdefault('displayName', '')
             return actor
         except:
@@ -182,8 +182,7 @@ def get_request_actor(request):
 
     username = get_request_actor_username(request)
     try:
-        mmdb = request.db
-        actor = mmdb.users.getItemsByusername(username).next()
+        actor = ItemWrapper(request.db.users.load('username', username), request, 'users')
         actor.setdefault('displayName', actor['username'])
         return actor
     except:
@@ -201,14 +200,20 @@ def get_request_creator(request):
     """
     username = get_username_in_oauth(request)
     try:
-        mmdb = request.db
-        actor = mmdb.users.getItemsByusername(username).next()
+        actor = ItemWrapper(request.db.users.load('username', username), request, 'users')
         actor.setdefault('displayName', actor['username'])
         return actor
     except:
         return None
 
 
+def get_field_permissions_cache(request):
+    """
+        Returns the cache of the fields permissions of model objects on this request
+    """
+    return {}
+
+
 def get_database(request):
     """
         Returns the global database object
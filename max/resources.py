@@ -1,7 +1,13 @@
 # -*- coding: utf-8 -*-
+from max import GEVENT_AVAILABLE
 from max import maxlogger
 from max.MADMax import MADMaxCollection
+from max.MADMax import MADMaxDB
+from max.utils.cache import VERSION_POLL_INTERVAL
+from max.utils.cache import VersionTracker
+from maxutils import mongodb
 from pyramid.security import Allow, Authenticated
+from pyramid.settings import asbool
 from max.exceptions import ObjectNotFound, UnknownUserError
 from max.security import Manager, Owner, is_self_operation
 from max.security import permissions
@@ -69,7 +75,7 @@ class Root(dict):
 
 
 def get_security_object(root, request):
-    security_settings = request.registry.max_security
+    security_settings = get_max_security(request.registry)
     security_settings.__parent__ = root
     security_settings.request = request
     return security_settings
@@ -83,7 +89,7 @@ class MongoDBTraverser(MADMaxCollection):
     def __init__(self, parent, request):
         self.request = request
         self.__parent__ = parent
-        self.collection = self.request.registry.max_store[self.collection_name]
+        self.collection = self.request.db.db[self.collection_name]
         self.show_fields = None
 
 
@@ -111,6 +117,8 @@ class CommentsTraverser(object):
         from max.ASObjects import Comment
         if self.activity:
             comment = self.activity.get_comment(commentid)
+            if not comment:
+                raise ObjectNotFound('Activity {} has no comment with id {}'.format(self.activity['_id'], commentid))
             comment_object = Comment(self.request, comment, creating=False)
             comment_object.__parent__ = self
             return comment_object
@@ -267,6 +275,28 @@ def loadMAXSettings(settings):
     return max_ini_settings
 
 
+def loadMAXStore(settings):
+    """
+        Opens the mongodb connection configured in settings and
+        returns the max database
+    """
+    cluster_enabled = asbool(settings.get('mongodb.cluster', False))
+    auth_enabled = asbool(settings.get('mongodb.auth', False))
+    mongodb_uri = settings.get('mongodb.hosts') if cluster_enabled else settings['mongodb.url']
+
+    conn = mongodb.get_connection(
+        mongodb_uri,
+        use_greenlets=GEVENT_AVAILABLE,
+        cluster=settings.get('mongodb.replica_set', None))
+    db = mongodb.get_database(
+        conn,
+        settings['mongodb.db_name'],
+        username=settings.get('mongodb.username', None) if auth_enabled else None,
+        password=settings.get('mongodb.password', None) if auth_enabled else None,
+        authdb=settings.get('mongodb.authdb', None) if auth_enabled else None)
+    return db
+
+
 def loadCloudAPISettings(registry):
     cloudapis_settings = registry.max_store.cloudapis.find_one()
     if cloudapis_settings:
@@ -279,9 +309,55 @@ def loadCloudAPISettings(registry):
 def loadMAXSecurity(registry):
     from max.models import Security
     from collections import namedtuple
-    Request = namedtuple('Request', ['db'])
+    Request = namedtuple('Request', ['db', 'registry'])
     security_settings = [a for a in registry.max_store.security.find({})]
     if security_settings:
-        return Security.from_object(Request(registry.max_store), security_settings[0])
+        return Security.from_object(Request(MADMaxDB(None, registry.max_store), registry), security_settings[0])
     else:
         maxlogger.info("No security info found. Please run initialization database script.")  # pragma: no cover
+
+
+class SecurityRefresher(object):
+    """
+        Keeps the security settings of a registry up to date with the changes
+        made by other processes.
+
+        Saving the security settings bumps the ``security`` version on the
+        ``cache_versions`` collection. Each process checks that version at most
+        every ``max.security_refresh_interval`` seconds (5 by default), when
+        resolving the roles of a request, and reloads the settings if it changed.
+    """
+
+    def __init__(self, registry, interval=VERSION_POLL_INTERVAL):
+        self.registry = registry
+        self.tracker = VersionTracker('security', interval)
+        self.version = self.tracker.current(registry.max_store)
+
+    def refresh(self):
+        version = self.tracker.current(self.registry.max_store)
+        if version != self.version:
+            self.registry.max_security = loadMAXSecurity(self.registry)
+            self.version = version
+
+    def reset(self):
+        """
+            Forces a reload of the settings on the next refresh
+        """
+        self.tracker.reset()
+        self.version = None
+
+    def saved(self):
+        """
+            Notifies the other processes of a change made on this one
+        """
+        self.version = self.tracker.bump(self.registry.max_store)
+
+
+def get_max_security(registry):
+    """
+        Returns the security settings of the registry, reloaded if changed by another process
+    """
+    refresher = getattr(registry, 'max_security_refresher', None)
+    if refresher is not None:
+        refresher.refresh()
+    return registry.max_security
@@ -101,9 +101,15 @@ class JSONResourceRoot(object):
         else:
             response_payload = json.dumps(self.data, cls=IterEncoder)
 
-        if self.remaining:
+        # Results wrappers know if there are remaining items once serialized
+        if self.remaining or getattr(self.data, 'remaining', False):
             self.headers['X-Has-Remaining-Items'] = '1'
 
+        # Keyset paginated results provide the cursor to the next page
+        continuation = getattr(self.data, 'continuation', None)
+        if continuation:
+            self.headers['X-Continuation-Cursor'] = continuation
+
         data = response_payload is None and self.data or response_payload
         response = Response(data, status_int=self.status_code)
         response.content_type = self.response_content_type
@@ -1,4 +1,9 @@
 # -*- coding: utf-8 -*-
+from max.contextcache import get_context_cache
+from max.idempotency import activity_key
+from max.idempotency import claim_activity_key
+from max.idempotency import complete_activity_key
+from max.idempotency import release_activity_key
 from max.models import Activity
 from max.rest import JSONResourceEntity
 from max.rest import JSONResourceRoot
@@ -18,7 +23,6 @@ from pyramid.security import ACLAllowed
 
 from base64 import b64encode
 from bson import ObjectId
-from datetime import timedelta
 
 import re
 
@@ -73,8 +77,12 @@ def visible_user_activities_query(user, request, filter_non_shared=True):
 
     # Prepare query to search for all non_shared context public activity
     if non_shared_contexts:
-        public_contexts = request.db.contexts.search({'permissions.write': 'public'}, flatten=1)
-        public_contexts_hashes = [a['hash'] for a in public_contexts]
+        context_cache = get_context_cache(request)
+        if context_cache is not None:
+            public_contexts_hashes = context_cache.public_contexts(request.registry.max_store, 'write').keys()
+        else:
+            public_contexts = request.db.contexts.search({'permissions.write': 'public'}, flatten=1)
+            public_contexts_hashes = [a['hash'] for a in public_contexts]
         if public_contexts_hashes:
             non_shared_contexts_activity_query.update(common_query)
             non_shared_contexts_activity_query['contexts.hash'] = {'$in': public_contexts_hashes}
@@ -169,9 +177,14 @@ def getContextActivities(context, request):
                 readable_contexts_urls.append(subscription['url'])
 
         # We'll include also all contexts that are public whitin the url
-        public_query = {'permissions.read': 'public', 'url': url_regex}
-        for result in request.db.contexts.search(public_query, show_fields=['url']):
-            readable_contexts_urls.append(result['url'])
+        context_cache = get_context_cache(request)
+        if context_cache is not None:
+            public_urls = context_cache.public_contexts(request.registry.max_store, 'read').values()
+            readable_contexts_urls.extend([public_url for public_url in public_urls if public_url.startswith(url)])
+        else:
+            public_query = {'permissions.read': 'public', 'url': url_regex}
+            for result in request.db.contexts.search(public_query, show_fields=['url']):
+                readable_contexts_urls.append(result['url'])
 
     # if any url collected, include it on the query
     if readable_contexts_urls:
@@ -187,6 +200,40 @@ def getContextActivities(context, request):
     return handler.buildResponse()
 
 
+def insert_activity(request, newactivity, scope):
+    """
+        Inserts a new activity, unless it's a retry of an already posted one, as told
+        by its idempotency key. ``scope`` is where the activity is posted, or None
+        if it's only deduplicated by the Idempotency-Key header.
+
+        Returns the inserted or the already posted activity, and the status code.
+    """
+    newactivity['_id'] = ObjectId()
+    key, ttl = activity_key(request, newactivity, scope)
+    if key is not None:
+        duplicated = claim_activity_key(request, key, ttl, newactivity['_id'])
+        if duplicated is not None:
+            return duplicated, 200
+
+    try:
+        if newactivity['object']['objectType'] == u'image' or \
+           newactivity['object']['objectType'] == u'file':
+            # Extract the file before saving object
+            activity_file = newactivity.extract_file_from_activity()
+            newactivity.process_file(request, activity_file)
+        newactivity.insert()
+        if key is not None:
+            # Retries of the activity must find it once they find its key completed
+            request.db.flush()
+            complete_activity_key(request, key, newactivity['_id'])
+    except Exception:
+        if key is not None:
+            release_activity_key(request, key, newactivity['_id'])
+        raise
+
+    return newactivity, 201
+
+
 @endpoint(route_name='context_activities', request_method='POST', permission=add_activity)
 def addContextActivity(context, request):
     """
@@ -204,44 +251,7 @@ def addContextActivity(context, request):
     }
     # Initialize a Activity object from the request
     newactivity = Activity.from_request(request, rest_params=rest_params)
-
-    # Search if there's any activity from the same user with
-    # the same actor in the last minute
-
-    actor_id_key = 'actor.{}'.format(request.actor.unique)
-    actor_id_value = request.actor.get(request.actor.unique)
-
-    query = {
-        actor_id_key: actor_id_value,
-        'published': {'$gt': newactivity['published'] - timedelta(minutes=1)},
-        'contexts.hash': context['hash'],
-        'verb': 'post'
-    }
-
-    possible_duplicates = request.db.activity.search(query)
-    duplicated = False
-    for candidate in possible_duplicates:
-        if candidate['object']['content'] == newactivity['object'].get('content', ''):
-            duplicated = candidate
-            break
-
-    if duplicated:
-        code = 200
-        newactivity = duplicated
-    else:
-        # New activity
-        code = 201
-        if newactivity['object']['objectType'] == u'image' or \
-           newactivity['object']['objectType'] == u'file':
-            # Extract the file before saving object
-            activity_file = newactivity.extract_file_from_activity()
-            activity_oid = newactivity.insert()
-            newactivity['_id'] = ObjectId(activity_oid)
-            newactivity.process_file(request, activity_file)
-            newactivity.save()
-        else:
-            activity_oid = newactivity.insert()
-            newactivity['_id'] = ObjectId(activity_oid)
+    newactivity, code = insert_activity(request, newactivity, context['hash'])
 
     handler = JSONResourceEntity(request, newactivity.flatten(squash=['keywords']), status_code=code)
     return handler.buildResponse()
@@ -263,39 +273,9 @@ def addUserActivity(user, request):
     # Initialize a Activity object from the request
     newactivity = Activity.from_request(request, rest_params=rest_params)
 
-    # Search if there's any activity from the same user with
-    # the same actor and without context
-    query = {
-        'actor.username': request.actor['username'],
-        'published': {'$gt': newactivity['published'] - timedelta(minutes=1)},
-        'contexts': {'$exists': False},
-        'verb': 'post'
-    }
-
-    possible_duplicates = request.db.activity.search(query)
-    duplicated = None
-    for candidate in possible_duplicates:
-        if candidate['object']['content'] == newactivity['object'].get('content', ''):
-            duplicated = candidate
-            break
-
-    if duplicated:
-        code = 200
-        newactivity = duplicated
-    else:
-        # New activity
-        code = 201
-        if newactivity['object']['objectType'] == u'image' or \
-           newactivity['object']['objectType'] == u'file':
-            # Extract the file before saving object
-            activity_file = newactivity.extract_file_from_activity()
-            activity_oid = newactivity.insert()
-            newactivity['_id'] = ObjectId(activity_oid)
-            newactivity.process_file(request, activity_file)
-            newactivity.save()
-        else:
-            activity_oid = newactivity.insert()
-            newactivity['_id'] = activity_oid
+    # Activities posted on contexts from here are not deduplicated by content
+    scope = None if newactivity.get('contexts') else 'timeline'
+    newactivity, code = insert_activity(request, newactivity, scope)
 
     handler = JSONResourceEntity(request, newactivity.flatten(squash=['keywords']), status_code=code)
     return handler.buildResponse()
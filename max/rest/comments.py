@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 from max.models import Activity
+from max.models.activity import comment_from_activity
 from max.rest import JSONResourceEntity
 from max.rest import JSONResourceRoot
 from max.rest import endpoint
@@ -11,6 +12,8 @@ from max.security.permissions import list_comments
 
 from pyramid.httpexceptions import HTTPNoContent
 
+from pymongo import DESCENDING
+
 
 @endpoint(route_name='user_comments', request_method='GET', permission=list_comments)
 def getUserComments(user, request):
@@ -43,12 +46,19 @@ def getActivityComments(activity, request):
     """
         Get activity comments
 
-        Return the comments for an activity.
+        Return the comments for an activity, paged from the newest ones
+        with limit and before, and sorted from older to newer in each page.
     """
-    replies = activity.get('replies', {})
-    items = replies
-    result = flatten(items, keep_private_fields=False)
-    handler = JSONResourceRoot(request, result)
+    query = {
+        'verb': 'comment',
+        'object.inReplyTo._id': activity['_id']
+    }
+
+    # Sorting by _id, as id is indeed the same as published
+    comment_activities = request.db.activity.search(query, sort_direction=DESCENDING, sort_by_field="_id", keep_private_fields=False, **searchParams(request))
+    comments = activity.mark_deletable_comments([comment_from_activity(comment) for comment in comment_activities])
+    result = flatten(comments, reverse=True, keep_private_fields=False)
+    handler = JSONResourceRoot(request, result, remaining=comment_activities.remaining)
     return handler.buildResponse()
 
 
@@ -112,12 +122,7 @@ def addActivityComment(activity, request):
     newactivity_oid = newactivity.insert()
     newactivity['_id'] = newactivity_oid
 
-    comment = dict(newactivity['object'])
-    comment['published'] = newactivity['published']
-    comment['actor'] = request.actor
-    comment['id'] = newactivity['_id']
-    del comment['inReplyTo']
-    activity.addComment(comment)
+    activity.addComment(comment_from_activity(newactivity, actor=request.actor))
 
     handler = JSONResourceEntity(request, newactivity.flatten(), status_code=code)
     return handler.buildResponse()
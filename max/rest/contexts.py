@@ -1,12 +1,17 @@
 # -*- coding: utf-8 -*-
 from max import AUTHORS_SEARCH_MAX_QUERIES_LIMIT
 from max import LAST_AUTHORS_LIMIT
+from max.MADMax import MADMaxCollection
 from max.exceptions import ObjectNotFound
 from max.exceptions import ValidationError
+from max.jobs import JobStep
+from max.jobs import dispatch_job
+from max.jobs import register_job
 from max.models import Context
 from max.rest import JSONResourceEntity
 from max.rest import JSONResourceRoot
 from max.rest import endpoint
+from max.rest.jobs import job_accepted
 from max.rest.sorting import sorted_query
 from max.utils.dicts import flatten
 from max.utils import searchParams
@@ -66,6 +71,55 @@ def getContext(context, request):
     return handler.buildResponse()
 
 
+def propagate_context_changes(request, item, params):
+    """
+        Updates the subscriptions and activities of a context with its changes.
+
+        If the changed fields are not known, all fields are propagated. Otherwise
+        the context gets its changed fields and their previous values restored,
+        so only those fields are propagated, as when done just after the change.
+    """
+    context = MADMaxCollection(request, 'contexts', query_key='hash')[params['hash']]
+    if params.get('fields') is None:
+        context.updateContextActivities(force_update=True)
+        context.updateUsersSubscriptions(force_update=True)
+    else:
+        context.data = dict.fromkeys(params['fields'])
+        context.old.update(params['old'])
+        context.updateUsersSubscriptions()
+        context.updateContextActivities()
+
+
+def remove_context(request, item, params):
+    context = MADMaxCollection(request, 'contexts', query_key='hash')[params['hash']]
+    context.removeUserSubscriptions()
+    context.removeActivities(logical=True)
+    context.delete()
+
+
+register_job('propagate_context', [
+    JobStep(None, None, propagate_context_changes)
+])
+
+register_job('delete_context', [
+    JobStep(None, None, remove_context)
+])
+
+
+def dispatch_context_propagation(request, context, properties=None):
+    """
+        Dispatches the propagation of the changes of a context. Changes to all fields
+        are propagated unless the modified properties are given.
+    """
+    params = {'hash': context['hash'], 'fields': None}
+    if properties is not None:
+        fields = [field for field in properties if context.field_changed(field)]
+        old_fields = fields + ['hash'] if 'url' in fields else fields
+        params['fields'] = fields
+        params['old'] = dict([(field, context.old.get(field)) for field in old_fields])
+    return dispatch_job(request, 'propagate_context', params)
+
+
 @endpoint(route_name='context', request_method='PUT', permission=modify_context)
 def ModifyContext(context, request):
     """
@@ -73,8 +127,10 @@ def ModifyContext(context, request):
     """
     properties = context.getMutablePropertiesFromRequest(request)
     context.modifyContext(properties)
-    context.updateUsersSubscriptions()
-    context.updateContextActivities()
+    job = dispatch_context_propagation(request, context, properties)
+    if job['status'] != 'done':
+        return job_accepted(request, job, context.flatten())
+
     handler = JSONResourceEntity(request, context.flatten())
     return handler.buildResponse()
 
@@ -84,9 +140,9 @@ def DeleteContext(context, request):
     """
         Delete a context
     """
-    context.removeUserSubscriptions()
-    context.removeActivities(logical=True)
-    context.delete()
+    job = dispatch_job(request, 'delete_context', {'hash': context['hash']})
+    if job['status'] != 'done':
+        return job_accepted(request, job)
     return HTTPNoContent()
 
 
@@ -106,8 +162,10 @@ def clearContextTags(context, request):
     """
     context['tags'] = []
     context.save()
-    context.updateContextActivities(force_update=True)
-    context.updateUsersSubscriptions(force_update=True)
+    job = dispatch_context_propagation(request, context)
+    if job['status'] != 'done':
+        return job_accepted(request, job, [])
+
     handler = JSONResourceRoot(request, [])
     return handler.buildResponse()
 
@@ -129,8 +187,10 @@ def updateContextTags(context, request):
     context['tags'].extend(tags)
     context['tags'] = list(set(context['tags']))
     context.save()
-    context.updateContextActivities(force_update=True)
-    context.updateUsersSubscriptions(force_update=True)
+    job = dispatch_context_propagation(request, context)
+    if job['status'] != 'done':
+        return job_accepted(request, job, context['tags'])
+
     handler = JSONResourceRoot(request, context['tags'])
     return handler.buildResponse()
 
@@ -148,8 +208,9 @@ def removeContextTag(context, request):
         raise ObjectNotFound('This context has no tag "{}"'.format(tag))
 
     context.save()
-    context.updateContextActivities(force_update=True)
-    context.updateUsersSubscriptions(force_update=True)
+    job = dispatch_context_propagation(request, context)
+    if job['status'] != 'done':
+        return job_accepted(request, job)
     return HTTPNoContent()
 
 
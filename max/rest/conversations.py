@@ -33,18 +33,11 @@ def getConversations(conversations, request):
     """
         Get user conversations
     """
-    # List subscribed conversations, and use it to make the query
-    # This way we can filter 2-people conversations that have been archived
-
+    # Conversations come sorted by the date of their last message, stored on each conversation
     conversations_search = request.actor.getConversations()
+    conversations_info = [conversation.getInfo(request.actor['username']) for conversation in conversations_search]
 
-    def conversations_info():
-        for conversation in conversations_search:
-            yield conversation.getInfo(request.actor['username'])
-
-    sorted_conversations = sorted(conversations_info(), reverse=True, key=lambda conv: conv['lastMessage']['published'])
-
-    handler = JSONResourceRoot(request, sorted_conversations)
+    handler = JSONResourceRoot(request, conversations_info)
     return handler.buildResponse()
 
 
@@ -77,6 +70,7 @@ def postMessage2Conversation(conversations, request):
 
     participants = {}
     users = MADMaxCollection(request, 'users', query_key='username')
+    users.prefetch('username', request_participants)
     for participant in request_participants:
         user = users[participant]
         if request.actor['username'] != user['username'] and not request.actor.is_allowed_to_see(user):
@@ -15,31 +15,40 @@ def favorite(activity, request):
         Favorite activity
     """
 
-    if activity.has_favorite_from(request.actor):
-        code = 200
+    # Prepare rest parameters to be merged with post data
+    rest_params = {
+        'verb': 'favorite',
+        'object': {
+            '_id': ObjectId(activity['_id']),
+            'objectType': activity['objectType'],
+        }
+    }
 
-        activities = MADMaxCollection(request, 'activity')
-        query = {'verb': 'favorite', 'object._id': activity['_id'], 'actor.username': request.actor['username']}
-        newactivity = activities.last(query)  # Pick the last one, so we get the last time user favorited this activiry
+    # Initialize a Activity object from the request
+    newactivity = Activity.from_request(request, rest_params=rest_params)
 
-    else:
+    # The mark is added atomically, so only one of concurrent requests from the
+    # same actor adds it, and the activity gets the stored favorites
+    if activity.add_favorite_from(request.actor):
         code = 201
-        # Prepare rest parameters to be merged with post data
-        rest_params = {
-            'verb': 'favorite',
-            'object': {
-                '_id': ObjectId(activity['_id']),
-                'objectType': activity['objectType'],
-            }
-        }
+        try:
+            newactivity_oid = newactivity.insert()
+        except Exception:
+            # The mark is not kept without its favorite activity
+            activity.delete_favorite_from(request.actor)
+            raise
+        newactivity['_id'] = newactivity_oid
 
-        # Initialize a Activity object from the request
-        newactivity = Activity.from_request(request, rest_params=rest_params)
+    else:
+        code = 200
 
-        newactivity_oid = newactivity.insert()
-        newactivity['_id'] = newactivity_oid
+        activities = MADMaxCollection(request, 'activity')
+        query = {'verb': 'favorite', 'object._id': activity['_id'], 'actor.username': request.actor['username']}
+        last_activity = activities.last(query)  # Pick the last one, so we get the last time user favorited this activity
 
-        activity.add_favorite_from(request.actor)
+        # The favorite activity of a concurrent request may not be stored yet
+        if last_activity is not None:
+            newactivity = last_activity
 
     newactivity['object']['favorites'] = activity['favorites']  # Return the current favorites of the activity
     newactivity['object']['favoritesCount'] = activity['favoritesCount']
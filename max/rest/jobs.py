@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from max.exceptions import ObjectNotFound
+from max.jobs import get_job
+from max.jobs import job_info
+from max.rest import JSONResourceEntity
+from max.rest import endpoint
+from max.security.permissions import do_maintenance
+
+
+def job_accepted(request, job, data=None):
+    """
+        Returns the 202 response of a request that queued a job, with the
+        job url on the Location header. Returns the job info unless other
+        data is provided.
+    """
+    handler = JSONResourceEntity(request, job_info(job) if data is None else data, status_code=202)
+    response = handler.buildResponse()
+    response.location = request.route_url('job', id=str(job['_id']))
+    return response
+
+
+@endpoint(route_name='job', request_method='GET', permission=do_maintenance)
+def getJob(context, request):
+    """
+        Get the status and progress of a job
+    """
+    job = get_job(request.registry.max_store, request.matchdict['id'])
+    if job is None:
+        raise ObjectNotFound('There is no job with id {}'.format(request.matchdict['id']))
+
+    handler = JSONResourceEntity(request, job_info(job))
+    return handler.buildResponse()
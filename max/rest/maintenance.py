@@ -1,13 +1,28 @@
 # -*- coding: utf-8 -*-
+from max.MADMax import MADMaxCollection
 from max.exceptions import ObjectNotFound
+from max.jobs import JobStep
+from max.jobs import dispatch_job
+from max.jobs import register_job
+from max.keywords import KeywordReindexer
+from max.mongoprobe import profiler
+from max.outbox import outbox_backlog
+from max.peoplesearch import search_field
+from max.queryplans import explain_enabled
+from max.queryplans import query_plans
 from max.models import Context
 from max.models import Token
 from max.models import Conversation
+from max.models.activity import REPLIES_PREVIEW_SIZE
+from max.models.conversation import refresh_last_message
 from max.rest import JSONResourceEntity
 from max.rest import JSONResourceRoot
 from max.rest import endpoint
+from max.rest.jobs import job_accepted
+from max.security.oauth import token_cache
 from max.security.permissions import do_maintenance
 from max.rabbitmq import RabbitNotifications
+from max.rabbitmq import get_rabbit_pools_metrics
 from max import maxlogger
 
 from pyramid.httpexceptions import HTTPNoContent
@@ -16,23 +31,89 @@ from bson import ObjectId
 from datetime import datetime
 
 import glob
+import multiprocessing
 import os
 import re
 from collections import defaultdict
 
+
+def log_finished(message):
+    """
+        Returns a job step function that logs the end of a maintenance job
+    """
+    def log(request, item, params):
+        maxlogger.warning("Finalizado {}, realizado el: {}".format(message, datetime.now().strftime('%Y/%m/%d %H:%M:%S')))
+    return log
+
+
+def maintenance_job(request, name, data=[]):
+    """
+        Dispatches a maintenance job. When the job has been run inline
+        returns data as the response, otherwise the accepted job.
+    """
+    job = dispatch_job(request, name)
+    if job['status'] != 'done':
+        return job_accepted(request, job)
+
+    handler = JSONResourceRoot(request, data)
+    return handler.buildResponse()
+
+
+def rebuild_activity_keywords(request, checkpoint, params):
+    """
+        Reindexes the keywords of the posted activities from the last checkpoint,
+        computing them on a pool of ``max.keywords_reindex_processes`` processes.
+
+        Job workers are daemonic and can't start a pool, so keywords are computed
+        in the worker process there.
+    """
+    processes = params.get('processes')
+    if processes is None:
+        processes = int(request.registry.max_settings.get('max_keywords_reindex_processes', 0))
+    if multiprocessing.current_process().daemon:
+        processes = 0
+
+    reindexer = KeywordReindexer(request.registry.max_store, processes=processes)
+    if checkpoint.last_id is None:
+        checkpoint.save(None, 0, total=reindexer.count())
+
+    already_processed = checkpoint.processed
+
+    def save(last_id, processed, throughput):
+        checkpoint.save(last_id, already_processed + processed, throughput=throughput)
+
+    last_id, processed, throughput = reindexer.run(checkpoint.last_id, checkpoint=save)
+    maxlogger.warning("Finalizado rebuildKeywords, {} actividades a {} actividades/s, realizado el: {}".format(
+        processed, throughput, datetime.now().strftime('%Y/%m/%d %H:%M:%S')))
+
+
+register_job('rebuild_keywords', [
+    JobStep(None, None, rebuild_activity_keywords)
+])
+
+
 @endpoint(route_name='maintenance_keywords', request_method='POST', permission=do_maintenance)
 def rebuildKeywords(context, request):
     """
         Rebuild keywords of all activities
     """
-    activities = request.db.activity.search({'verb': 'post'})
-    for activity in activities:
-        activity['object'].setKeywords()
-        activity.setKeywords()
-        activity.save()
+    return maintenance_job(request, 'rebuild_keywords')
 
-    handler = JSONResourceRoot(request, [])
-    return handler.buildResponse()
+
+def rebuild_activity_dates(request, activity, params):
+    # Remove ancient commented field
+    if 'commented' in activity:
+        del activity['commented']
+    if activity.get('replies', []):
+        activity['lastComment'] = ObjectId(activity['replies'][-1]['id'])
+    if not activity.get('likesCount', 0):
+        activity['lastLike'] = None
+    activity.save()
+
+
+register_job('rebuild_dates', [
+    JobStep('activity', {'verb': 'post'}, rebuild_activity_dates)
+])
 
 
 @endpoint(route_name='maintenance_dates', request_method='POST', permission=do_maintenance)
@@ -40,19 +121,68 @@ def rebuildDates(context, request):
     """
         Rebuild dates of activities
 
-        Now currently sets the lastComment id field
+        Now currently sets the lastComment id field, and clears the
+        lastLike date of activities without likes
     """
-    activities = request.db.activity.search({'verb': 'post'})
-    for activity in activities:
-        # Remove ancient commented field
-        if 'commented' in activity:
-            del activity['commented']
-        if activity.get('replies', []):
-            activity['lastComment'] = ObjectId(activity['replies'][-1]['id'])
-        activity.save()
+    return maintenance_job(request, 'rebuild_dates')
 
-    handler = JSONResourceRoot(request, [])
-    return handler.buildResponse()
+
+def rebuild_activity_replies(request, activity, params):
+    replies = activity.get('replies', [])
+    request.registry.max_store.activity.update(
+        {'_id': activity['_id']},
+        {'$set': {'repliesCount': len(replies), 'replies': replies[-REPLIES_PREVIEW_SIZE:]}}
+    )
+
+
+register_job('rebuild_replies', [
+    JobStep('activity', {'verb': 'post', 'repliesCount': {'$exists': False}}, rebuild_activity_replies, wrap=False),
+    JobStep(None, None, log_finished('rebuildReplies (guarda el numero de comentarios y solo los ultimos en cada actividad)'))
+])
+
+
+@endpoint(route_name='maintenance_replies', request_method='POST', permission=do_maintenance)
+def rebuildReplies(context, request):
+    """
+        Rebuild replies of activities
+
+        Stores the number of comments of each activity, and keeps only
+        the last ones on its replies, as the rest are read from the
+        comment activities.
+    """
+    return maintenance_job(request, 'rebuild_replies')
+
+
+def rebuild_context_subscriptions(request, context, params):
+    context.updateUsersSubscriptions(force_update=True)
+    context.updateContextActivities(force_update=True)
+
+    #Creates a binding between user exchanges and a context
+    notifier = RabbitNotifications(request)
+    if context.get('notifications', False):
+        for user in context.subscribedUsers():
+            notifier.bind_user_to_context(context, user['username'])
+
+
+def rebuild_user_context_subscriptions(request, user, params):
+    subscribed_hashes = [subscription['hash'] for subscription in user.get('subscribedTo', [])]
+    existing_contexts = set([context['hash'] for context in request.db.db.contexts.find({'hash': {'$in': subscribed_hashes}}, {'hash': 1})])
+
+    for subscription in user.get('subscribedTo', []):
+        if subscription['hash'] not in existing_contexts:
+            fake_deleted_context = Context.from_object(request, subscription)
+            user.removeSubscription(fake_deleted_context)
+        else:
+            subscription.pop('vetos', None)
+            subscription.pop('grants', None)
+    user.save()
+
+
+register_job('rebuild_subscriptions', [
+    JobStep('contexts', {}, rebuild_context_subscriptions),
+    JobStep('users', {'subscribedTo.0': {'$exists': True}}, rebuild_user_context_subscriptions),
+    JobStep(None, None, log_finished('rebuildSubscriptions (crea los bindings de los usuarios subscritos en un contexto, si no los tiene)'))
+])
 
 
 @endpoint(route_name='maintenance_subscriptions', request_method='POST', permission=do_maintenance)
@@ -62,32 +192,99 @@ def rebuildSubscriptions(context, request):
 
         Performs sanity checks on existing subscriptions
     """
-    existing_contexts = {}
-    contexts = request.db.contexts.dump()
-    for context in contexts:
-        context.updateUsersSubscriptions(force_update=True)
-        context.updateContextActivities(force_update=True)
-        existing_contexts[context['hash']] = context
-
-        #Creates a binding between user exchanges and a context
-        notifier = RabbitNotifications(request)
-        if context.get('notifications', False):
-            for user in context.subscribedUsers():
-                notifier.bind_user_to_context(context, user['username'])
-
-    users = request.db.users.search({'subscribedTo.0': {'$exists': True}})
-    for user in users:
-        for subscription in user.get('subscribedTo', []):
-            if subscription['hash'] not in existing_contexts:
-                fake_deleted_context = Context.from_object(request, subscription)
-                user.removeSubscription(fake_deleted_context)
-            else:
-                subscription.pop('vetos', None)
-                subscription.pop('grants', None)
-        user.save()
-    handler = JSONResourceRoot(request, [])
-    maxlogger.warning("Finalizado rebuildSubscriptions (crea los bindings de los usuarios subscritos en un contexto, si no los tiene): " + str(handler.buildResponse()._status) + " realizado el: " + datetime.now().strftime('%Y/%m/%d %H:%M:%S'))
-    return handler.buildResponse()
+    return maintenance_job(request, 'rebuild_subscriptions')
+
+
+def rebuild_conversation(request, conversation, params):
+    # if we found an ancient plain username list, we migrate it
+    if True not in [isinstance(a, dict) for a in conversation['participants']]:
+        conversation['participants'] = [{'username': a, 'displayName': a, 'objectType': 'person'} for a in conversation['participants']]
+
+    conversation.save()
+
+    conversation.updateUsersSubscriptions(force_update=True)
+    conversation.updateContextActivities(force_update=True)
+
+
+def rebuild_user_conversation_subscriptions(request, user, params):
+    subscribed_ids = [ObjectId(subscription['id']) for subscription in user.get('talkingIn', [])]
+    existing_conversations = dict([(str(conversation['_id']), conversation) for conversation in request.db.db.conversations.find({'_id': {'$in': subscribed_ids}}, {'participants': 1})])
+
+    notifier = RabbitNotifications(request)
+    for subscription in list(user.get('talkingIn', [])):
+        if subscription['id'] not in existing_conversations:
+            # Don't go through removeSubscription, as it would try to update the missing conversation
+            fake_deleted_conversation = Conversation.from_object(request, dict(subscription, _id=ObjectId(subscription['id'])))
+            notifier.unbind_user_from_conversation(fake_deleted_conversation, user['username'])
+            user['talkingIn'] = [a for a in user['talkingIn'] if a['id'] != subscription['id']]
+        else:
+            # if subscription has an ancient plain username list, update and save it
+            if True not in [isinstance(a, dict) for a in subscription['participants']]:
+                subscription['participants'] = existing_conversations[subscription['id']]['participants']
+
+    user.updateConversationParticipants(force_update=True)
+    user.save()
+
+
+def rebuild_conversation_tags(request, conversation, params):
+    conversation_participants_usernames = [user['username'] for user in conversation['participants']]
+    conversation_subscribed_usernames = [user['username'] for user in request.db.db.users.find({'talkingIn.id': str(conversation['_id'])}, {'username': 1})]
+    existing_users = set([user['username'] for user in request.db.db.users.find({'username': {'$in': conversation_participants_usernames}}, {'username': 1})])
+
+    not_subscribed = set(conversation_participants_usernames) - set(conversation_subscribed_usernames)
+    deleted_participants = set(not_subscribed) - existing_users
+
+    all_participants_subscribed = len(conversation_participants_usernames) == len(conversation_subscribed_usernames)
+    all_participants_exist = len(deleted_participants) == 0
+    if 'single' in conversation['tags']:
+        conversation['tags'].remove('single')
+    if 'archive' in conversation['tags']:
+        conversation['tags'].remove('archive')
+
+    # Conversations od 2+ get the group tag
+    if len(conversation['participants']) > 2:
+        if 'group' not in conversation['tags']:
+            conversation['tags'].append('group')
+    # Two people conversation and not group:
+    # tag single: if not all participants subscribed by all exist
+    # tag archive: if not all participants exist
+    elif len(conversation['participants']) == 2 and 'group' not in conversation['tags']:
+        if all_participants_subscribed:
+            pass
+        elif not all_participants_subscribed and all_participants_exist:
+            conversation['tags'].append('single')
+        elif not all_participants_subscribed and not all_participants_exist:
+            conversation['tags'].append('archive')
+    # Tag archive: if group conversation only 1 participant
+    elif 'group' in conversation['tags'] and len(conversation['participants']) == 1:
+        conversation['tags'].append('archive')
+
+    # Si hi ha alguna conversa on el owner no estigui subscrit a la conversa
+    # el que fem es afegir com a owner un dels membres que estigui subscrit
+    if conversation_subscribed_usernames and conversation['_owner'] not in conversation_subscribed_usernames:
+        conversation['_owner'] = conversation_subscribed_usernames[0]
+
+        # Give hability to add new users to the new owner
+        owner = MADMaxCollection(request, 'users', query_key='username')[conversation['_owner']]
+        subscription = owner.getSubscription(conversation)
+        owner.grantPermission(subscription, 'invite', permanent=True)
+        owner.grantPermission(subscription, 'kick', permanent=True)
+        owner.revokePermission(subscription, 'unsubscribe', permanent=True)
+
+    # Creates a binding only users subscribed in conversation
+    notifier = RabbitNotifications(request)
+    for participant in conversation_subscribed_usernames:
+        notifier.bind_user_to_conversation(conversation, participant)
+
+    conversation.save()
+
+
+register_job('rebuild_conversations', [
+    JobStep('conversations', {}, rebuild_conversation),
+    JobStep('users', {'talkingIn.0': {'$exists': True}}, rebuild_user_conversation_subscriptions),
+    JobStep('conversations', {}, rebuild_conversation_tags),
+    JobStep(None, None, log_finished('rebuildConversationSubscriptions (crea los bindings de los usuarios subscritos en una conversa, si no los tiene)'))
+])
 
 
 @endpoint(route_name='maintenance_conversations', request_method='POST', permission=do_maintenance)
@@ -97,169 +294,103 @@ def rebuildConversationSubscriptions(context, request):
 
         Performs sanity checks on existing subscriptions
     """
-    existing_conversations = {}
-    conversations = request.db.conversations.dump()
-    for conversation in conversations:
-
-        # if we found an ancient plain username list, we migrate it
-        if True not in [isinstance(a, dict) for a in conversation['participants']]:
-            conversation['participants'] = [{'username': a, 'displayName': a, 'objectType': 'person'} for a in conversation['participants']]
-
-        conversation.save()
-
-        conversation.updateUsersSubscriptions(force_update=True)
-        conversation.updateContextActivities(force_update=True)
-
-        existing_conversations[str(conversation['_id'])] = conversation
-
-    subscribed_users_by_conversation = {}
-    users = request.db.users.search({'talkingIn.0': {'$exists': True}})
-    for user in users:
-        for subscription in user.get('talkingIn', []):
-            if subscription['id'] not in existing_conversations:
-                fake_deleted_conversation = Conversation.from_object(request, subscription)
-                user.removeSubscription(fake_deleted_conversation)
-                user['talkingIn'] = [a for a in user['talkingIn'] if a['id'] != subscription['id']]
-            else:
-                # if subscription has an ancient plain username list, update and save it
-                if True not in [isinstance(a, dict) for a in subscription['participants']]:
-                    subscription['participants'] = existing_conversations[subscription['id']]['participants']
-            subscribed_users_by_conversation.setdefault(subscription['id'], [])
-            subscribed_users_by_conversation[subscription['id']].append(user['username'])
-
-        user.updateConversationParticipants(force_update=True)
-        user.save()
+    return maintenance_job(request, 'rebuild_conversations')
 
-    existing_users = request.db.users.search({}, show_fields={'username': True, '_id': False})
-    existing_users_set = set([a['username'] for a in existing_users])
-
-    conversations = request.db.conversations.dump()
-    try:
-        for conversation in conversations:
-            conversation_participants_usernames = [user['username'] for user in conversation['participants']]
-            conversation_subscribed_usernames = subscribed_users_by_conversation[str(conversation['_id'])]
-
-            not_subscribed = set(conversation_participants_usernames) - set(conversation_subscribed_usernames)
-            deleted_participants = set(not_subscribed) - existing_users_set
-
-            all_participants_subscribed = len(conversation_participants_usernames) == len(conversation_subscribed_usernames)
-            all_participants_exist = len(deleted_participants) == 0
-            if 'single' in conversation['tags']:
-                conversation['tags'].remove('single')
-            if 'archive' in conversation['tags']:
-                conversation['tags'].remove('archive')
-
-            # Conversations od 2+ get the group tag
-            if len(conversation['participants']) > 2:
-                if 'group' not in conversation['tags']:
-                    conversation['tags'].append('group')
-            # Two people conversation and not group:
-            # tag single: if not all participants subscribed by all exist
-            # tag archive: if not all participants exist
-            elif len(conversation['participants']) == 2 and 'group' not in conversation['tags']:
-                if all_participants_subscribed:
-                    pass
-                elif not all_participants_subscribed and all_participants_exist:
-                    conversation['tags'].append('single')
-                elif not all_participants_subscribed and not all_participants_exist:
-                    conversation['tags'].append('archive')
-            # Tag archive: if group conversation only 1 participant
-            elif 'group' in conversation['tags'] and len(conversation['participants']) == 1:
-                conversation['tags'].append('archive')
-
-            # Creates a binding only users subscribed in conversation
-            notifier = RabbitNotifications(request)
-            for participant in conversation_subscribed_usernames:
-                notifier.bind_user_to_conversation(conversation, participant)
-
-            conversation.save()
-    except:
-        # Si hi ha alguna conversa on el owner no estigui subscrit a la conversa
-        # el que fem es afegir com a owner un dels membres que estigui subscrit
-        # i creem els bindings dels usuaris subscrits.
-        # He fet això perque en local tenia un grup on el propietari no estaba subscrit i petava
-        if conversation['_owner'] not in conversation_subscribed_usernames:
-            conversation['_owner'] = conversation_subscribed_usernames[0]
-            conversation.save()
-
-
-            # Give hability to add new users to the new owner
-            user = request.db.users.search({'username': str(conversation_subscribed_usernames[0])})
-            user.request.actor.grantPermission(subscription, 'invite', permanent=True)
-            user.request.actor.grantPermission(subscription, 'kick', permanent=True)
-            user.request.actor.revokePermission(subscription, 'unsubscribe', permanent=True)
-
-            # Creates a binding only users subscribed in conversation
-            notifier = RabbitNotifications(request)
-            for participant in conversation_subscribed_usernames:
-                notifier.bind_user_to_conversation(conversation, participant)
-
-            conversation.save()
-
-    handler = JSONResourceRoot(request, [])
-    maxlogger.warning("Finalizado rebuildConversationSubscriptions (crea los bindings de los usuarios subscritos en una conversa, si no los tiene): " + str(handler.buildResponse()._status) + " realizado el: " + datetime.now().strftime('%Y/%m/%d %H:%M:%S'))
-    return handler.buildResponse()
 
+def rebuild_conversation_last_message(request, conversation, params):
+    refresh_last_message(request.registry.max_store, conversation['_id'])
 
-@endpoint(route_name='maintenance_users', request_method='POST', permission=do_maintenance)
-def rebuildUser(context, request):
-    """
-        Rebuild users
 
-        Sets sensible defaults and perform consistency checks.
-        Checks that owner of the object must be the same as the user object
+register_job('rebuild_conversations_last_message', [
+    JobStep('conversations', {}, rebuild_conversation_last_message, wrap=False),
+    JobStep(None, None, log_finished('rebuildConversationsLastMessage (guarda el ultimo mensaje en cada conversa)'))
+])
+
+
+@endpoint(route_name='maintenance_conversations_last_message', request_method='POST', permission=do_maintenance)
+def rebuildConversationsLastMessage(context, request):
     """
-    users = request.db.users.dump()
-    for user in users:
-        if user['_owner'] != user['username']:
-            user['_owner'] = user['username']
-            user.save()
+        Rebuild conversations last message
 
-        # Create exchange publish and subscribe in Rabbit
-        # Hemos visto que si el usuario ya esta creado no pasa nada y si no existe crea los exchanges
-        notifier = RabbitNotifications(request)
-        notifier.add_user(user['username'])
+        Stores the last message of each conversation on it, as needed to
+        list conversations sorted by its last message.
+    """
+    job = dispatch_job(request, 'rebuild_conversations_last_message')
+    if job['status'] != 'done':
+        return job_accepted(request, job)
 
-    handler = JSONResourceRoot(request, [])
-    maxlogger.warning("Finalizado rebuildUser (crea exchanges de los usuarios que no existan en el Rabbit): " + str(handler.buildResponse()._status) + " realizado el: " + datetime.now().strftime('%Y/%m/%d %H:%M:%S'))
+    handler = JSONResourceEntity(request, {'conversations': job['processed']})
     return handler.buildResponse()
 
 
-@endpoint(route_name='maintenance_tokens', request_method='POST', permission=do_maintenance)
-def rebuildTokens(context, request):
+def rebuild_user(request, user, params):
+    # Saving the user also updates its people search field
+    if user['_owner'] != user['username'] or user.get('_search') != search_field(user):
+        user['_owner'] = user['username']
+        user.save()
+
+    # Create exchange publish and subscribe in Rabbit
+    # Hemos visto que si el usuario ya esta creado no pasa nada y si no existe crea los exchanges
+    notifier = RabbitNotifications(request)
+    notifier.add_user(user['username'])
+
+
+register_job('rebuild_users', [
+    JobStep('users', {}, rebuild_user),
+    JobStep(None, None, log_finished('rebuildUser (crea exchanges de los usuarios que no existan en el Rabbit)'))
+])
+
+
+@endpoint(route_name='maintenance_users', request_method='POST', permission=do_maintenance)
+def rebuildUser(context, request):
     """
-        Rebuild tokens
+        Rebuild users
 
-        Move any user that has old style tokens to the new tokens collection
+        Sets sensible defaults and perform consistency checks.
+        Checks that owner of the object must be the same as the user object,
+        and that the people search field is up to date.
     """
-    # Find all users with tokens
-    users_with_tokens = request.db.db.users.find({'$or': [{'iosDevices.0': {'$exists': True}}, {'androidDevices.0': {'$exists': True}}]})
+    return maintenance_job(request, 'rebuild_users')
 
+
+def rebuild_user_tokens(request, user, params):
     platforms = [
         ('ios', 'iosDevices'),
         ('android', 'androidDevices')
     ]
 
-    for user in users_with_tokens:
-        for platform, oldfield in platforms:
-            tokens = user.get(oldfield, [])
-
-            for token in tokens:
-                newtoken = Token.from_object(request, {
-                    'platform': platform,
-                    'token': token,
-                    'objectId': 'token',
-                    '_owner': user['username'],
-                    '_creator': user['username'],
-                })
-                newtoken.setDates()
-                newtoken.insert()
+    for platform, oldfield in platforms:
+        tokens = user.get(oldfield, [])
+
+        for token in tokens:
+            newtoken = Token.from_object(request, {
+                'platform': platform,
+                'token': token,
+                'objectId': 'token',
+                '_owner': user['username'],
+                '_creator': user['username'],
+            })
+            newtoken.setDates()
+            newtoken.insert()
 
     # Clean old token fields
-    request.db.db.users.update({}, {'$unset': {'iosDevices': '', 'androidDevices': ''}}, multi=True)
+    request.db.db.users.update({'_id': user['_id']}, {'$unset': {'iosDevices': '', 'androidDevices': ''}})
 
-    handler = JSONResourceRoot(request, [])
-    return handler.buildResponse()
+
+register_job('rebuild_tokens', [
+    # Find all users with tokens
+    JobStep('users', {'$or': [{'iosDevices.0': {'$exists': True}}, {'androidDevices.0': {'$exists': True}}]}, rebuild_user_tokens, wrap=False)
+])
+
+
+@endpoint(route_name='maintenance_tokens', request_method='POST', permission=do_maintenance)
+def rebuildTokens(context, request):
+    """
+        Rebuild tokens
+
+        Move any user that has old style tokens to the new tokens collection
+    """
+    return maintenance_job(request, 'rebuild_tokens')
 
 
 @endpoint(route_name='maintenance_exception', request_method='GET', permission=do_maintenance)
@@ -327,3 +458,81 @@ def getExceptions(context, request):
 
     handler = JSONResourceRoot(request, sorted(get_exceptions(), key=lambda x: x['date'], reverse=True))
     return handler.buildResponse()
+
+
+@endpoint(route_name='maintenance_queries', request_method='GET', permission=do_maintenance)
+def getQueriesProfile(context, request):
+    """
+        Get the mongodb queries stats of this process
+
+        Queries are aggregated by route, collection and query shape,
+        and sorted by total time spent.
+    """
+    result = {
+        'enabled': profiler.enabled,
+        'since': profiler.started.strftime('%Y/%m/%d %H:%M:%S'),
+        'queries': profiler.report()
+    }
+    handler = JSONResourceEntity(request, result)
+    return handler.buildResponse()
+
+
+@endpoint(route_name='maintenance_queries', request_method='DELETE', permission=do_maintenance)
+def resetQueriesProfile(context, request):
+    """
+        Reset the mongodb queries stats of this process
+    """
+    profiler.reset()
+    return HTTPNoContent()
+
+
+@endpoint(route_name='maintenance_query_plans', request_method='GET', permission=do_maintenance)
+def getQueryPlans(context, request):
+    """
+        Get the mongodb query plans captured on this process, grouped by route
+
+        Plans doing collection scans or examining too many documents
+        for the ones returned are flagged.
+    """
+    result = {
+        'enabled': explain_enabled(request),
+        'routes': query_plans.by_route()
+    }
+    handler = JSONResourceEntity(request, result)
+    return handler.buildResponse()
+
+
+@endpoint(route_name='maintenance_query_plans', request_method='DELETE', permission=do_maintenance)
+def resetQueryPlans(context, request):
+    """
+        Reset the mongodb query plans captured on this process
+    """
+    query_plans.reset()
+    return HTTPNoContent()
+
+
+@endpoint(route_name='maintenance_rabbitmq', request_method='GET', permission=do_maintenance)
+def getRabbitMetrics(context, request):
+    """
+        Get the usage of the rabbitmq connections pools of this process
+    """
+    handler = JSONResourceRoot(request, get_rabbit_pools_metrics())
+    return handler.buildResponse()
+
+
+@endpoint(route_name='maintenance_oauth', request_method='GET', permission=do_maintenance)
+def getOAuthMetrics(context, request):
+    """
+        Get the hits, misses and latency of the oauth tokens cache of this process
+    """
+    handler = JSONResourceEntity(request, token_cache.report())
+    return handler.buildResponse()
+
+
+@endpoint(route_name='maintenance_outbox', request_method='GET', permission=do_maintenance)
+def getOutboxBacklog(context, request):
+    """
+        Get the backlog of notifications waiting to be published to rabbitmq
+    """
+    handler = JSONResourceEntity(request, outbox_backlog(request.registry.max_store))
+    return handler.buildResponse()
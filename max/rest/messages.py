@@ -66,6 +66,7 @@ def add_message(conversation, request):
 
     if 'single' in message_params['contexts'][0]['tags']:
         users = MADMaxCollection(request, 'users', query_key='username')
+        users.prefetch('username', [participant['username'] for participant in conversation['participants']])
         for participant in message_params['contexts'][0]['participants']:
             user = users[participant['username']]
             if user.getSubscription(conversation) is None:
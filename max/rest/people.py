@@ -2,11 +2,11 @@
 from max import SEARCH_MODIFIERS
 from max.exceptions import ValidationError
 from max.models import User
+from max.peoplesearch import search_people
 from max.rabbitmq import RabbitNotifications
 from max.rest import JSONResourceEntity
 from max.rest import JSONResourceRoot
 from max.rest import endpoint
-from max.utils.dicts import flatten
 from max.utils import searchParams
 from max.security.permissions import add_people
 from max.security.permissions import delete_user
@@ -33,19 +33,24 @@ def getVisibleUsers(users, request):
         searching, so only username and displayName attributes of a person are returned. If you
         need the full profile of a user, use the `GET` endpoint of the `User` resource.
     """
-    query = {}
+    # Only the people the actor is allowed to see are queried,
+    # so pages are always full and the remaining flag is accurate
+    query = request.actor.visible_users_query()
 
     search_params = searchParams(request)
-    filter_fields = ["username", "displayName", "objectType", 'subscribedTo']
+    filter_fields = ["username", "displayName", "objectType"]
     if asbool(search_params.get('twitter_enabled', False)):
         filter_fields.append("twitterUsername")
 
-    found_users = users.search(query, show_fields=filter_fields, sort_by_field="username", flatten=0, **search_params)
-    # Filter user results. User
-
-    filtered_users = [user for user in found_users if request.actor.is_allowed_to_see(user)]
+    # Search people on the search index instead of by regex, that scans all users,
+    # the most relevant first
+    search = search_params.pop('username', None)
+    if search:
+        found_users = search_people(users, query, search, show_fields=filter_fields, flatten=1, **search_params)
+    else:
+        found_users = users.search(query, show_fields=filter_fields, sort_by_field="username", flatten=1, **search_params)
 
-    handler = JSONResourceRoot(request, flatten(filtered_users, squash=['subscribedTo']), remaining=found_users.remaining)
+    handler = JSONResourceRoot(request, found_users)
     return handler.buildResponse()
 
 
@@ -18,31 +18,40 @@ def like(activity, request):
     """
         Like activity
     """
-    if activity.has_like_from(request.actor):
-        code = 200
+    # Prepare rest parameters to be merged with post data
+    rest_params = {
+        'verb': 'like',
+        'object': {
+            '_id': ObjectId(activity['_id']),
+            'objectType': activity['objectType'],
+        }
+    }
 
-        activities = MADMaxCollection(request, 'activity')
-        query = {'verb': 'like', 'object._id': activity['_id'], 'actor.username': request.actor['username']}
-        newactivity = activities.last(query)  # Pick the last one, so we get the last time user liked this activity
+    # Initialize a Activity object from the request
+    newactivity = Activity.from_request(request, rest_params=rest_params)
 
-    else:
+    # The mark is added atomically, so only one of concurrent requests from the
+    # same actor adds it, and the activity gets the stored likes
+    if activity.add_like_from(request.actor):
         code = 201
-        # Prepare rest parameters to be merged with post data
-        rest_params = {
-            'verb': 'like',
-            'object': {
-                '_id': ObjectId(activity['_id']),
-                'objectType': activity['objectType'],
-            }
-        }
+        try:
+            newactivity_oid = newactivity.insert()
+        except Exception:
+            # The mark is not kept without its like activity
+            activity.delete_like_from(request.actor)
+            raise
+        newactivity['_id'] = newactivity_oid
 
-        # Initialize a Activity object from the request
-        newactivity = Activity.from_request(request, rest_params=rest_params)
+    else:
+        code = 200
 
-        newactivity_oid = newactivity.insert()
-        newactivity['_id'] = newactivity_oid
+        activities = MADMaxCollection(request, 'activity')
+        query = {'verb': 'like', 'object._id': activity['_id'], 'actor.username': request.actor['username']}
+        last_activity = activities.last(query)  # Pick the last one, so we get the last time user liked this activity
 
-        activity.add_like_from(request.actor)
+        # The like activity of a concurrent request may not be stored yet
+        if last_activity is not None:
+            newactivity = last_activity
 
     newactivity['object']['likes'] = activity['likes']  # Return the current likes of the activity
     newactivity['object']['likesCount'] = activity['likesCount']  # Return the current likes of the activity
@@ -82,13 +91,8 @@ def flagActivity(activity, request):
     """
        Flag an activity
     """
-    status_code = 200
-
     # Flag only if not already flagged
-    if activity.get('flagged', None) is None:
-        activity.flag()
-        activity.save()
-        status_code = 201
+    status_code = 201 if activity.flag() else 200
 
     handler = JSONResourceEntity(request, activity.flatten(), status_code=status_code)
     return handler.buildResponse()
@@ -100,6 +104,5 @@ def unflagActivity(activity, request):
        Unflag an activity
     """
     activity.unflag()
-    activity.save()
 
     return HTTPNoContent()
@@ -1,5 +1,9 @@
 # -*- coding: utf-8 -*-
+from max.exceptions import InvalidSearchParams
+from max.exceptions import ObjectNotFound
 from max.utils import searchParams
+from max.utils.cursors import keyset_condition
+from max.utils.cursors import sort_key_values
 
 from pymongo import DESCENDING
 
@@ -11,11 +15,11 @@ SORT_STRATEGIES = {
     },
     'flagged': {
         'activity': [('flagged', DESCENDING), ('_id', DESCENDING)],
-        'comments': [('flagged', DESCENDING), ('lastComment', DESCENDING)]
+        'comments': [('flagged', DESCENDING), ('lastComment', DESCENDING), ('_id', DESCENDING)]
     },
     'likes': {
-        'activity': [('likesCount', DESCENDING), ('lastLike', DESCENDING)],
-        'comments': [('likesCount', DESCENDING), ('lastComment', DESCENDING)],
+        'activity': [('likesCount', DESCENDING), ('lastLike', DESCENDING), ('_id', DESCENDING)],
+        'comments': [('likesCount', DESCENDING), ('lastComment', DESCENDING), ('_id', DESCENDING)],
     }
 }
 
@@ -39,13 +43,9 @@ def sorted_query(request, collection, query, count=None, **kwargs):
     if strategy == 'published':
         activities = simple_sort(collection, query, search_params, is_head)
 
-    elif strategy == 'likes':
+    elif strategy in ['likes', 'flagged']:
         search_params['flatten'] = 1
-        activities = get_activities_sorted_by_like_count(collection, query, search_params, is_head)
-
-    elif strategy == 'flagged':
-        search_params['flatten'] = 1
-        activities = get_activities_sorted_by_flagged_first(collection, query, search_params, is_head)
+        activities = keyset_sort(collection, query, search_params, is_head)
 
     return activities
 
@@ -58,192 +58,42 @@ def simple_sort(collection, query, search_params, is_head):
         **search_params)
 
 
-def get_activities_sorted_by_like_count(collection, query, search_params, is_head):
-    """
-        Sorts activities by likes Count. Activities without likes will appear
-        sorted by descending activity published date order.
-
-        Sorting is made by concatenating subqueries, and preserving coherence
-        and order between pagination.
-
-        There are 4 different queries that may be executed, depending on the scenario:
-
-        - First page of a set of activities(with or without liked objects):
-            - NEXT_LIKES_QUERY will get the top liked activities until the specified limit is reached
-            - NO_LIKES_QUERY will fill up until specified limit ONLY if limit not reached in previous query
-
-        - Second and following pages of a set of activies(with or without liked objects):
-            - LAST_ITEM_QUERY will search for the last item of the previous page
-            - SAME_LIKES_QUERY will find ALL activities with the same number of likes of
-              the last item
-            - NEXT_LIKES_QUERY will search for activities with less likes than the last items ONLY
-              if limit is not reached
-            - NO_LIKES_QUERY will fill up until specified limit ONLY if limit not reached in previous query
-
-        So the most expensive scenario is the one that in a non-first page, has mixed elements,
-        that could execute 4 queries.
-
-    """
-    # This var controls whether if we have to look for liked
-    # items. We alway look for them on first page, not always on 2+ pages
-    do_search_liked = True
-    last_page_had_likes = True
-    last = None
-
-    activities = []
-
-    # Enhance the query to filter the activities,
-    # getting only the ones that have been liked
-    query['likesCount'] = {'$exists': 1, '$ne': 0}
-
-    # If we are in a 2+ page
-    if 'before' in search_params:
-        # Get the last object of the previous page...
-        # QUERY ID: LAST_ITEM_QUERY
-        last = collection[search_params['before']]
-        search_params['before'] = None
-
-        # If the last object has no likes, do nothing
-        if not last.get('likesCount', 0):
-            do_search_liked = False
-            last_page_had_likes = False
-        # Otherwise continue processing
-        else:
-            # The problem is that in order to get the next page of items, we have to request
-            # first of all the items with likesCount == last.likesCount
-            query['likesCount']['$eq'] = last['likesCount']
-            same_likesCount_search_params = dict(search_params)
-            del same_likesCount_search_params['limit']
-            # QUERY ID: SAME_LIKES_QUERY
-            same_likesCount_activities = collection.search(
-                query,
-                count=is_head,
-                offset_field='lastLike',
-                keep_private_fields=False,
-                **same_likesCount_search_params)
-
-            # and discard all of them until the last displayed item is found
-            # The remaining items will be items with the same like_count not displayed already
-            def not_displayed_activities():
-                result = []
-                activities_enumerator = enumerate(same_likesCount_activities)
-
-                for activity_index, activity in activities_enumerator:
-                    if activity['id'] == str(last['_id']):
-                        break
-
-                for activity_index, activity in activities_enumerator:
-                    result.append(activity)
-                return result
-
-            same_likesCount_activities = not_displayed_activities()
-
-            # If we have enough results to fullfill the limit requested, we don't
-            # need to query more liked items
-            if len(same_likesCount_activities) >= search_params['limit']:
-                activities = same_likesCount_activities[:search_params['limit']]
-                do_search_liked = False
-
-            # If we don't have enough items and we last queryied for likesCount == 1
-            # we don't need to query more liked items, because we used all activities
-            # with a positive value in likesCount
-            elif last['likesCount'] == 1:
-                activities = same_likesCount_activities
-                do_search_liked = False
-
-            # Otherwise, configure next query to keep searching for items
-            # with less likesCount
-            else:
-                activities = same_likesCount_activities
-                del query['likesCount']['$eq']
-                query['likesCount']['$lt'] = last['likesCount']
-
-    if do_search_liked:
-        # QUERY ID: NEXT_LIKES_QUERY
-        activities += collection.search(
-            query,
-            count=is_head,
-            offset_field='lastLike',
-            keep_private_fields=False,
-            **search_params).get()
-
-    # Use case 1:
-    # - We requested <limit> liked activities, and we got zero or less than <limit
-    #   In this situation, fill up to <limit> with the rest of non-liked actities
-    #  Use case 2:
-    # - We didn't request any liked activity because we're in a  2+ page that has no
-    #   liked activities
-    if len(activities) < search_params['limit']:
-        # Search non-liked activities to fullfill <limit> requirement
-        query.pop('likesCount', None)
-        query['likesCount'] = 0
-        # (Use case 2) Filter by the last displayed
-        search_params['sort_order'] = 'activities'
-        if not last_page_had_likes:
-            search_params['before'] = last['_id']
-
-        # QUERY ID: NO_LIKES_QUERY
-        search_params['sort_params'] = SORT_STRATEGIES['published']['activity']
-        non_liked_activities = collection.search(
-            query,
-            count=is_head,
-            keep_private_fields=False,
-            **search_params)
-        needed = search_params['limit'] - len(activities)
-        activities += non_liked_activities.get(needed)
-
-    return activities
-
-
-def get_activities_sorted_by_flagged_first(collection, query, search_params, is_head):
+def keyset_sort(collection, query, search_params, is_head):
     """
+        Sorts activities by a compound sort key, as the likes and flagged strategies do:
+
+        - likes: by likesCount, then by the date of the last like. Activities
+          without likes appear sorted by descending activity published date order.
+        - flagged: flagged activities first, sorted by the date of the flag, then the
+          rest of activities by descending activity published date order.
+
+        The last sort field is always the _id, so the key is unique, and pages are
+        retrieved with a single bounded query, filtering the items that come after the
+        sort key of the last item of the previous page. This key is taken from the
+        opaque continuation cursor returned with the previous page or, as in older
+        clients, from the item referenced in the before param.
     """
-    # This var controls whether if we have to look for flagged
-    # items. We alway look for them on first page, not aloways on 2+ pages
-    do_search_flagged = True
-    activities = []
-
-    # Enchange the query to filter the activities,
-    # getting only the ones that have been flagged
-    query['flagged'] = {'$exists': 1, '$ne': None}
-
-    # If we are in a 2+ page
-    if 'before' in search_params:
-        # Get the last object of the previous page...
-        last = collection[search_params['before']]
-        search_params['before'] = None
-        # ... and if that item displayed is flagged it means
-        # that we may have more flagged items to display
-        if last.get('flagged', None):
-            query['flagged']['$lt'] = last['flagged']
-        else:
-            do_search_flagged = False
-
-    if do_search_flagged:
-        activities = collection.search(query, count=is_head, keep_private_fields=False, **search_params).get()
-
-    # Use case 1:
-    # - We requested <limit> flagged activities, and we got zero or less than <limit
-    #   In this situation, fill up to <limit> with the rest of non-flagged actities
-    #  Use case 2:
-    # - We did'nt request any flagged activity because we're in a  2+ page that has no
-    #   flagged activities
-    found_activities_count = len(activities)
-    if found_activities_count < search_params['limit']:
-        # Search non-flagged activities to fullfill <limit> requirement
-        query.pop('flagged', None)
-        query['flagged'] = {'$exists': 0}
-        # (Use case 2) Filter by the last displayed
-        if not do_search_flagged:
-            search_params['before'] = last['_id']
-
-        search_params['sort_params'] = SORT_STRATEGIES['published']['activity']
-        non_flagged_activities = collection.search(
-            query,
-            count=is_head,
-            keep_private_fields=False,
-            **search_params)
-        needed = search_params['limit'] - found_activities_count
-        activities += non_flagged_activities.get(needed)
+    sort_params = search_params['sort_params']
+    last_values = search_params.pop('cursor', None)
+    before = search_params.pop('before', None)
+
+    # Find the sort key of the last item displayed when paginating with before=<id>
+    if last_values is None and before is not None:
+        fields = dict([(field, 1) for field, direction in sort_params])
+        last = collection.collection.find_one({'_id': before}, fields)
+        if last is None:
+            raise ObjectNotFound("Object with _id {} not found inside {}".format(before, collection.collection.name))
+        last_values = sort_key_values(last, sort_params)
+
+    if last_values is not None:
+        if len(last_values) != len(sort_params):
+            raise InvalidSearchParams('cursor does not match the requested sorting')
+        query = dict(query)
+        query['$and'] = query.get('$and', []) + [keyset_condition(sort_params, last_values)]
 
-    return activities
+    return collection.search(
+        query,
+        count=is_head,
+        keep_private_fields=False,
+        keyset=sort_params,
+        **search_params)
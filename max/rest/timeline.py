@@ -5,6 +5,12 @@ from max.rest import JSONResourceRoot
 from max.rest import endpoint
 from max.rest.sorting import sorted_query
 from max.security.permissions import view_timeline
+from max.timelines import TimelineFeeds
+from max.timelines import materialized_timelines_enabled
+from max.utils import searchParams
+
+# Search params that can be answered from a materialized timeline
+MATERIALIZED_TIMELINE_PARAMS = set(['limit', 'before', 'after'])
 
 
 def timelineQuery(actor):
@@ -52,16 +58,67 @@ def timelineQuery(actor):
     return query
 
 
+def materializedTimeline(user, request):
+    """
+        Get a page of the user timeline from its materialized feed, and if there
+        are activities remaining in the feed after it.
+
+        Returns None when the request can't be answered from the feed (the feature
+        is disabled, the user feed is not built yet or the request uses sorting,
+        filters or counts), so the regular timeline query must be used.
+    """
+    if request.method == 'HEAD' or not materialized_timelines_enabled(request):
+        return None
+
+    search_params = searchParams(request)
+    sorting = (search_params.pop('sort_strategy', 'published'), search_params.pop('sort_priority', 'activity'))
+    if sorting != ('published', 'activity') or 'limit' not in search_params:
+        return None
+    if set(search_params.keys()) - MATERIALIZED_TIMELINE_PARAMS:
+        return None
+
+    feeds = TimelineFeeds(request.db.db)
+    if not feeds.has_feed(user['username']):
+        return None
+
+    limit = search_params['limit']
+    activity_ids = feeds.page(
+        user['username'],
+        limit + 1,
+        before=search_params.get('before'),
+        after=search_params.get('after'))
+
+    query = {
+        '_id': {'$in': activity_ids},
+        'verb': 'post',
+        'visible': {'$ne': False}
+    }
+    activities = request.db.activity.search(query, keep_private_fields=False, flatten=1, limit=limit).get()
+
+    # Lazily clean the feed if some activity is gone or hidden, this page
+    # will be shorter but next requests will be served right.
+    expected = min(len(activity_ids), limit)
+    if len(activities) < expected:
+        feeds.repair(user['username'], activity_ids)
+
+    return activities, len(activity_ids) > limit
+
+
 @endpoint(route_name='timeline', request_method='GET', permission=view_timeline)
 def getUserTimeline(user, request):
     """
         Get user timeline
     """
-    query = timelineQuery(user)
+    materialized = materializedTimeline(user, request)
 
-    activities = sorted_query(request, request.db.activity, query, flatten=1)
+    if materialized is None:
+        query = timelineQuery(user)
+        activities = sorted_query(request, request.db.activity, query, flatten=1)
+        remaining = False
+    else:
+        activities, remaining = materialized
 
-    handler = JSONResourceRoot(request, activities)
+    handler = JSONResourceRoot(request, activities, remaining=remaining)
     return handler.buildResponse()
 
 
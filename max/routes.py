@@ -106,10 +106,18 @@ RESOURCES['admin_security_role_user'] = dict(route='/admin/security/roles/{role}
 RESOURCES['admin_security_users'] = dict(route='/admin/security/users', category='Management', name='Users with security', traverse="/security/", actor_not_required=['GET'])
 RESOURCES['maintenance_keywords'] = dict(route='/admin/maintenance/keywords', category='Management', name='Keywords maintenance', actor_not_required=['POST'])
 RESOURCES['maintenance_dates'] = dict(route='/admin/maintenance/dates', category='Management', name='Dates maintenance', actor_not_required=['POST'])
+RESOURCES['maintenance_replies'] = dict(route='/admin/maintenance/replies', category='Management', name='Replies maintenance', actor_not_required=['POST'])
 RESOURCES['maintenance_subscriptions'] = dict(route='/admin/maintenance/subscriptions', category='Management', name='Subscriptions maintenance', actor_not_required=['POST'])
 RESOURCES['maintenance_conversations'] = dict(route='/admin/maintenance/conversations', category='Management', name='Conversations maintenance', actor_not_required=['POST'])
+RESOURCES['maintenance_conversations_last_message'] = dict(route='/admin/maintenance/conversations/lastmessage', category='Management', name='Conversations last message maintenance', actor_not_required=['POST'])
 RESOURCES['maintenance_users'] = dict(route='/admin/maintenance/users', category='Management', name='Users Maintenance', actor_not_required=['POST'])
 RESOURCES['maintenance_tokens'] = dict(route='/admin/maintenance/tokens', category='Management', name='Tokens Maintenance', actor_not_required=['POST'])
+RESOURCES['maintenance_queries'] = dict(route='/admin/maintenance/queries', category='Management', name='Queries profiler', actor_not_required=['GET', 'DELETE'])
+RESOURCES['maintenance_query_plans'] = dict(route='/admin/maintenance/queries/plans', category='Management', name='Queries plans', actor_not_required=['GET', 'DELETE'])
+RESOURCES['maintenance_rabbitmq'] = dict(route='/admin/maintenance/rabbitmq', category='Management', name='Rabbitmq connections', actor_not_required=['GET'])
+RESOURCES['maintenance_oauth'] = dict(route='/admin/maintenance/oauth', category='Management', name='OAuth tokens cache', actor_not_required=['GET'])
+RESOURCES['maintenance_outbox'] = dict(route='/admin/maintenance/outbox', category='Management', name='Notifications outbox', actor_not_required=['GET'])
+RESOURCES['job'] = dict(route='/admin/jobs/{id}', category='Management', name='Job', actor_not_required=['GET'])
 RESOURCES['maintenance_exceptions'] = dict(route='/admin/maintenance/exceptions', category='Management', name='Error Exception list', actor_not_required=['GET'])
 RESOURCES['maintenance_exception'] = dict(route='/admin/maintenance/exceptions/{hash}', category='Management', name='Error Exception', actor_not_required=['GET'])
 
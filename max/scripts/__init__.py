@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+"""
+    Command line utilities to operate on a max instance.
+
+    All scripts take the max .ini configuration file as the first argument,
+    and use the mongodb connection settings found on it.
+"""
+from max.resources import loadMAXStore
+
+from pyramid.paster import get_appsettings
+
+import argparse
+
+
+def get_script_parser(description):
+    """
+        Returns an argument parser with the arguments common to all scripts
+    """
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('config_uri', help='max .ini configuration file')
+    return parser
+
+
+def get_max_database(config_uri):
+    """
+        Returns the max settings and database configured in config_uri
+    """
+    settings = get_appsettings(config_uri)
+    return settings, loadMAXStore(settings)
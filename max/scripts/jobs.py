@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""
+    Runs the jobs queued by max when ``max.background_jobs`` is enabled.
+
+    Starts a pool of worker processes, each one loading the max application from
+    the configuration file and running queued jobs until interrupted. With ``--once``
+    each worker exits when there are no more jobs to run. Jobs left unfinished by a
+    dead worker are resumed from their last checkpoint by any other worker.
+"""
+from max.jobs import WORKER_INTERVAL
+from max.jobs import JobRunner
+from max.scripts import get_script_parser
+
+from pyramid.paster import bootstrap
+
+import multiprocessing
+import sys
+import threading
+
+
+def run_worker(args):
+    """
+        Runs jobs in a worker process. Returns the number of jobs run.
+    """
+    config_uri, once, interval = args
+    env = bootstrap(config_uri)
+    runner = JobRunner(env['registry'])
+    jobs_run = 0
+    try:
+        if once:
+            while runner.run_next() is not None:
+                jobs_run += 1
+        else:
+            runner.run(threading.Event(), interval=interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        env['closer']()
+    return jobs_run
+
+
+def main(argv=sys.argv):
+    parser = get_script_parser('Run the max background jobs')
+    parser.add_argument('--processes', type=int, default=multiprocessing.cpu_count(), help='Number of worker processes')
+    parser.add_argument('--once', action='store_true', help='Run the queued jobs and exit')
+    parser.add_argument('--interval', type=float, default=WORKER_INTERVAL, help='Seconds to wait when there are no jobs')
+    args = parser.parse_args(argv[1:])
+
+    pool = multiprocessing.Pool(processes=args.processes)
+    try:
+        # map_async with a timeout, so KeyboardInterrupt reaches the main process
+        results = pool.map_async(run_worker, [(args.config_uri, args.once, args.interval)] * args.processes)
+        jobs_run = sum(results.get(sys.maxint))
+    except KeyboardInterrupt:
+        pool.terminate()
+    else:
+        pool.close()
+        print 'Run {} jobs'.format(jobs_run)
+    pool.join()
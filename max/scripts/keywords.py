@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+    Reindexes the keywords of all posted activities.
+
+    Runs the ``rebuild_keywords`` maintenance job in this process, computing keywords
+    on a pool of ``--processes`` processes. If a previous reindex failed, or is still
+    running but its heartbeat is older than ``max.jobs_heartbeat_timeout`` seconds, it's
+    resumed from the last activity written, unless ``--restart`` is given.
+"""
+from max.jobs import JOBS_COLLECTION
+from max.jobs import create_job
+from max.jobs import heartbeat_timeout
+from max.jobs import job_info
+from max.jobs import run_job
+from max.jobs import worker_id
+from max.scripts import get_script_parser
+
+from pyramid.paster import bootstrap
+
+from datetime import datetime
+from datetime import timedelta
+from pymongo import DESCENDING
+
+import multiprocessing
+import sys
+
+
+def main(argv=sys.argv):
+    parser = get_script_parser('Reindex the keywords of all activities')
+    parser.add_argument('--processes', type=int, default=multiprocessing.cpu_count(), help='Number of processes computing keywords')
+    parser.add_argument('--restart', action='store_true', help='Start from the first activity, even if a previous reindex was interrupted')
+    args = parser.parse_args(argv[1:])
+
+    env = bootstrap(args.config_uri)
+    request = env['request']
+    request.actor = None
+    request.creator = None
+    database = env['registry'].max_store
+
+    job = None
+    if not args.restart:
+        now = datetime.utcnow()
+        timeout = heartbeat_timeout(env['registry'].max_settings)
+        job = database[JOBS_COLLECTION].find_and_modify(
+            query={'name': 'rebuild_keywords', '$or': [
+                {'status': 'failed'},
+                {'status': 'running', 'heartbeat': {'$lt': now - timedelta(seconds=timeout)}}
+            ]},
+            update={'$set': {
+                'status': 'running',
+                'worker': worker_id(),
+                'heartbeat': now,
+                'started': now,
+                'error': None,
+                'params.processes': args.processes
+            }},
+            sort=[('_id', DESCENDING)],
+            new=True)
+
+    if job is None:
+        job = create_job(database, 'rebuild_keywords', {'processes': args.processes}, status='running')
+    else:
+        print 'Resuming reindex from {} ({} activities processed)'.format(job['last_id'], job['processed'])
+
+    try:
+        job = run_job(request, job)
+    finally:
+        env['closer']()
+
+    info = job_info(job)
+    print 'Reindex {}: {} of {} activities, {} activities/s'.format(info['status'], info['processed'], info['total'], info['throughput'])
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""
+    Compares the mongodb indexes declared on max models with the ones on the
+    database, and creates the missing ones.
+
+    Without options, only reports the differences. Use ``--apply`` to create missing
+    and outdated indexes, and ``--drop-unknown`` to also drop the indexes not declared.
+"""
+from max.indexes import declared_indexes
+from max.indexes import diff_indexes
+from max.indexes import ensure_indexes
+from max.scripts import get_max_database
+from max.scripts import get_script_parser
+
+import sys
+
+
+def print_report(indexes, report):
+    """
+        Prints the differences found, with the routes affected by each missing index
+    """
+    for collection_name, changes in sorted(report.items()):
+        for index in changes['missing']:
+            print '[missing] {}: {}'.format(collection_name, index.describe())
+            print '          used by: {}'.format(', '.join(index.routes))
+        for index, info in changes['outdated']:
+            print '[outdated] {}: {} (existing: {})'.format(collection_name, index.describe(), info.get('key'))
+        for name in changes['unknown']:
+            print '[unknown] {}: {}'.format(collection_name, name)
+
+    declared = sum([len(collection_indexes) for collection_indexes in indexes.values()])
+    print '{} indexes declared on {} collections'.format(declared, len(indexes))
+
+
+def main(argv=sys.argv):
+    parser = get_script_parser('Check and create the mongodb indexes used by max')
+    parser.add_argument('--apply', action='store_true', help='Create missing indexes and recreate outdated ones')
+    parser.add_argument('--drop-unknown', action='store_true', help='Drop existing indexes not declared on max. Implies --apply')
+    args = parser.parse_args(argv[1:])
+
+    settings, db = get_max_database(args.config_uri)
+    indexes = declared_indexes()
+
+    if not (args.apply or args.drop_unknown):
+        print_report(indexes, diff_indexes(db, indexes))
+        return
+
+    for action, collection_name, description in ensure_indexes(db, drop_unknown=args.drop_unknown, indexes=indexes):
+        print '[{}] {}: {}'.format(action, collection_name, description)
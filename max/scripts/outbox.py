@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+"""
+    Publishes the notifications stored on the outbox to rabbitmq.
+
+    Runs until interrupted, unless ``--once`` is used to publish the current
+    backlog and exit. Use it when ``max.notifications_outbox`` is enabled and the
+    publisher is not running as a thread inside max processes.
+"""
+from max.outbox import BATCH_SIZE
+from max.outbox import PUBLISHER_INTERVAL
+from max.outbox import get_outbox_publisher
+from max.resources import loadMAXSettings
+from max.scripts import get_max_database
+from max.scripts import get_script_parser
+
+import sys
+import threading
+
+
+def main(argv=sys.argv):
+    parser = get_script_parser('Publish the max notifications outbox to rabbitmq')
+    parser.add_argument('--once', action='store_true', help='Publish the current backlog and exit')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='Entries published on each batch')
+    parser.add_argument('--interval', type=float, default=PUBLISHER_INTERVAL, help='Seconds to wait when the outbox is empty')
+    args = parser.parse_args(argv[1:])
+
+    settings, db = get_max_database(args.config_uri)
+    publisher = get_outbox_publisher(loadMAXSettings(settings), db)
+
+    if args.once:
+        published = total = publisher.drain(args.batch_size)
+        while published:
+            published = publisher.drain(args.batch_size)
+            total += published
+        print 'Published {} notifications'.format(total)
+        return
+
+    stop_event = threading.Event()
+    try:
+        publisher.run(stop_event, interval=args.interval, batch_size=args.batch_size)
+    except KeyboardInterrupt:
+        stop_event.set()
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+"""
+    Builds the materialized timelines of existing users.
+
+    Has to be run once when enabling ``max.materialized_timelines`` on an instance
+    with existing users, and can be run again to rebuild broken feeds.
+"""
+from max.scripts import get_max_database
+from max.scripts import get_script_parser
+from max.timelines import TimelineFeeds
+
+import sys
+import time
+
+
+def main(argv=sys.argv):
+    parser = get_script_parser('Build the materialized timelines of max users')
+    parser.add_argument('-u', '--user', dest='usernames', action='append', default=[], help='Build only the timeline of this user. Can be repeated.')
+    parser.add_argument('--missing', action='store_true', help='Build only the timelines of users without one')
+    args = parser.parse_args(argv[1:])
+
+    settings, db = get_max_database(args.config_uri)
+    feeds = TimelineFeeds(db)
+
+    query = {'username': {'$in': args.usernames}} if args.usernames else {}
+    users = db.users.find(query, {'username': 1, 'following': 1, 'subscribedTo.hash': 1})
+
+    started = time.time()
+    built = 0
+    for user in users:
+        if args.missing and feeds.has_feed(user['username']):
+            continue
+        entries = feeds.build(user)
+        built += 1
+        print '{}: {} activities'.format(user['username'], entries)
+
+    print 'Built {} timelines in {:.2f} seconds'.format(built, time.time() - started)
@@ -27,5 +27,6 @@ def get_user_roles(request, userid):
         Returns the global max roles that userid posesses.
     """
 
-    security = request.registry.max_security
+    from max.resources import get_max_security
+    security = get_max_security(request.registry)
     return security.get_user_roles(userid)
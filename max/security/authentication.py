@@ -5,25 +5,20 @@ from zope.interface import implementer
 from max.exceptions import Unauthorized
 from max.resources import getMAXSettings
 from max.security import Owner, is_owner, get_user_roles
+from max.security.oauth import token_cache
+from max.security.signedtokens import signed_tokens
 
 from pyramid.interfaces import IAuthenticationPolicy
 from pyramid.security import Authenticated
 from pyramid.security import Everyone
 from pyramid.settings import asbool
 
-from beaker.cache import cache_region
 
-import requests
-
-
-@cache_region('oauth_token')
 def check_token(url, username, token, scope, oauth_standard):
     """
         Checks if a user matches the given token.
     """
-    payload = {"access_token": token, "username": username}
-    payload['scope'] = scope if scope else 'widgetcli'
-    return requests.post(url, data=payload, verify=False).status_code == 200
+    return token_cache.check(url, username, token, scope)
 
 
 @implementer(IAuthenticationPolicy)
@@ -53,11 +48,14 @@ class MaxAuthenticationPolicy(object):
         if scope not in self.allowed_scopes:
             raise Unauthorized('The specified scope is not allowed for this resource.')
 
-        settings = getMAXSettings(request)
-        valid = check_token(
-            settings['max_oauth_check_endpoint'],
-            username, oauth_token, scope,
-            asbool(settings.get('max_oauth_standard', True)))
+        # Signed tokens are verified locally, opaque ones by the oauth server
+        valid = signed_tokens.verify(oauth_token, username, scope) if signed_tokens.enabled else None
+        if valid is None:
+            settings = getMAXSettings(request)
+            valid = check_token(
+                settings['max_oauth_check_endpoint'],
+                username, oauth_token, scope,
+                asbool(settings.get('max_oauth_standard', True)))
 
         if not valid:
             raise Unauthorized('Invalid token.')
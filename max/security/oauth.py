@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+    OAuth tokens validation cache
+
+    Tokens are validated against the oauth server check endpoint, and the results
+    kept on an in-process LRU cache: valid tokens for ``max.oauth_token_cache_ttl``
+    seconds (defaults to the old beaker ``cache.oauth_token.expire`` setting, or 60),
+    and invalid ones for ``max.oauth_token_cache_negative_ttl`` seconds (5 by default).
+
+    Concurrent checks of the same token are collapsed: the first one calls the oauth
+    server and the others wait for its result. Calls to the oauth server reuse the
+    keep-alive connections of a ``requests.Session``, with up to
+    ``max.oauth_connections`` connections per host.
+
+    Hit, miss and latency counters are available on ``/admin/maintenance/oauth``.
+"""
+from max.mongoprobe import percentile
+from max.utils.cache import LRUCache
+
+from collections import deque
+
+import requests
+import threading
+import time
+
+TOKEN_CACHE_SIZE = 10000
+TOKEN_CACHE_TTL = 60
+TOKEN_CACHE_NEGATIVE_TTL = 5
+OAUTH_CONNECTIONS = 10
+LATENCY_SAMPLES = 500
+
+
+class InFlightCheck(object):
+    """
+        A token check being performed by another thread
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.valid = None
+        self.error = None
+
+    def wait(self):
+        self.event.wait()
+        if self.error is not None:
+            raise self.error
+        return self.valid
+
+
+class TokenCache(object):
+    """
+        Process wide cache of oauth tokens validations
+    """
+
+    def __init__(self, size=TOKEN_CACHE_SIZE, ttl=TOKEN_CACHE_TTL, negative_ttl=TOKEN_CACHE_NEGATIVE_TTL, connections=OAUTH_CONNECTIONS):
+        self.valid = LRUCache(size, ttl)
+        self.invalid = LRUCache(size, negative_ttl)
+        self.connections = connections
+        self.lock = threading.Lock()
+        self.inflight = {}
+        self.session = None
+        self.reset_metrics()
+
+    def configure(self, settings):
+        """
+            Applies the cache settings. Receives the raw application settings,
+            to fall back to the beaker oauth_token region expiration.
+        """
+        size = int(settings.get('max.oauth_token_cache_size', TOKEN_CACHE_SIZE))
+        ttl = settings.get('max.oauth_token_cache_ttl', settings.get('cache.oauth_token.expire', TOKEN_CACHE_TTL))
+        self.valid.size = self.invalid.size = size
+        self.valid.ttl = int(ttl)
+        self.invalid.ttl = int(settings.get('max.oauth_token_cache_negative_ttl', TOKEN_CACHE_NEGATIVE_TTL))
+        self.connections = int(settings.get('max.oauth_connections', OAUTH_CONNECTIONS))
+        self.session = None
+
+    def get_session(self):
+        with self.lock:
+            if self.session is None:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.connections)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self.session = session
+            return self.session
+
+    def request_check(self, url, username, token, scope):
+        """
+            Asks the oauth server if a user matches the given token.
+        """
+        payload = {"access_token": token, "username": username}
+        payload['scope'] = scope if scope else 'widgetcli'
+        return self.get_session().post(url, data=payload, verify=False).status_code == 200
+
+    def check(self, url, username, token, scope):
+        """
+            Checks if a user matches the given token, using the cached result if any.
+        """
+        key = (url, username, token, scope)
+        if self.valid.get(key):
+            self.count('hits')
+            return True
+        if self.invalid.get(key):
+            self.count('negative_hits')
+            return False
+
+        with self.lock:
+            inflight = self.inflight.get(key)
+            leader = inflight is None
+            if leader:
+                inflight = self.inflight[key] = InFlightCheck()
+                self.metrics['misses'] += 1
+            else:
+                self.metrics['collapsed'] += 1
+
+        if not leader:
+            return inflight.wait()
+
+        start = time.time()
+        try:
+            inflight.valid = self.request_check(url, username, token, scope)
+        except Exception as exc:
+            inflight.error = exc
+            self.count('errors')
+            raise
+        else:
+            if inflight.valid:
+                self.valid.set(key, True)
+            else:
+                self.invalid.set(key, True)
+        finally:
+            elapsed = time.time() - start
+            with self.lock:
+                self.latencies.append(elapsed)
+                self.metrics['check_time'] += elapsed
+                del self.inflight[key]
+            inflight.event.set()
+        return inflight.valid
+
+    def count(self, counter):
+        with self.lock:
+            self.metrics[counter] += 1
+
+    def reset_metrics(self):
+        with self.lock:
+            self.metrics = dict.fromkeys(['hits', 'negative_hits', 'misses', 'collapsed', 'errors'], 0)
+            self.metrics['check_time'] = 0.0
+            self.latencies = deque(maxlen=LATENCY_SAMPLES)
+
+    def clear(self):
+        self.valid.clear()
+        self.invalid.clear()
+        self.reset_metrics()
+
+    def report(self):
+        """
+            Returns the cache counters, and the latency of the calls
+            to the oauth server in milliseconds
+        """
+        with self.lock:
+            metrics = dict(self.metrics)
+            latencies = list(self.latencies)
+        lookups = metrics['hits'] + metrics['negative_hits'] + metrics['misses'] + metrics['collapsed']
+        metrics.update({
+            'cached_valid': len(self.valid),
+            'cached_invalid': len(self.invalid),
+            'hit_ratio': round((metrics['hits'] + metrics['negative_hits']) / float(lookups), 4) if lookups else None,
+            'check_time': round(metrics['check_time'] * 1000, 3),
+            'avg_check_time': round(metrics['check_time'] * 1000 / metrics['misses'], 3) if metrics['misses'] else 0,
+            'p95_check_time': round(percentile(latencies, 95) * 1000, 3),
+            'max_check_time': round(max(latencies) * 1000, 3) if latencies else 0
+        })
+        return metrics
+
+
+token_cache = TokenCache()
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+"""
+    Offline verification of signed (JWT) oauth tokens
+
+    When ``max.oauth_jwt_keys`` points to a key file, tokens that are JWTs are verified
+    locally, without asking the oauth server. The key file can be:
+
+        - A JWKS json file, {"keys": [{"kid": "...", "kty": "oct" | "RSA" | "EC", ...}]}
+        - A PEM encoded public key
+        - Any other content is used as the shared secret of HS* signed tokens
+
+    HS256, HS384 and HS512 signatures are verified natively. RS* and ES* signatures
+    need PyJWT with cryptography installed, and are left to the oauth server otherwise.
+
+    A verified token is valid if:
+
+        - Its ``max.oauth_jwt_username_claim`` claim (``sub`` by default) is the username
+          of the request
+        - Its ``scope`` claim (a space separated string or a list, or ``scp``) contains
+          the scope of the request
+        - It has not expired, and its ``nbf`` is not in the future, allowing
+          ``max.oauth_jwt_leeway`` seconds of clock skew
+        - Its issuer and audience match ``max.oauth_jwt_issuer`` and
+          ``max.oauth_jwt_audience``, if set
+        - Its ``jti`` is not listed on the ``max.oauth_jwt_revocations`` file, one per line
+
+    Key and revocation files are reloaded when modified. Opaque tokens, and JWTs that
+    can't be verified locally, are checked against the oauth server as usual.
+"""
+from max import maxlogger
+
+import base64
+import hashlib
+import hmac
+import json
+import os
+import threading
+import time
+
+try:
+    import jwt as pyjwt
+    from jwt.algorithms import get_default_algorithms
+except ImportError:  # pragma: no cover
+    pyjwt = None
+
+HMAC_ALGORITHMS = {
+    'HS256': hashlib.sha256,
+    'HS384': hashlib.sha384,
+    'HS512': hashlib.sha512
+}
+PUBLIC_KEY_ALGORITHMS = ['RS256', 'RS384', 'RS512', 'ES256', 'ES384', 'ES512']
+FILE_CHECK_INTERVAL = 5
+
+
+def base64url_decode(value):
+    value = str(value)
+    return base64.urlsafe_b64decode(value + '=' * (-len(value) % 4))
+
+
+def parse_token(token):
+    """
+        Splits a JWT in its header, claims, signing input and signature.
+        Returns None if the token is not a JWT.
+    """
+    parts = str(token).split('.')
+    if len(parts) != 3:
+        return None
+    try:
+        header = json.loads(base64url_decode(parts[0]))
+        claims = json.loads(base64url_decode(parts[1]))
+        signature = base64url_decode(parts[2])
+    except (TypeError, ValueError):
+        return None
+    if not isinstance(header, dict) or not isinstance(claims, dict) or 'alg' not in header:
+        return None
+    return header, claims, '{}.{}'.format(parts[0], parts[1]), signature
+
+
+class WatchedFile(object):
+    """
+        A file parsed again when modified, checked at most
+        every FILE_CHECK_INTERVAL seconds
+    """
+
+    def __init__(self, path, parse):
+        self.path = path
+        self.parse = parse
+        self.mtime = None
+        self.checked = 0
+        self.value = parse(None)
+        self.lock = threading.Lock()
+
+    def get(self):
+        if not self.path or time.time() - self.checked < FILE_CHECK_INTERVAL:
+            return self.value
+        with self.lock:
+            self.checked = time.time()
+            try:
+                mtime = os.path.getmtime(self.path)
+                if mtime != self.mtime:
+                    with open(self.path) as source:
+                        self.value = self.parse(source.read())
+                    self.mtime = mtime
+            except Exception as exc:
+                maxlogger.error('Could not load {}: {}'.format(self.path, exc))
+        return self.value
+
+
+def parse_keys(content):
+    """
+        Returns a dict of kid -> (kind, key), with None as the kid of the key to use
+        for tokens without kid. Keys are either a 'secret' for HS* signatures, or a
+        'public' key, PEM encoded or loaded by PyJWT, for RS* and ES* signatures.
+    """
+    keys = {}
+    if not content:
+        return keys
+
+    try:
+        jwks = json.loads(content)
+    except ValueError:
+        jwks = None
+
+    if isinstance(jwks, dict) and 'keys' in jwks:
+        for jwk in jwks['keys']:
+            key = None
+            if jwk.get('kty') == 'oct':
+                key = ('secret', base64url_decode(jwk['k']))
+            elif pyjwt is not None and jwk.get('kty') in ['RSA', 'EC']:
+                algorithm = get_default_algorithms()['RS256' if jwk['kty'] == 'RSA' else 'ES256']
+                key = ('public', algorithm.from_jwk(json.dumps(jwk)))
+            if key is not None:
+                keys[jwk.get('kid')] = key
+        if len(keys) == 1:
+            keys[None] = keys.values()[0]
+    elif content.strip().startswith('-----BEGIN'):
+        keys[None] = ('public', content.strip())
+    else:
+        keys[None] = ('secret', content.strip())
+    return keys
+
+
+def parse_revocations(content):
+    return set([line.strip() for line in (content or '').splitlines() if line.strip() and not line.startswith('#')])
+
+
+class SignedTokenVerifier(object):
+    """
+        Verifies signed tokens with the configured keys
+    """
+
+    def __init__(self):
+        self.configure({})
+
+    def configure(self, settings):
+        self.keys = WatchedFile(settings.get('max.oauth_jwt_keys'), parse_keys)
+        self.revocations = WatchedFile(settings.get('max.oauth_jwt_revocations'), parse_revocations)
+        self.username_claim = settings.get('max.oauth_jwt_username_claim', 'sub')
+        self.issuer = settings.get('max.oauth_jwt_issuer')
+        self.audience = settings.get('max.oauth_jwt_audience')
+        self.leeway = int(settings.get('max.oauth_jwt_leeway', 0))
+
+    @property
+    def enabled(self):
+        return bool(self.keys.path)
+
+    def verify_signature(self, header, signing_input, signature, token):
+        """
+            Returns True or False if the signature could be verified, None otherwise
+        """
+        kind, key = self.keys.get().get(header.get('kid'), (None, None))
+        if key is None:
+            return None
+
+        # Each key is only used with the algorithms of its kind, so public
+        # keys can't be used as secrets to forge HS* signatures
+        algorithm = header['alg']
+        if algorithm in HMAC_ALGORITHMS and kind == 'secret':
+            expected = hmac.new(key, signing_input, HMAC_ALGORITHMS[algorithm]).digest()
+            return hmac.compare_digest(expected, signature)
+
+        if algorithm in PUBLIC_KEY_ALGORITHMS and kind == 'public' and pyjwt is not None:
+            try:
+                pyjwt.decode(token, key, algorithms=[algorithm], options={'verify_exp': False, 'verify_nbf': False, 'verify_aud': False, 'verify_iat': False})
+            except pyjwt.InvalidSignatureError:
+                return False
+            except pyjwt.InvalidTokenError:
+                return None
+            return True
+        return None
+
+    def verify_claims(self, claims, username, scope):
+        now = time.time()
+        if unicode(claims.get(self.username_claim, '')).lower() != username:
+            return False
+
+        scopes = claims.get('scope', claims.get('scp', []))
+        if isinstance(scopes, basestring):
+            scopes = scopes.split()
+        if scope not in scopes:
+            return False
+
+        if 'exp' in claims and now > claims['exp'] + self.leeway:
+            return False
+        if 'nbf' in claims and now < claims['nbf'] - self.leeway:
+            return False
+
+        if self.issuer and claims.get('iss') != self.issuer:
+            return False
+        if self.audience:
+            audience = claims.get('aud', [])
+            audience = [audience] if isinstance(audience, basestring) else audience
+            if self.audience not in audience:
+                return False
+
+        if claims.get('jti') in self.revocations.get():
+            return False
+        return True
+
+    def verify(self, token, username, scope):
+        """
+            Verifies a token locally. Returns True or False if the token
+            is signed with a known key, or None if it has to be checked remotely.
+        """
+        parsed = parse_token(token)
+        if parsed is None:
+            return None
+        header, claims, signing_input, signature = parsed
+
+        verified = self.verify_signature(header, signing_input, signature, token)
+        if verified is None:
+            return None
+        return verified and self.verify_claims(claims, username, scope)
+
+
+signed_tokens = SignedTokenVerifier()
@@ -2,11 +2,8 @@
 from max.tests import test_default_security
 from max.tests.base import MaxTestApp
 from max.tests.base import MaxTestBase
-from max.tests.base import mock_post
 from max.tests.base import oauth2Header
 
-from functools import partial
-from mock import patch
 from paste.deploy import loadapp
 
 import os
@@ -20,8 +17,7 @@ class FunctionalTests(unittest.TestCase, MaxTestBase):
         self.app = loadapp('config:tests.ini', relative_to=conf_dir)
         self.reset_database(self.app)
         self.app.registry.max_store.security.insert(test_default_security)
-        self.patched_post = patch('requests.post', new=partial(mock_post, self))
-        self.patched_post.start()
+        self.patch_post()
         self.testapp = MaxTestApp(self)
 
     # BEGIN TESTS
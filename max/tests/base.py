@@ -1,10 +1,14 @@
 # -*- coding: utf-8 -*-
+from max.contextcache import context_cache
+from max.security.oauth import token_cache
 from max.tests import test_manager
 from max.utils.dicts import deepcopy
 from max.utils.image import get_avatar_folder
 
 from PIL import Image
+from functools import partial
 from io import BytesIO
+from mock import patch
 from pymongo.cursor import Cursor
 from pymongo.errors import AutoReconnect
 from urllib import urlencode
@@ -276,6 +280,26 @@ class MaxTestBase(object):
         self.app.registry.max_store.drop_collection('security')
         self.app.registry.max_store.drop_collection('tokens')
         self.app.registry.max_store.drop_collection('cloudapis')
+        self.app.registry.max_store.drop_collection('timelines')
+        self.app.registry.max_store.drop_collection('outbox')
+        self.app.registry.max_store.drop_collection('jobs')
+        self.app.registry.max_store.drop_collection('cache_versions')
+        self.app.registry.max_store.drop_collection('activity_keys')
+        context_cache.clear()
+        token_cache.clear()
+        self.app.registry.max_security_refresher.reset()
+
+    def patch_post(self):
+        """
+            Mocks the posts made with requests, either directly or through a session
+            as the oauth token checks do, and clears the token checks cached by
+            previous tests. The patches are stopped when the test ends.
+        """
+        token_cache.clear()
+        for target in ['requests.post', 'requests.Session.post']:
+            patched = patch(target, new=partial(mock_post, self))
+            patched.start()
+            self.addCleanup(patched.stop)
 
     def assertFileExists(self, path):
         self.assertTrue(os.path.exists(path))
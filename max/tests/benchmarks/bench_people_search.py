@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+    Compares the old case insensitive regex people search with the anchored
+    word prefix lookup on the people search index, on a synthetic directory
+    of 200k users. The endpoint time includes all the relevance tiers.
+
+    Run with:
+
+        python -m max.tests.benchmarks.bench_people_search
+
+    against the mongodb configured in max/tests/tests.ini, that will be reset.
+"""
+from max.peoplesearch import search_field
+from max.peoplesearch import word_prefix_query
+from max.tests import test_default_security
+from max.tests import test_manager
+from max.tests.base import MaxTestApp
+from max.tests.base import MaxTestBase
+from max.tests.base import oauth2Header
+
+from paste.deploy import loadapp
+
+import os
+import random
+import time
+import unittest
+
+USERS = 200000
+INSERT_BATCH_SIZE = 5000
+SEARCHES = ['ma', 'mar', 'garc', 'jordi.p', u'núñez', 'xyz']
+REPETITIONS = 10
+FIRST_NAMES = [u'maria', u'marc', u'jordi', u'anna', u'joan', u'laura', u'pere', u'marta', u'josep', u'núria', u'àlex', u'carles']
+LAST_NAMES = [u'garcia', u'martínez', u'puig', u'ferrer', u'soler', u'vila', u'núñez', u'roca', u'serra', u'pons', u'font', u'sala']
+
+
+def synthetic_user(index):
+    first = random.choice(FIRST_NAMES)
+    last = random.choice(LAST_NAMES)
+    user = {
+        'username': u'{}.{}{}'.format(first, last, index),
+        'displayName': u'{} {}'.format(first.capitalize(), last.capitalize()),
+        'objectType': 'person',
+        'subscribedTo': [],
+        'talkingIn': [],
+        'following': []
+    }
+    user['_owner'] = user['_creator'] = user['username']
+    user['_search'] = search_field(user)
+    return user
+
+
+class PeopleSearchBenchmark(unittest.TestCase, MaxTestBase):
+
+    def setUp(self):
+        conf_dir = os.path.join(os.path.dirname(__file__), '..')
+        self.app = loadapp('config:tests.ini', relative_to=conf_dir)
+        self.reset_database(self.app)
+        self.app.registry.max_store.security.insert(test_default_security)
+        self.patch_post()
+        self.testapp = MaxTestApp(self)
+
+        self.create_user(test_manager)
+
+    def populate(self):
+        from max.indexes import ensure_indexes
+        users = self.app.registry.max_store.users
+        random.seed(0)
+        for start in range(0, USERS, INSERT_BATCH_SIZE):
+            users.insert([synthetic_user(index) for index in range(start, min(start + INSERT_BATCH_SIZE, USERS))])
+        ensure_indexes(self.app.registry.max_store)
+
+    def time_query(self, query, limit=10):
+        """
+            Returns the average time in milliseconds to get a page of users,
+            and the documents examined to get it
+        """
+        users = self.app.registry.max_store.users
+        cursor = users.find(query, {'username': 1, 'displayName': 1}).sort('username', -1).limit(limit)
+        scanned = cursor.explain().get('nscannedObjects', None)
+        started = time.time()
+        for repetition in range(REPETITIONS):
+            list(users.find(query, {'username': 1, 'displayName': 1}).sort('username', -1).limit(limit))
+        return (time.time() - started) * 1000 / REPETITIONS, scanned
+
+    def time_endpoint(self, search):
+        started = time.time()
+        for repetition in range(REPETITIONS):
+            self.testapp.get('/people', {'username': search.encode('utf-8')}, oauth2Header(test_manager), status=200)
+        return (time.time() - started) * 1000 / REPETITIONS
+
+    def bench_people_search(self):
+        self.populate()
+
+        print '{:>10} {:>10} {:>10} {:>10} {:>10} {:>8} {:>12}'.format('search', 'regex ms', 'scanned', 'index ms', 'scanned', 'speedup', 'endpoint ms')
+        for search in SEARCHES:
+            regex_query = {'$or': [
+                {'username': {'$regex': search, '$options': 'i'}},
+                {'displayName': {'$regex': search, '$options': 'i'}}
+            ]}
+            regex_time, regex_scanned = self.time_query(regex_query)
+            index_time, index_scanned = self.time_query(word_prefix_query(search))
+            print u'{:>10} {:>10.2f} {:>10} {:>10.2f} {:>10} {:>7.2f}x {:>12.2f}'.format(
+                search, regex_time, regex_scanned, index_time, index_scanned, regex_time / index_time, self.time_endpoint(search))
+
+
+def main():
+    benchmark = PeopleSearchBenchmark('bench_people_search')
+    benchmark.setUp()
+    try:
+        benchmark.bench_people_search()
+    finally:
+        benchmark.tearDown()
+
+
+if __name__ == '__main__':
+    main()
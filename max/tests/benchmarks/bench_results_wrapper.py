@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+    Compares the per-item and the bulk page wrapping of flattened results.
+
+    Run with:
+
+        python -m max.tests.benchmarks.bench_results_wrapper
+
+    against the mongodb configured in max/tests/tests.ini, that will be reset.
+"""
+from max.tests import test_default_security
+from max.tests import test_manager
+from max.tests.base import MaxTestApp
+from max.tests.base import MaxTestBase
+from max.tests.base import oauth2Header
+
+from paste.deploy import loadapp
+
+import os
+import time
+import unittest
+
+ACTIVITIES = 200
+LIMITS = [10, 50, 200]
+REPETITIONS = 20
+
+
+class ResultsWrapperBenchmark(unittest.TestCase, MaxTestBase):
+
+    def setUp(self):
+        conf_dir = os.path.join(os.path.dirname(__file__), '..')
+        self.app = loadapp('config:tests.ini', relative_to=conf_dir)
+        self.reset_database(self.app)
+        self.app.registry.max_store.security.insert(test_default_security)
+        self.patch_post()
+        self.testapp = MaxTestApp(self)
+
+        self.create_user(test_manager)
+
+    def time_timeline(self, username, limit):
+        """
+            Returns the average time in milliseconds to get a timeline page
+        """
+        url = '/people/%s/timeline?limit=%d' % (username, limit)
+        started = time.time()
+        for repetition in range(REPETITIONS):
+            self.testapp.get(url, "", oauth2Header(username), status=200)
+        return (time.time() - started) * 1000 / REPETITIONS
+
+    def bench_results_wrapper(self):
+        from max.MADMax import ResultsWrapper
+        from max.tests.mockers import user_status
+        username = 'messi'
+        self.create_user(username)
+        for index in range(ACTIVITIES):
+            self.create_activity(username, user_status, note=str(index))
+
+        print '{:>6} {:>12} {:>12} {:>8}'.format('limit', 'per item ms', 'bulk ms', 'speedup')
+        for limit in LIMITS:
+            ResultsWrapper.bulk_wrapping = False
+            per_item = self.time_timeline(username, limit)
+            ResultsWrapper.bulk_wrapping = True
+            bulk = self.time_timeline(username, limit)
+            print '{:>6} {:>12.2f} {:>12.2f} {:>7.2f}x'.format(limit, per_item, bulk, per_item / bulk)
+
+
+def main():
+    benchmark = ResultsWrapperBenchmark('bench_results_wrapper')
+    benchmark.setUp()
+    try:
+        benchmark.bench_results_wrapper()
+    finally:
+        benchmark.tearDown()
+
+
+if __name__ == '__main__':
+    main()
@@ -36,6 +36,8 @@ class myPyramidLayer(Layer):
         self.app.registry.max_store.security.insert(test_default_security)
         self.patched_post = patch('requests.post', new=partial(mock_post, self))
         self.patched_post.start()
+        self.patched_session_post = patch('requests.Session.post', new=partial(mock_post, self))
+        self.patched_session_post.start()
         self.server = http.StopableWSGIServer.create(self.app, port=9090)
         os.environ['APP_PORT'] = '9090'
 
@@ -4,12 +4,9 @@ from max.tests import test_manager
 from max.tests.base import MaxTestApp
 from max.tests.base import MaxTestBase
 from max.tests.base import MaxAvatarsTestBase
-from max.tests.base import mock_post
 from max.tests.base import oauth2Header
 
 from max.tests.test_avatars import http_mock_twitter_user_image
-from functools import partial
-from mock import patch
 from paste.deploy import loadapp
 
 import json
@@ -30,8 +27,7 @@ class AvatarsACLTests(unittest.TestCase, MaxTestBase, MaxAvatarsTestBase):
         self.app.registry.max_store.drop_collection('conversations')
         self.app.registry.max_store.drop_collection('messages')
         self.app.registry.max_store.security.insert(test_default_security)
-        self.patched_post = patch('requests.post', new=partial(mock_post, self))
-        self.patched_post.start()
+        self.patch_post()
         self.testapp = MaxTestApp(self)
 
         self.create_user(test_manager)
@@ -42,7 +38,6 @@ class AvatarsACLTests(unittest.TestCase, MaxTestBase, MaxAvatarsTestBase):
         """
             Deletes test avatar folder with all test images
         """
-        self.patched_post.stop()
         MaxAvatarsTestBase.tearDown(self)
 
     # Add person avatar tests
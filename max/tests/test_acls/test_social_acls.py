@@ -3,11 +3,8 @@ from max.tests import test_default_security
 from max.tests import test_manager, test_manager2
 from max.tests.base import MaxTestApp
 from max.tests.base import MaxTestBase
-from max.tests.base import mock_post
 from max.tests.base import oauth2Header
 from max.tests.base import impersonate_payload
-from functools import partial
-from mock import patch
 from paste.deploy import loadapp
 
 import json
@@ -28,8 +25,7 @@ class ConversationsACLTests(unittest.TestCase, MaxTestBase):
         self.app.registry.max_store.drop_collection('conversations')
         self.app.registry.max_store.drop_collection('messages')
         self.app.registry.max_store.security.insert(test_default_security)
-        self.patched_post = patch('requests.post', new=partial(mock_post, self))
-        self.patched_post.start()
+        self.patch_post()
         self.testapp = MaxTestApp(self)
 
         self.create_user(test_manager)
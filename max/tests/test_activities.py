@@ -3,11 +3,9 @@ from max.tests import test_default_security
 from max.tests import test_manager
 from max.tests.base import MaxTestApp
 from max.tests.base import MaxTestBase
-from max.tests.base import mock_post
 from max.tests.base import oauth2Header
 
 from max.utils.dicts import deepcopy
-from functools import partial
 from mock import patch
 from paste.deploy import loadapp
 
@@ -23,8 +21,7 @@ class FunctionalTests(unittest.TestCase, MaxTestBase):
         self.app = loadapp('config:tests.ini', relative_to=conf_dir)
         self.reset_database(self.app)
         self.app.registry.max_store.security.insert(test_default_security)
-        self.patched_post = patch('requests.post', new=partial(mock_post, self))
-        self.patched_post.start()
+        self.patch_post()
         self.testapp = MaxTestApp(self)
 
         self.create_user(test_manager)
@@ -200,6 +197,64 @@ class FunctionalTests(unittest.TestCase, MaxTestBase):
         self.testapp.post('/people/%s/activities' % username, json.dumps(activity), oauth2Header(test_manager), status=201)
         self.testapp.post('/people/%s/activities' % username, json.dumps(activity), oauth2Header(test_manager), status=200)
 
+    def test_create_activity_with_idempotency_key(self):
+        """
+            Given a plain user
+            When I post an activity with an idempotency key
+            And I retry the post with the same key
+            Then the activity is posted only once
+            And the retry returns the original activity
+        """
+        from .mockers import user_status as activity
+        username = 'messi'
+        self.create_user(username)
+        headers = oauth2Header(username)
+        headers['Idempotency-Key'] = 'retry-1'
+        res = self.testapp.post('/people/%s/activities' % username, json.dumps(activity), headers, status=201)
+        original_id = res.json['id']
+
+        retried_activity = deepcopy(activity)
+        retried_activity['object']['content'] = 'Edited before retrying'
+        res = self.testapp.post('/people/%s/activities' % username, json.dumps(retried_activity), headers, status=200)
+        self.assertEqual(res.json['id'], original_id)
+
+        headers['Idempotency-Key'] = 'retry-2'
+        self.testapp.post('/people/%s/activities' % username, json.dumps(retried_activity), headers, status=201)
+
+        stored = self.exec_mongo_query('activity', 'find', {'actor.username': username})
+        self.assertEqual(len(stored), 2)
+        self.assertEqual(str(stored[0]['lastComment']), str(stored[0]['_id']))
+
+    def test_create_activity_with_idempotency_key_being_created(self):
+        """
+            Given a plain user
+            And an activity with an idempotency key still being created
+            When I retry the post with the same key
+            Then I get a conflict
+            And no activity is created
+        """
+        from .mockers import user_status as activity
+        from max.idempotency import hash_parts
+        from bson import ObjectId
+        from datetime import datetime
+        from datetime import timedelta
+
+        username = 'messi'
+        self.create_user(username)
+        self.app.registry.max_store.activity_keys.insert({
+            '_id': 'key:' + hash_parts(username, 'retry-1'),
+            'activity': ObjectId(),
+            'expires': datetime.utcnow() + timedelta(seconds=60),
+            'pending': True
+        })
+        headers = oauth2Header(username)
+        headers['Idempotency-Key'] = 'retry-1'
+        res = self.testapp.post('/people/%s/activities' % username, json.dumps(activity), headers, status=409)
+        self.assertEqual(res.json['error'], 'ActivityPending')
+
+        stored = self.exec_mongo_query('activity', 'find', {'actor.username': username})
+        self.assertEqual(len(stored), 0)
+
     def test_create_activity_on_context_check_duplicate_activity(self):
         """
             Given a admin user
@@ -531,6 +586,63 @@ class FunctionalTests(unittest.TestCase, MaxTestBase):
         self.assertEqual(len(res.json), 1)
         self.assertNotIn('_keywords', res.json[0]['object'])
 
+    def test_get_timeline_bulk_wrapping(self):
+        """
+            Given a user with own and other users activities in his timeline
+            When I get the timeline wrapping results one by one and in bulk
+            Then both results are the same
+        """
+        from max.MADMax import ResultsWrapper
+        from .mockers import user_status, user_status_context
+        from .mockers import create_context, subscribe_context
+        username = 'messi'
+        username_not_me = 'xavi'
+        self.create_user(username)
+        self.create_user(username_not_me)
+        self.create_context(create_context)
+        self.admin_subscribe_user_to_context(username, subscribe_context)
+        self.admin_subscribe_user_to_context(username_not_me, subscribe_context)
+        self.create_activity(username, user_status)
+        self.create_activity(username_not_me, user_status_context)
+        self.create_activity(username, user_status_context)
+
+        for url in ['/people/%s/timeline' % username, '/people/%s/timeline?limit=1' % username]:
+            ResultsWrapper.bulk_wrapping = False
+            try:
+                per_item = self.testapp.get(url, "", oauth2Header(username), status=200)
+            finally:
+                ResultsWrapper.bulk_wrapping = True
+            bulk = self.testapp.get(url, "", oauth2Header(username), status=200)
+
+            self.assertEqual(per_item.json, bulk.json)
+            self.assertEqual(per_item.headers.get('X-Has-Remaining-Items'), bulk.headers.get('X-Has-Remaining-Items'))
+
+    def test_get_timeline_field_permissions_shared(self):
+        """
+            Given a user with several activities in his timeline
+            When I get the timeline
+            Then the fields permissions are evaluated once for all the activities
+        """
+        from pyramid.request import Request
+        from .mockers import user_status
+        username = 'messi'
+        self.create_user(username)
+        for index in range(10):
+            self.create_activity(username, user_status, note=str(index))
+
+        evaluated = []
+        original_has_permission = Request.has_permission
+
+        def has_permission(request, permission, context=None):
+            evaluated.append(permission)
+            return original_has_permission(request, permission, context)
+
+        with patch.object(Request, 'has_permission', has_permission):
+            res = self.testapp.get('/people/%s/timeline' % username, "", oauth2Header(username), status=200)
+
+        self.assertEqual(len(res.json), 10)
+        self.assertLess(len(evaluated), 10)
+
     def test_get_generated_activities_from_another_user(self):
         """
             Given a plain user
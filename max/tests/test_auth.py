@@ -3,10 +3,8 @@ from max.tests import test_default_security
 from max.tests import test_manager
 from max.tests.base import MaxTestApp
 from max.tests.base import MaxTestBase
-from max.tests.base import mock_post
 from max.tests.base import oauth2Header
 
-from functools import partial
 from mock import patch
 from paste.deploy import loadapp
 
@@ -22,8 +20,7 @@ class FunctionalTests(unittest.TestCase, MaxTestBase):
         self.app = loadapp('config:tests.ini', relative_to=conf_dir)
         self.reset_database(self.app)
         self.app.registry.max_store.security.insert(test_default_security)
-        self.patched_post = patch('requests.post', new=partial(mock_post, self))
-        self.patched_post.start()
+        self.patch_post()
         self.testapp = MaxTestApp(self)
 
         self.create_user(test_manager)
@@ -45,6 +42,104 @@ class FunctionalTests(unittest.TestCase, MaxTestBase):
         res = self.testapp.put('/contexts/%s' % url_hash, json.dumps({"twitterHashtag": "assignatura1"}), oauth2Header(mindundi, token='bad token'), status=401)
         self.assertEqual(res.json['error_description'], 'Invalid token.')
 
+    def test_token_checks_cached(self):
+        """
+            Given a valid and an invalid token already checked
+            When they're used again
+            Then the oauth server is not asked again
+        """
+        username = 'messi'
+        self.create_user(username)
+        self.testapp.get('/people/%s' % username, "", oauth2Header(username), status=200)
+        self.testapp.get('/people/%s' % username, "", oauth2Header(username, token='bad token'), status=401)
+
+        with patch('requests.Session.post') as oauth_post:
+            self.testapp.get('/people/%s' % username, "", oauth2Header(username), status=200)
+            self.testapp.get('/people/%s' % username, "", oauth2Header(username, token='bad token'), status=401)
+        self.assertFalse(oauth_post.called)
+
+        res = self.testapp.get('/admin/maintenance/oauth', "", oauth2Header(test_manager), status=200)
+        self.assertGreaterEqual(res.json['hits'], 2)
+        self.assertGreaterEqual(res.json['negative_hits'], 1)
+        self.assertGreaterEqual(res.json['misses'], 2)
+
+    def test_concurrent_token_checks_collapsed(self):
+        """
+            Given a token not yet checked
+            When several requests check it at the same time
+            Then the oauth server is asked only once
+        """
+        from max.security.oauth import TokenCache
+        import threading
+        import time
+
+        calls = []
+
+        def request_check(url, username, token, scope):
+            calls.append(token)
+            time.sleep(0.2)
+            return True
+
+        cache = TokenCache()
+        cache.request_check = request_check
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.check('url', 'messi', 'token', 'widgetcli'))) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, [True] * 5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(cache.report()['misses'], 1)
+
+    def test_signed_tokens_verified_offline(self):
+        """
+            Given a max configured with the key of the signed tokens
+            When a user uses valid, expired and revoked signed tokens
+            Then they're validated without asking the oauth server
+        """
+        from max.security.signedtokens import signed_tokens
+        import base64
+        import hashlib
+        import hmac
+        import tempfile
+        import time
+
+        def encode(data):
+            return base64.urlsafe_b64encode(json.dumps(data)).rstrip('=')
+
+        def signed_token(**claims):
+            claims.setdefault('sub', username)
+            claims.setdefault('scope', 'widgetcli')
+            signing_input = '{}.{}'.format(encode({'alg': 'HS256', 'typ': 'JWT'}), encode(claims))
+            signature = hmac.new('secret', signing_input, hashlib.sha256).digest()
+            return '{}.{}'.format(signing_input, base64.urlsafe_b64encode(signature).rstrip('='))
+
+        username = 'messi'
+        self.create_user(username)
+        keys = tempfile.NamedTemporaryFile()
+        keys.write('secret')
+        keys.flush()
+        revocations = tempfile.NamedTemporaryFile()
+        revocations.write('revoked-token\n')
+        revocations.flush()
+
+        signed_tokens.configure({'max.oauth_jwt_keys': keys.name, 'max.oauth_jwt_revocations': revocations.name})
+        try:
+            with patch('requests.Session.post') as oauth_post:
+                self.testapp.get('/people/%s' % username, "", oauth2Header(username, token=signed_token(exp=time.time() + 60)), status=200)
+                self.testapp.get('/people/%s' % username, "", oauth2Header(username, token=signed_token(exp=time.time() - 60)), status=401)
+                self.testapp.get('/people/%s' % username, "", oauth2Header(username, token=signed_token(jti='revoked-token')), status=401)
+                self.testapp.get('/people/%s' % username, "", oauth2Header(username, token=signed_token(sub='xavi')), status=401)
+                self.testapp.get('/people/%s' % username, "", oauth2Header(username, token=signed_token(scope='other')), status=401)
+            self.assertFalse(oauth_post.called)
+
+            # Opaque tokens are still checked by the oauth server
+            self.testapp.get('/people/%s' % username, "", oauth2Header(username), status=200)
+        finally:
+            signed_tokens.configure({})
+
     def test_invalid_scope(self):
         username = 'messi'
         headers = oauth2Header(test_manager)
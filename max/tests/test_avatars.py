@@ -7,7 +7,6 @@ from max.tests.base import MaxTestApp
 from max.tests.base import MaxTestBase
 from max.tests.base import MockTweepyAPI
 from max.tests.base import mock_get
-from max.tests.base import mock_post
 from max.tests.base import oauth2Header
 from max.tests.base import http_mock_twitter_user_image
 from max.utils.image import get_avatar_folder
@@ -148,8 +147,7 @@ class AvatarTests(unittest.TestCase, MaxTestBase, MaxAvatarsTestBase):
         self.reset_database(self.app)
         self.app.registry.max_store.security.insert(test_default_security)
         self.app.registry.max_store.cloudapis.insert(test_cloudapis)
-        self.patched_post = patch('requests.post', new=partial(mock_post, self))
-        self.patched_post.start()
+        self.patch_post()
         self.patched_get = patch('requests.get', new=partial(mock_get, self))
         self.patched_get.start()
 
@@ -162,7 +160,6 @@ class AvatarTests(unittest.TestCase, MaxTestBase, MaxAvatarsTestBase):
         """
             Deletes test avatar folder with all test images
         """
-        self.patched_post.stop()
         self.patched_get.stop()
         MaxAvatarsTestBase.tearDown(self)
 
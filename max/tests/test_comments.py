@@ -3,11 +3,9 @@ from max.tests import test_default_security
 from max.tests import test_manager
 from max.tests.base import MaxTestApp
 from max.tests.base import MaxTestBase
-from max.tests.base import mock_post
 from max.tests.base import oauth2Header
 
 from max.utils.dicts import deepcopy
-from functools import partial
 from mock import patch
 from paste.deploy import loadapp
 
@@ -23,8 +21,7 @@ class FunctionalTests(unittest.TestCase, MaxTestBase):
         self.app = loadapp('config:tests.ini', relative_to=conf_dir)
         self.reset_database(self.app)
         self.app.registry.max_store.security.insert(test_default_security)
-        self.patched_post = patch('requests.post', new=partial(mock_post, self))
-        self.patched_post.start()
+        self.patch_post()
         self.testapp = MaxTestApp(self)
 
         self.create_user(test_manager)
@@ -169,3 +166,117 @@ class FunctionalTests(unittest.TestCase, MaxTestBase):
         res = self.testapp.post('/activities/%s/comments' % str(activity.get('id')), json.dumps(user_comment), oauth2Header(username_not_me), status=201)
         comment_id = res.json['id']
         res = self.testapp.delete('/activities/%s/comments/%s' % (str(activity.get('id')), comment_id), '', oauth2Header(username), status=403)
+
+    def test_get_comments_paged(self):
+        """
+            Given a plain user
+            When i comment an activity many times
+            Then i get the comments paged from the newest ones, older first on each page
+        """
+        from .mockers import user_status, user_comment
+        username = 'messi'
+        self.create_user(username)
+        activity = self.create_activity(username, user_status).json
+        comment_ids = []
+        for index in range(7):
+            comment = deepcopy(user_comment)
+            comment['object']['content'] += ' {}'.format(index)
+            res = self.testapp.post('/activities/%s/comments' % str(activity.get('id')), json.dumps(comment), oauth2Header(username), status=201)
+            comment_ids.append(res.json['id'])
+
+        res = self.testapp.get('/activities/%s/comments?limit=3' % str(activity.get('id')), "", oauth2Header(username), status=200)
+        self.assertEqual([reply['id'] for reply in res.json], comment_ids[4:7])
+        self.assertEqual(res.headers.get('X-Has-Remaining-Items'), '1')
+
+        res = self.testapp.get('/activities/%s/comments?limit=3&before=%s' % (str(activity.get('id')), comment_ids[4]), "", oauth2Header(username), status=200)
+        self.assertEqual([reply['id'] for reply in res.json], comment_ids[1:4])
+        self.assertTrue(res.json[0]['deletable'])
+
+        res = self.testapp.get('/activities/%s/comments?limit=3&before=%s' % (str(activity.get('id')), comment_ids[1]), "", oauth2Header(username), status=200)
+        self.assertEqual([reply['id'] for reply in res.json], comment_ids[0:1])
+        self.assertNotIn('X-Has-Remaining-Items', res.headers)
+
+    def test_activity_keeps_last_replies(self):
+        """
+            Given a plain user
+            When i comment an activity more times than the replies kept on it
+            Then the activity has only the last comments, and the count of all of them
+        """
+        from max.models.activity import REPLIES_PREVIEW_SIZE
+        from .mockers import user_status, user_comment
+        username = 'messi'
+        self.create_user(username)
+        activity = self.create_activity(username, user_status).json
+        comment_ids = []
+        for index in range(REPLIES_PREVIEW_SIZE + 2):
+            comment = deepcopy(user_comment)
+            comment['object']['content'] += ' {}'.format(index)
+            res = self.testapp.post('/activities/%s/comments' % str(activity.get('id')), json.dumps(comment), oauth2Header(username), status=201)
+            comment_ids.append(res.json['id'])
+
+        res = self.testapp.get('/activities/%s' % str(activity.get('id')), "", oauth2Header(username), status=200)
+        self.assertEqual(res.json['repliesCount'], REPLIES_PREVIEW_SIZE + 2)
+        self.assertEqual([reply['id'] for reply in res.json['replies']], comment_ids[2:])
+        self.assertEqual(res.json['lastComment'], comment_ids[-1])
+
+    def test_delete_comment_not_in_last_replies(self):
+        """
+            Given a plain user
+            When i delete an old comment of an activity, not kept on its replies
+            Then the comment is deleted and the activity replies are kept
+        """
+        from max.models.activity import REPLIES_PREVIEW_SIZE
+        from .mockers import user_status, user_comment
+        username = 'messi'
+        self.create_user(username)
+        activity = self.create_activity(username, user_status).json
+        comment_ids = []
+        for index in range(REPLIES_PREVIEW_SIZE + 2):
+            comment = deepcopy(user_comment)
+            comment['object']['content'] += ' {}'.format(index)
+            res = self.testapp.post('/activities/%s/comments' % str(activity.get('id')), json.dumps(comment), oauth2Header(username), status=201)
+            comment_ids.append(res.json['id'])
+
+        self.testapp.delete('/activities/%s/comments/%s' % (str(activity.get('id')), comment_ids[0]), '', oauth2Header(username), status=204)
+        self.testapp.delete('/activities/%s/comments/%s' % (str(activity.get('id')), comment_ids[0]), '', oauth2Header(username), status=404)
+
+        res = self.testapp.get('/activities/%s' % str(activity.get('id')), "", oauth2Header(username), status=200)
+        self.assertEqual(res.json['repliesCount'], REPLIES_PREVIEW_SIZE + 1)
+        self.assertEqual([reply['id'] for reply in res.json['replies']], comment_ids[2:])
+
+        res = self.testapp.get('/activities/%s/comments?limit=0' % str(activity.get('id')), "", oauth2Header(username), status=200)
+        self.assertEqual([reply['id'] for reply in res.json], comment_ids[1:])
+
+    def test_delete_comment_while_commenting(self):
+        """
+            Given a plain user
+            When i delete a comment of an activity while another comment is added
+            Then the activity replies keep the added comment
+        """
+        from max.models import activity as activity_module
+        from .mockers import user_status, user_comment
+        username = 'messi'
+        self.create_user(username)
+        activity = self.create_activity(username, user_status).json
+        comment_ids = []
+        for index in range(2):
+            res = self.testapp.post('/activities/%s/comments' % str(activity.get('id')), json.dumps(user_comment), oauth2Header(username), status=201)
+            comment_ids.append(res.json['id'])
+
+        added = []
+        original_comment_from_activity = activity_module.comment_from_activity
+
+        def comment_from_activity(*args, **kwargs):
+            if not added:
+                added.append(None)
+                res = self.testapp.post('/activities/%s/comments' % str(activity.get('id')), json.dumps(user_comment), oauth2Header(username), status=201)
+                comment_ids.append(res.json['id'])
+            return original_comment_from_activity(*args, **kwargs)
+
+        with patch.object(activity_module, 'comment_from_activity', comment_from_activity):
+            self.testapp.delete('/activities/%s/comments/%s' % (str(activity.get('id')), comment_ids[0]), '', oauth2Header(username), status=204)
+
+        res = self.testapp.get('/activities/%s' % str(activity.get('id')), "", oauth2Header(username), status=200)
+        self.assertEqual(res.json['repliesCount'], 2)
+        self.assertEqual([reply['id'] for reply in res.json['replies']], comment_ids[1:])
+        self.assertEqual(res.json['lastComment'], comment_ids[-1])
@@ -4,10 +4,8 @@ from max.tests import test_manager
 from max.tests.base import MaxTestApp
 from max.tests.base import MaxTestBase
 from max.tests.base import MockTweepyAPI
-from max.tests.base import mock_post
 from max.tests.base import oauth2Header
 
-from functools import partial
 from mock import patch
 from paste.deploy import loadapp
 
@@ -24,8 +22,7 @@ class FunctionalTests(unittest.TestCase, MaxTestBase):
         self.app = loadapp('config:tests.ini', relative_to=conf_dir)
         self.reset_database(self.app)
         self.app.registry.max_store.security.insert(test_default_security)
-        self.patched_post = patch('requests.post', new=partial(mock_post, self))
-        self.patched_post.start()
+        self.patch_post()
         self.testapp = MaxTestApp(self)
 
         self.create_user(test_manager)
@@ -307,6 +304,85 @@ class FunctionalTests(unittest.TestCase, MaxTestBase):
         res = self.testapp.get('/people/%s/subscriptions' % username, '', oauth2Header(username), status=200)
         self.assertEqual(res.json[0]['displayName'], 'New Name')
 
+    def test_modify_context_permissions_updates_subscriptions(self):
+        """
+            Given two users subscribed to a context, one of them with a permanent grant
+            When the context permissions change
+            Then both subscriptions get the new defaults and the granted permission is kept
+        """
+        from hashlib import sha1
+        from .mockers import create_context_private_r, subscribe_context
+
+        self.create_user('messi')
+        self.create_user('xavi')
+        self.create_context(create_context_private_r)
+        self.admin_subscribe_user_to_context('messi', subscribe_context)
+        self.admin_subscribe_user_to_context('xavi', subscribe_context)
+        chash = sha1(create_context_private_r['url']).hexdigest()
+        self.testapp.put('/contexts/%s/permissions/%s/%s' % (chash, 'messi', 'write'), "", oauth2Header(test_manager), status=201)
+
+        permissions = dict(create_context_private_r['permissions'], invite='subscribed')
+        self.testapp.put('/contexts/%s' % chash, json.dumps({"permissions": permissions}), oauth2Header(test_manager), status=200)
+
+        res = self.testapp.get('/people/%s/subscriptions' % 'messi', '', oauth2Header('messi'), status=200)
+        self.assertItemsEqual(res.json[0]['permissions'], ['read', 'write', 'invite'])
+        res = self.testapp.get('/people/%s/subscriptions' % 'xavi', '', oauth2Header('xavi'), status=200)
+        self.assertItemsEqual(res.json[0]['permissions'], ['read', 'invite'])
+
+    def test_modify_context_url_and_permissions_updates_subscriptions(self):
+        """
+            Given a user subscribed to a context
+            When the context url and permissions change at once
+            Then the subscription gets the new url, hash and permissions
+            And the user subscribe activity points to the new url
+        """
+        from hashlib import sha1
+        from .mockers import create_context_private_r, subscribe_context
+
+        username = 'messi'
+        self.create_user(username)
+        self.create_context(create_context_private_r)
+        self.admin_subscribe_user_to_context(username, subscribe_context)
+        chash = sha1(create_context_private_r['url']).hexdigest()
+
+        new_url = 'http://new.url'
+        new_hash = sha1(new_url).hexdigest()
+        permissions = dict(create_context_private_r['permissions'], invite='subscribed')
+        self.testapp.put('/contexts/%s' % chash, json.dumps({"url": new_url, "permissions": permissions}), oauth2Header(test_manager), status=200)
+
+        res = self.testapp.get('/people/%s/subscriptions' % username, '', oauth2Header(username), status=200)
+        self.assertEqual(res.json[0]['url'], new_url)
+        self.assertEqual(res.json[0]['hash'], new_hash)
+        self.assertItemsEqual(res.json[0]['permissions'], ['read', 'invite'])
+
+        activities = self.exec_mongo_query('activity', 'find', {'verb': 'subscribe', 'actor.username': username})
+        self.assertEqual([activity['object']['url'] for activity in activities], [new_url])
+
+    def test_context_cache_invalidated_on_modify(self):
+        """
+            Given a max with the context cache enabled
+            And a public context listed by a user not subscribed to it
+            When the context read policy changes
+            Then the cached public contexts are discarded
+        """
+        from hashlib import sha1
+        from max.contextcache import context_cache
+        from .mockers import create_context
+
+        self.app.registry.max_settings['max_context_cache'] = 'true'
+        self.create_user('xavi')
+        self.create_context(create_context)
+        chash = sha1(create_context['url']).hexdigest()
+
+        self.testapp.get('/contexts/%s/activities' % chash, '', oauth2Header('xavi'), status=200)
+        self.assertIn(chash, context_cache.policies.get('read'))
+
+        self.modify_context(create_context['url'], {"permissions": {"read": "subscribed"}})
+
+        self.assertIsNone(context_cache.policies.get('read'))
+        self.assertNotIn(chash, context_cache.public_contexts(self.app.registry.max_store, 'read'))
+        self.assertGreater(self.app.registry.max_store.cache_versions.find_one({'_id': 'contexts'})['version'], 1)
+
     def test_modify_context_unsetting_property(self):
         from hashlib import sha1
         from .mockers import create_context
@@ -321,6 +397,28 @@ class FunctionalTests(unittest.TestCase, MaxTestBase):
         self.assertEqual(result.get('twitterUsername', None), None)
         self.assertEqual(result.get('twitterUsernameId', None), None)
 
+    def test_modify_context_updates_changed_fields_only(self):
+        from hashlib import sha1
+        from .mockers import create_context
+        from pymongo.collection import Collection
+
+        self.create_context(create_context)
+        url_hash = sha1(create_context['url']).hexdigest()
+        self.modify_context(create_context['url'], {"twitterHashtag": "assignatura1"})
+
+        updates = []
+        collection_update = Collection.update
+
+        def recording_update(collection, spec, document, *args, **kwargs):
+            if collection.name == 'contexts':
+                updates.append(document)
+            return collection_update(collection, spec, document, *args, **kwargs)
+
+        with patch.object(Collection, 'update', recording_update):
+            self.testapp.put('/contexts/%s' % url_hash, json.dumps({"twitterHashtag": "", "displayName": "Renamed"}), oauth2Header(test_manager), status=200)
+
+        self.assertIn({'$set': {'displayName': 'Renamed'}, '$unset': {'twitterHashtag': ''}}, updates)
+
     def test_delete_context(self):
         """ doctest .. http:delete:: /contexts/{hash} """
         from hashlib import sha1
@@ -3,11 +3,9 @@ from max.tests import test_default_security
 from max.tests import test_manager
 from max.tests.base import MaxTestApp
 from max.tests.base import MaxTestBase
-from max.tests.base import mock_post
 from max.tests.base import oauth2Header
 
-from functools import partial
-from mock import patch
+from bson import ObjectId
 from paste.deploy import loadapp
 
 import datetime
@@ -23,8 +21,7 @@ class FunctionalTests(unittest.TestCase, MaxTestBase):
         self.app = loadapp('config:tests.ini', relative_to=conf_dir)
         self.reset_database(self.app)
         self.app.registry.max_store.security.insert(test_default_security)
-        self.patched_post = patch('requests.post', new=partial(mock_post, self))
-        self.patched_post.start()
+        self.patch_post()
         self.testapp = MaxTestApp(self)
 
         self.create_user(test_manager)
@@ -316,6 +313,37 @@ class FunctionalTests(unittest.TestCase, MaxTestBase):
         self.assertEqual(len(result), 1)
         self.assertEqual(result[0].get("objectType", ""), "conversation")
 
+    def test_get_conversations_sorted_by_last_message(self):
+        """
+            Given a user with two conversations
+            When a message is posted to the oldest one
+            Then both the conversations list and the user info list it first
+        """
+        from .mockers import message, message_s, message3
+        sender = 'messi'
+        self.create_user(sender)
+        self.create_user('xavi')
+        self.create_user('shakira')
+
+        res = self.testapp.post('/conversations', json.dumps(message), oauth2Header(sender), status=201)
+        first_cid = str(res.json['contexts'][0]['id'])
+        res = self.testapp.post('/conversations', json.dumps(message_s), oauth2Header(sender), status=201)
+        second_cid = str(res.json['contexts'][0]['id'])
+        self.testapp.post('/conversations/%s/messages' % first_cid, json.dumps(message3), oauth2Header(sender), status=201)
+
+        conversation = self.exec_mongo_query('conversations', 'find', {'_id': ObjectId(first_cid)})[0]
+        self.assertEqual(conversation['lastMessage']['content'], message3['object']['content'])
+        self.assertIn('lastMessageAt', conversation)
+
+        res = self.testapp.get('/conversations', "", oauth2Header(sender), status=200)
+        self.assertEqual([conv['id'] for conv in res.json], [first_cid, second_cid])
+        self.assertEqual(res.json[0]['lastMessage']['content'], message3['object']['content'])
+        self.assertEqual(res.json[0]['lastMessage']['actor'], sender)
+
+        res = self.testapp.get('/people/{}'.format(sender), '', oauth2Header(sender), status=200)
+        self.assertEqual([conv['id'] for conv in res.json['talkingIn']], [first_cid, second_cid])
+        self.assertEqual(res.json['talkingIn'][0]['lastMessage']['content'], message3['object']['content'])
+
     def test_post_message_to_inexistent_group_conversation_creates_conversation(self):
         """
             Given a plain user
@@ -170,3 +170,46 @@ class FunctionalTests(unittest.TestCase):
         self.assertNotEqual(id(rdict['level1_key']['level2_key2']), id(new_dict['level1_key']['level2_key2']))
         self.assertEqual(id(rdict['level1_key']['level2_key']['level3_key']['new_value']), id(new_dict['level1_key']['level2_key']['level3_key']['new_value']))
         self.assertEqual(id(rdict['actor']), id(new_dict['actor']))
+
+    def test_document_changes(self):
+        """
+            Test that only the changed keys of a document are set or unset,
+            recursing into nested dicts but not into lists
+        """
+        from max.utils.dicts import document_changes
+        saved = {
+            '_id': 1,
+            'displayName': 'Old',
+            'tags': ['a', 'b'],
+            'object': {'content': 'Hello', 'url': 'http://a', 'nested': {'value': 1}},
+            'removed': True,
+            'volatile': 1
+        }
+        current = {
+            '_id': 1,
+            'displayName': 'Old',
+            'tags': ['a', 'b', 'c'],
+            'object': {'content': 'Hello', 'nested': {'value': 2}, 'added': 'x'},
+            'new': 0
+        }
+
+        sets, unsets = document_changes(saved, current, skip=['_id', 'volatile'])
+
+        self.assertEqual(sets, {'tags': ['a', 'b', 'c'], 'object.nested.value': 2, 'object.added': 'x', 'new': 0})
+        self.assertItemsEqual(unsets, ['object.url', 'removed'])
+
+    def test_apply_changes(self):
+        """
+            Test that applying the changes of a document to its stored version
+            results in the current document, without sharing its values
+        """
+        from max.utils.dicts import apply_changes
+        from max.utils.dicts import document_changes
+        saved = {'tags': ['a'], 'object': {'content': 'Hello', 'url': 'http://a'}}
+        current = {'tags': ['a', 'b'], 'object': {'content': 'Bye'}, 'new': {'value': 1}}
+
+        apply_changes(saved, *document_changes(saved, current))
+
+        self.assertEqual(saved, current)
+        current['tags'].append('c')
+        self.assertEqual(saved['tags'], ['a', 'b'])
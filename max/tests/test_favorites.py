@@ -2,12 +2,9 @@
 from max.tests import test_default_security
 from max.tests.base import MaxTestApp
 from max.tests.base import MaxTestBase
-from max.tests.base import mock_post
 from max.tests.base import oauth2Header
 from max.tests import test_manager
 
-from functools import partial
-from mock import patch
 from paste.deploy import loadapp
 
 import os
@@ -21,8 +18,7 @@ class FunctionalTests(unittest.TestCase, MaxTestBase):
         self.app = loadapp('config:tests.ini', relative_to=conf_dir)
         self.reset_database(self.app)
         self.app.registry.max_store.security.insert(test_default_security)
-        self.patched_post = patch('requests.post', new=partial(mock_post, self))
-        self.patched_post.start()
+        self.patch_post()
         self.testapp = MaxTestApp(self)
 
         self.create_user(test_manager)
@@ -84,6 +80,37 @@ class FunctionalTests(unittest.TestCase, MaxTestBase):
         self.assertEqual(res.json['object']['favorited'], True)
         self.assertEqual(res.json['object']['favoritesCount'], 1)
 
+    def test_favorite_activity_favorited_without_favorite_activity(self):
+        """
+           Given a plain user
+           and a regular context
+           When i post an activity in a context
+           And someone favorited it, but the favorite activity is not stored yet
+           Then this someone gets the current favorites when favoriteing it again
+        """
+        from .mockers import user_status_context
+        from .mockers import subscribe_context, create_context
+        from bson import ObjectId
+        username = 'messi'
+        username_not_me = 'xavi'
+        self.create_user(username)
+        self.create_user(username_not_me)
+        self.create_context(create_context)
+        self.admin_subscribe_user_to_context(username, subscribe_context)
+        self.admin_subscribe_user_to_context(username_not_me, subscribe_context)
+        res = self.create_activity(username, user_status_context)
+        activity_id = res.json['id']
+        self.exec_mongo_query('activity', 'update', {'_id': ObjectId(activity_id)}, {
+            '$push': {'favorites': {'username': username_not_me, 'objectType': 'person'}},
+            '$inc': {'favoritesCount': 1}
+        })
+        res = self.testapp.post('/activities/%s/favorites' % activity_id, '', oauth2Header(username_not_me), status=200)
+
+        self.assertEqual(res.json['verb'], 'favorite')
+        self.assertEqual(res.json['object']['favorites'][0]['username'], username_not_me)
+        self.assertEqual(res.json['object']['favorited'], True)
+        self.assertEqual(res.json['object']['favoritesCount'], 1)
+
     def test_unfavorite_activity(self):
         """
            Given a plain user
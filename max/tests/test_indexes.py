@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+from max.tests import test_default_security
+from max.tests.base import MaxTestApp
+from max.tests.base import MaxTestBase
+
+from paste.deploy import loadapp
+
+import os
+import unittest
+
+
+class FunctionalTests(unittest.TestCase, MaxTestBase):
+
+    def setUp(self):
+        conf_dir = os.path.dirname(__file__)
+        self.app = loadapp('config:tests.ini', relative_to=conf_dir)
+        self.reset_database(self.app)
+        self.app.registry.max_store.security.insert(test_default_security)
+        self.patch_post()
+        self.testapp = MaxTestApp(self)
+
+    def tearDown(self):
+        for collection_name in ['activity', 'users']:
+            self.app.registry.max_store[collection_name].drop_indexes()
+
+    # BEGIN TESTS
+
+    def test_ensure_indexes(self):
+        """
+            Given a database without indexes
+            When I ensure the declared indexes
+            Then all declared indexes are created
+            And no differences are reported afterwards
+        """
+        from max.indexes import diff_indexes
+        from max.indexes import ensure_indexes
+        db = self.app.registry.max_store
+
+        actions = ensure_indexes(db)
+        report = diff_indexes(db)
+
+        self.assertIn(('create', 'users', 'username_1 (username asc) unique'), actions)
+        self.assertIn('username_1', db.users.index_information())
+        self.assertEqual([changes['missing'] for changes in report.values() if changes['missing']], [])
+
+    def test_ensure_indexes_outdated_and_unknown(self):
+        """
+            Given a database with an index with a declared name but different definition
+            And an index that is not declared
+            When I ensure the declared indexes dropping the unknown ones
+            Then the outdated index is recreated
+            And the unknown index is dropped
+        """
+        from max.indexes import ensure_indexes
+        db = self.app.registry.max_store
+        db.activity.create_index([('actor.username', 1)], name='actor.username_1__id_-1')
+        db.activity.create_index([('generator', 1)], name='generator_1')
+
+        actions = ensure_indexes(db, drop_unknown=True)
+        existing = db.activity.index_information()
+
+        self.assertIn(('recreate', 'activity', 'actor.username_1__id_-1 (actor.username asc, _id desc)'), actions)
+        self.assertIn(('drop', 'activity', 'generator_1'), actions)
+        self.assertEqual(existing['actor.username_1__id_-1']['key'], [('actor.username', 1), ('_id', -1)])
+        self.assertNotIn('generator_1', existing)
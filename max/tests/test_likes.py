@@ -3,11 +3,8 @@ from max.tests import test_default_security
 from max.tests import test_manager
 from max.tests.base import MaxTestApp
 from max.tests.base import MaxTestBase
-from max.tests.base import mock_post
 from max.tests.base import oauth2Header
 
-from functools import partial
-from mock import patch
 from paste.deploy import loadapp
 
 import os
@@ -22,8 +19,7 @@ class FunctionalTests(unittest.TestCase, MaxTestBase):
         self.app = loadapp('config:tests.ini', relative_to=conf_dir)
         self.reset_database(self.app)
         self.app.registry.max_store.security.insert(test_default_security)
-        self.patched_post = patch('requests.post', new=partial(mock_post, self))
-        self.patched_post.start()
+        self.patch_post()
         self.testapp = MaxTestApp(self)
 
         self.create_user(test_manager)
@@ -85,6 +81,37 @@ class FunctionalTests(unittest.TestCase, MaxTestBase):
         self.assertEqual(res.json['object']['liked'], True)
         self.assertEqual(res.json['object']['likesCount'], 1)
 
+    def test_like_activity_liked_without_like_activity(self):
+        """
+           Given a plain user
+           and a regular context
+           When i post an activity in a context
+           And someone liked it, but the like activity is not stored yet
+           Then this someone gets the current likes when likeing it again
+        """
+        from .mockers import user_status_context
+        from .mockers import subscribe_context, create_context
+        from bson import ObjectId
+        username = 'messi'
+        username_not_me = 'xavi'
+        self.create_user(username)
+        self.create_user(username_not_me)
+        self.create_context(create_context)
+        self.admin_subscribe_user_to_context(username, subscribe_context)
+        self.admin_subscribe_user_to_context(username_not_me, subscribe_context)
+        res = self.create_activity(username, user_status_context)
+        activity_id = res.json['id']
+        self.exec_mongo_query('activity', 'update', {'_id': ObjectId(activity_id)}, {
+            '$push': {'likes': {'username': username_not_me, 'objectType': 'person'}},
+            '$inc': {'likesCount': 1}
+        })
+        res = self.testapp.post('/activities/%s/likes' % activity_id, '', oauth2Header(username_not_me), status=200)
+
+        self.assertEqual(res.json['verb'], 'like')
+        self.assertEqual(res.json['object']['likes'][0]['username'], username_not_me)
+        self.assertEqual(res.json['object']['liked'], True)
+        self.assertEqual(res.json['object']['likesCount'], 1)
+
     def test_unlike_activity(self):
         """
            Given a plain user
@@ -362,3 +389,113 @@ class FunctionalTests(unittest.TestCase, MaxTestBase):
         self.assertEqual(len(fourthpage.json), 1)
         self.assertEqual(fourthpage.json[0]['likesCount'], 0)
         self.assertEqual(fourthpage.json[0]['id'], activities[9])
+
+    def test_timeline_by_likes_paginated_with_cursor(self):
+        """
+            Test likes sorting pagination using the continuation cursor returned
+            on each page, including activities that were liked and unliked, that
+            must be sorted as never liked ones.
+        """
+        from .mockers import user_status_context
+        from .mockers import subscribe_context, create_context
+
+        # Store the ids of all created activities. First is the oldest
+        activities = []
+        self.create_context(create_context)
+
+        for i in range(1, 6):
+            username = 'user{}'.format(i)
+            self.create_user(username)
+            self.admin_subscribe_user_to_context(username, subscribe_context)
+            res = self.create_activity(username, user_status_context)
+            activities.append(res.json['id'])
+
+        self.like_activity('user1', activities[1])
+        self.like_activity('user2', activities[1])
+        self.like_activity('user1', activities[3])
+        self.like_activity('user1', activities[0])
+        self.testapp.delete('/activities/%s/likes/%s' % (activities[0], 'user1'), '', oauth2Header('user1'), status=204)
+
+        firstpage = self.testapp.get('/people/%s/timeline?sort=likes&limit=2' % "user1", "", oauth2Header("user1"), status=200)
+        cursor = firstpage.headers['X-Continuation-Cursor']
+        secondpage = self.testapp.get('/people/%s/timeline?sort=likes&limit=2&cursor=%s' % ("user1", cursor), "", oauth2Header("user1"), status=200)
+        cursor = secondpage.headers['X-Continuation-Cursor']
+        thirdpage = self.testapp.get('/people/%s/timeline?sort=likes&limit=2&cursor=%s' % ("user1", cursor), "", oauth2Header("user1"), status=200)
+
+        sorted_ids = [activity['id'] for activity in firstpage.json + secondpage.json + thirdpage.json]
+        self.assertEqual(sorted_ids, [activities[1], activities[3], activities[4], activities[2], activities[0]])
+        self.assertNotIn('X-Continuation-Cursor', thirdpage.headers)
+
+    def test_concurrent_likes_counted(self):
+        """
+           Given a plain user
+           and a regular context
+           When i post an activity in a context
+           And several users like this activity at the same time
+           Then all the likes are counted once
+        """
+        from .mockers import user_status_context
+        from .mockers import subscribe_context, create_context
+        import threading
+        username = 'messi'
+        likers = ['user{}'.format(index) for index in range(10)]
+        self.create_context(create_context)
+        for user in [username] + likers:
+            self.create_user(user)
+            self.admin_subscribe_user_to_context(user, subscribe_context)
+        res = self.create_activity(username, user_status_context)
+        activity_id = res.json['id']
+
+        statuses = []
+
+        def like(user):
+            for repetition in range(2):
+                res = self.testapp.post('/activities/%s/likes' % activity_id, '', oauth2Header(user))
+                statuses.append(res.status_int)
+
+        threads = [threading.Thread(target=like, args=(user,)) for user in likers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        activity = self.testapp.get('/activities/%s' % activity_id, '', oauth2Header(username), status=200)
+        self.assertEqual(activity.json['likesCount'], len(likers))
+        self.assertItemsEqual([liked['username'] for liked in activity.json['likes']], likers)
+        self.assertEqual(statuses.count(201), len(likers))
+        self.assertEqual(statuses.count(200), len(likers))
+
+    def test_like_then_modify_keeps_concurrent_likes(self):
+        """
+           Given an activity liked through an instance of it
+           When someone else likes it meanwhile
+           And the instance is modified and saved
+           Then both likes are kept
+        """
+        from max.models import Activity
+        from max.models import User
+        from pyramid.scripting import prepare
+        from .mockers import user_status_context
+        from .mockers import subscribe_context, create_context
+        username = 'messi'
+        self.create_context(create_context)
+        for user in [username, 'xavi', 'shakira']:
+            self.create_user(user)
+            self.admin_subscribe_user_to_context(user, subscribe_context)
+        activity_id = self.create_activity(username, user_status_context).json['id']
+
+        env = prepare(registry=self.app.registry)
+        try:
+            request = env['request']
+            request.actor = None
+            activity = Activity.from_database(request, activity_id)
+            activity.add_like_from(User.from_database(request, 'xavi'))
+            self.testapp.post('/activities/%s/likes' % activity_id, '', oauth2Header('shakira'), status=201)
+            activity.modifyActivity({'generator': 'Test'})
+        finally:
+            env['closer']()
+
+        res = self.testapp.get('/activities/%s' % activity_id, '', oauth2Header(username), status=200)
+        self.assertEqual(res.json['likesCount'], 2)
+        self.assertItemsEqual([liked['username'] for liked in res.json['likes']], ['xavi', 'shakira'])
+        self.assertEqual(res.json['generator'], 'Test')
@@ -3,11 +3,8 @@ from max.tests import test_default_security
 from max.tests import test_manager
 from max.tests.base import MaxTestApp
 from max.tests.base import MaxTestBase
-from max.tests.base import mock_post
 from max.tests.base import oauth2Header
 
-from functools import partial
-from mock import patch
 from paste.deploy import loadapp
 
 import json
@@ -22,8 +19,7 @@ class FunctionalTests(unittest.TestCase, MaxTestBase):
         self.app = loadapp('config:tests.ini', relative_to=conf_dir)
         self.reset_database(self.app)
         self.app.registry.max_store.security.insert(test_default_security)
-        self.patched_post = patch('requests.post', new=partial(mock_post, self))
-        self.patched_post.start()
+        self.patch_post()
         self.testapp = MaxTestApp(self)
 
         self.create_user(test_manager)
@@ -49,6 +45,47 @@ class FunctionalTests(unittest.TestCase, MaxTestBase):
         response_keywords.sort()
         self.assertListEqual(expected_keywords, response_keywords)
 
+    def test_maintenance_keywords_resumes_from_checkpoint(self):
+        """
+            Given a keywords reindex interrupted after the first activity
+            When the job is resumed
+            Then only the activities after the checkpoint are reindexed
+            And the job reports its throughput
+        """
+        from .mockers import user_status
+        from max.jobs import HEARTBEAT_TIMEOUT
+        from max.jobs import JobRunner
+        from max.jobs import create_job
+        from datetime import datetime
+        from datetime import timedelta
+        username = 'messi'
+        self.create_user(username, displayName='Lionel messi')
+        self.create_activity(username, user_status)
+        self.create_activity(username, user_status)
+
+        db = self.app.registry.max_store
+        db.activity.update({}, {'$set': {'_keywords': [], 'object._keywords': []}}, multi=True)
+        activities = list(db.activity.find({}, {'_id': 1}).sort([('_id', 1)]))
+        job = create_job(db, 'rebuild_keywords', status='running')
+        db.jobs.update({'_id': job['_id']}, {'$set': {
+            'last_id': activities[0]['_id'],
+            'processed': 1,
+            'total': 2,
+            'heartbeat': datetime.utcnow() - timedelta(seconds=HEARTBEAT_TIMEOUT + 1)
+        }})
+
+        JobRunner(self.app.registry).run_next()
+
+        job = db.jobs.find_one({'_id': job['_id']})
+
+        self.assertEqual(job['status'], 'done')
+        self.assertEqual(job['processed'], 2)
+        self.assertGreater(job['throughput'], 0)
+        first, second = db.activity.find().sort([('_id', 1)])
+        self.assertEqual(first['_keywords'], [])
+        self.assertIn(u'messi', second['_keywords'])
+        self.assertIn(u'testejant', second['object']['_keywords'])
+
     def test_maintenance_dates(self):
         from .mockers import user_status, user_comment
         username = 'messi'
@@ -172,6 +209,29 @@ class FunctionalTests(unittest.TestCase, MaxTestBase):
         self.assertEqual(len(res.json['participants']), 1)
         self.assertIn('archive', res.json['tags'])
 
+    def test_maintenance_conversations_last_message(self):
+        from .mockers import message, message3
+
+        sender = 'messi'
+        recipient = 'xavi'
+        self.create_user(sender)
+        self.create_user(recipient)
+
+        res = self.testapp.post('/conversations', json.dumps(message), oauth2Header(sender), status=201)
+        conversation_id = str(res.json['contexts'][0]['id'])
+        self.testapp.post('/conversations/{}/messages'.format(conversation_id), json.dumps(message3), oauth2Header(sender), status=201)
+
+        # Simulate a conversation stored before last message was kept on conversations
+        self.exec_mongo_query('conversations', 'update', {}, {'$unset': {'lastMessage': 1, 'lastMessageAt': 1}})
+
+        res = self.testapp.post('/admin/maintenance/conversations/lastmessage', "", oauth2Header(test_manager), status=200)
+        self.assertEqual(res.json['conversations'], 1)
+
+        conversation = self.exec_mongo_query('conversations', 'find', {})[0]
+        self.assertEqual(conversation['lastMessage']['content'], message3['object']['content'])
+        self.assertEqual(conversation['lastMessage']['actor'], sender)
+        self.assertIn('lastMessageAt', conversation)
+
     def test_maintenance_two_people_conversations(self):
         from .mockers import message as creation_message
 
@@ -261,6 +321,138 @@ class FunctionalTests(unittest.TestCase, MaxTestBase):
         res = self.testapp.get('/people/{}'.format(username), "", oauth2Header(test_manager), status=200)
         self.assertEqual(res.json['owner'], username)
 
+    def test_maintenance_users_people_search(self):
+        username = 'messi'
+        self.create_user(username, displayName='Lionel Messi')
+
+        # Users created before the people search index are found by regex until rebuilt
+        self.exec_mongo_query('users', 'update', {'username': username}, {'$unset': {'_search': 1}})
+        res = self.testapp.get('/people', {'username': 'lionel'}, oauth2Header(test_manager), status=200)
+        self.assertEqual(res.json[0]['username'], username)
+
+        self.testapp.post('/admin/maintenance/users', "", oauth2Header(test_manager), status=200)
+        user = self.exec_mongo_query('users', 'find', {'username': username})[0]
+        self.assertIn('lionel', user['_search']['text'])
+        res = self.testapp.get('/people', {'username': 'lionel'}, oauth2Header(test_manager), status=200)
+        self.assertEqual(res.json[0]['username'], username)
+
+    def test_maintenance_users_background_job(self):
+        """
+            Given a max with background jobs enabled
+            When a maintenance rebuild is requested
+            Then the job is queued and accepted
+            And a worker runs it
+        """
+        from max.jobs import JobRunner
+        username = 'messi'
+        self.create_user(username)
+        self.exec_mongo_query('users', 'update', {'username': username}, {'$set': {'_owner': 'test_manager'}})
+        self.app.registry.max_settings['max_background_jobs'] = 'true'
+
+        res = self.testapp.post('/admin/maintenance/users', "", oauth2Header(test_manager), status=202)
+        job_id = res.json['id']
+        self.assertTrue(res.location.endswith('/admin/jobs/{}'.format(job_id)))
+        self.assertEqual(res.json['status'], 'queued')
+
+        res = self.testapp.get('/people/{}'.format(username), "", oauth2Header(test_manager), status=200)
+        self.assertEqual(res.json['owner'], 'test_manager')
+
+        JobRunner(self.app.registry).run_next()
+
+        res = self.testapp.get('/admin/jobs/{}'.format(job_id), "", oauth2Header(test_manager), status=200)
+        self.assertEqual(res.json['status'], 'done')
+        self.assertEqual(res.json['processed'], 2)
+        self.assertEqual(res.json['total'], 2)
+        res = self.testapp.get('/people/{}'.format(username), "", oauth2Header(test_manager), status=200)
+        self.assertEqual(res.json['owner'], username)
+
+    def test_maintenance_job_stops_when_reclaimed(self):
+        """
+            Given a job being run by a worker
+            When another worker claims it meanwhile
+            Then the first worker stops running it
+            And the job state of the new worker is kept
+        """
+        from max.jobs import JOBS
+        from max.jobs import JobRunner
+        from max.jobs import create_job
+        from mock import patch
+        self.create_user('messi')
+
+        db = self.app.registry.max_store
+        job = create_job(db, 'rebuild_users')
+        step = JOBS['rebuild_users'][0]
+
+        def reclaim(request, item, params):
+            db.jobs.update({'_id': job['_id']}, {'$set': {'worker': 'otherhost:1'}})
+
+        with patch.object(step, 'process', reclaim):
+            JobRunner(self.app.registry).run_next()
+
+        job = db.jobs.find_one({'_id': job['_id']})
+        self.assertEqual(job['status'], 'running')
+        self.assertEqual(job['worker'], 'otherhost:1')
+        self.assertEqual(job['processed'], 0)
+
+    def test_maintenance_job_heartbeat_timeout_setting(self):
+        """
+            Given a running job without heartbeat for longer than the configured timeout
+            When a worker looks for jobs to run
+            Then it claims the job
+        """
+        from max.jobs import JobRunner
+        from max.jobs import create_job
+        from datetime import datetime
+        from datetime import timedelta
+        self.create_user('messi')
+        self.app.registry.max_settings['max_jobs_heartbeat_timeout'] = '10'
+
+        db = self.app.registry.max_store
+        job = create_job(db, 'rebuild_users', status='running')
+        db.jobs.update({'_id': job['_id']}, {'$set': {'heartbeat': datetime.utcnow() - timedelta(seconds=11)}})
+
+        claimed = JobRunner(self.app.registry).claim()
+
+        self.assertEqual(claimed['_id'], job['_id'])
+
+    def test_maintenance_job_resumes_from_checkpoint(self):
+        """
+            Given a job left running by a dead worker after processing its first batch
+            When a worker claims it
+            Then it only processes the documents after the checkpoint
+        """
+        from max.jobs import HEARTBEAT_TIMEOUT
+        from max.jobs import JobRunner
+        from max.jobs import create_job
+        from datetime import datetime
+        from datetime import timedelta
+        self.create_user('messi')
+        self.create_user('xavi')
+
+        db = self.app.registry.max_store
+        db.users.update({}, {'$set': {'_owner': 'test_manager'}}, multi=True)
+        users = list(db.users.find({}, {'_id': 1, 'username': 1}).sort([('_id', 1)]))
+        job = create_job(db, 'rebuild_users', status='running')
+        db.jobs.update({'_id': job['_id']}, {'$set': {
+            'last_id': users[1]['_id'],
+            'processed': 2,
+            'total': 3,
+            'heartbeat': datetime.utcnow() - timedelta(seconds=HEARTBEAT_TIMEOUT + 1)
+        }})
+
+        JobRunner(self.app.registry).run_next()
+
+        job = db.jobs.find_one({'_id': job['_id']})
+        self.assertEqual(job['status'], 'done')
+        self.assertEqual(job['processed'], 3)
+
+        owners = dict([(user['username'], user['_owner']) for user in db.users.find()])
+        self.assertEqual(owners[users[2]['username']], users[2]['username'])
+        self.assertEqual(owners[users[1]['username']], 'test_manager')
+
+    def test_get_unknown_job(self):
+        self.testapp.get('/admin/jobs/{}'.format('0' * 24), "", oauth2Header(test_manager), status=404)
+
     def test_maintenance_tokens(self):
         username = 'messi'
         self.create_user(username)
@@ -288,3 +480,51 @@ class FunctionalTests(unittest.TestCase, MaxTestBase):
         self.assertItemsEqual(migrated_android_tokens, ['token3', 'token4'])
         self.assertNotIn('iosDevices', user)
         self.assertNotIn('androidDevices', user)
+
+    def test_maintenance_queries_profile(self):
+        """
+            Given a running max with the query profiler enabled
+            When i get a user timeline
+            Then the timeline queries are aggregated by route and shape
+            And the stats can be reset
+        """
+        from .mockers import user_status
+        username = 'messi'
+        self.create_user(username)
+        self.create_activity(username, user_status)
+        self.testapp.delete('/admin/maintenance/queries', "", oauth2Header(test_manager), status=204)
+
+        self.testapp.get('/people/%s/timeline' % username, "", oauth2Header(username), status=200)
+        self.testapp.get('/people/%s/timeline' % username, "", oauth2Header(username), status=200)
+        res = self.testapp.get('/admin/maintenance/queries', "", oauth2Header(test_manager), status=200)
+
+        timeline_queries = [query for query in res.json['queries'] if query['route'] == 'GET timeline' and query['collection'] == 'activity']
+        self.assertTrue(res.json['enabled'])
+        self.assertIn((2, 2), [(query['count'], query['documents']) for query in timeline_queries])
+
+        self.testapp.delete('/admin/maintenance/queries', "", oauth2Header(test_manager), status=204)
+        res = self.testapp.get('/admin/maintenance/queries', "", oauth2Header(test_manager), status=200)
+        self.assertEqual([query for query in res.json['queries'] if query['route'] == 'GET timeline'], [])
+
+    def test_maintenance_query_plans(self):
+        """
+            Given a running max with query plans capture enabled
+            And no index on the users collection
+            When i get a user profile twice
+            Then the query on users is explained once on the user route
+            And the plan is flagged as a collection scan
+        """
+        username = 'messi'
+        self.create_user(username)
+        self.app.registry.max_settings['max_explain_queries'] = 'true'
+        self.testapp.delete('/admin/maintenance/queries/plans', "", oauth2Header(test_manager), status=204)
+
+        self.testapp.get('/people/%s' % username, "", oauth2Header(username), status=200)
+        self.testapp.get('/people/%s' % username, "", oauth2Header(username), status=200)
+        res = self.testapp.get('/admin/maintenance/queries/plans', "", oauth2Header(test_manager), status=200)
+
+        user_plans = [plan for plan in res.json['routes']['user'] if plan['collection'] == 'users' and plan['shape']['query'] == {'username': 'VALUE'}]
+        self.assertTrue(res.json['enabled'])
+        self.assertEqual(len(user_plans), 1)
+        self.assertTrue(user_plans[0]['collection_scan'])
+        self.assertTrue(user_plans[0]['flagged'])
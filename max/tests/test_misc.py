@@ -4,7 +4,6 @@ from max.tests import test_manager
 from max.tests.base import MaxTestApp
 from max.tests.base import MaxTestBase
 from max.tests.base import MaxAvatarsTestBase
-from max.tests.base import mock_post
 from max.tests.base import oauth2Header
 from max.tests.base import mocked_cursor_init
 from functools import partial
@@ -36,8 +35,7 @@ class FunctionalTests(unittest.TestCase, MaxTestBase, MaxAvatarsTestBase):
         self.app = loadapp('config:tests.ini', relative_to=self.conf_dir)
         self.reset_database(self.app)
         self.app.registry.max_store.security.insert(test_default_security)
-        self.patched_post = patch('requests.post', new=partial(mock_post, self))
-        self.patched_post.start()
+        self.patch_post()
         self.testapp = MaxTestApp(self)
 
         self.create_user(test_manager)
@@ -3,12 +3,9 @@ from max.tests import test_default_security
 from max.tests import test_manager
 from max.tests.base import MaxTestApp
 from max.tests.base import MaxTestBase
-from max.tests.base import mock_post
 from max.tests.base import oauth2Header
 
 from max.utils.dicts import deepcopy
-from functools import partial
-from mock import patch
 from paste.deploy import loadapp
 
 import json
@@ -23,8 +20,7 @@ class FunctionalTests(unittest.TestCase, MaxTestBase):
         self.app = loadapp('config:tests.ini', relative_to=conf_dir)
         self.reset_database(self.app)
         self.app.registry.max_store.security.insert(test_default_security)
-        self.patched_post = patch('requests.post', new=partial(mock_post, self))
-        self.patched_post.start()
+        self.patch_post()
         self.testapp = MaxTestApp(self)
 
     def tearDown(self):
@@ -101,6 +97,32 @@ class FunctionalTests(unittest.TestCase, MaxTestBase):
         self.assertEqual(res.json[0]['username'], username_visible2)
         self.assertEqual(res.json[1]['username'], username_visible1)
 
+    def test_get_people_as_visible_user_pages_are_full(self):
+        """
+            Given i'm a visible user
+            When I search users a page at a time
+            Then the nonvisible ones don't take any place in the page
+        """
+        username_nonvisible1 = 'usernonvisible1'
+        username_nonvisible2 = 'usernonvisible2'
+
+        for username in ['user1', 'user2', 'user3', username_nonvisible1, username_nonvisible2]:
+            self.create_user(username)
+
+        self.testapp.post('/admin/security/roles/%s/users/%s' % ('NonVisible', username_nonvisible1), "", oauth2Header(test_manager), status=201)
+        self.testapp.post('/admin/security/roles/%s/users/%s' % ('NonVisible', username_nonvisible2), "", oauth2Header(test_manager), status=201)
+
+        res = self.testapp.get('/people?limit=2', "", oauth2Header('user1'), status=200)
+
+        self.assertEqual([user['username'] for user in res.json], ['user3', 'user2'])
+        self.assertNotIn('subscribedTo', res.json[0])
+        self.assertEqual(res.headers.get('X-Has-Remaining-Items'), '1')
+
+        res = self.testapp.get('/people?limit=3', "", oauth2Header('user1'), status=200)
+
+        self.assertEqual([user['username'] for user in res.json], ['user3', 'user2', 'user1'])
+        self.assertNotIn('X-Has-Remaining-Items', res.headers)
+
     # Tests for start Conversations without sharing contexts (4 tests)
 
     def test_start_conversation_with_visible_as_nonvisible_without_sharing_contexts(self):
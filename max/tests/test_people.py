@@ -3,10 +3,8 @@ from max.tests import test_default_security
 from max.tests import test_manager
 from max.tests.base import MaxTestApp
 from max.tests.base import MaxTestBase
-from max.tests.base import mock_post
 from max.tests.base import oauth2Header
 
-from functools import partial
 from mock import patch
 from paste.deploy import loadapp
 
@@ -22,8 +20,7 @@ class FunctionalTests(unittest.TestCase, MaxTestBase):
         self.app = loadapp('config:tests.ini', relative_to=conf_dir)
         self.reset_database(self.app)
         self.app.registry.max_store.security.insert(test_default_security)
-        self.patched_post = patch('requests.post', new=partial(mock_post, self))
-        self.patched_post.start()
+        self.patch_post()
         self.testapp = MaxTestApp(self)
 
     def tearDown(self):
@@ -111,6 +108,34 @@ class FunctionalTests(unittest.TestCase, MaxTestBase):
         self.assertIn('published', result)
         self.assertEqual(len(result.keys()), 4)
 
+    def test_get_user_as_someone_else_loads_users_once(self):
+        """
+            Given two users
+            When one gets the other's profile
+            Then each user is read from the database once
+        """
+        from pymongo.collection import Collection
+        username = 'messi'
+        usernamenotme = 'xavi'
+
+        self.create_user(username)
+        self.create_user(usernamenotme)
+
+        queried = []
+        original_find = Collection.find
+
+        def find(collection, *args, **kwargs):
+            spec = args[0] if args else kwargs.get('spec')
+            if collection.name == 'users' and spec and spec.keys() == ['username']:
+                queried.append(spec['username'])
+            return original_find(collection, *args, **kwargs)
+
+        with patch.object(Collection, 'find', find):
+            self.testapp.get('/people/%s' % username, "", oauth2Header(usernamenotme), status=200)
+
+        self.assertItemsEqual(queried, list(set(queried)))
+        self.assertIn(usernamenotme, queried)
+
     def test_get_user_case_insensitive(self):
         """ Doctest .. http:get:: /people/{username} """
         username = 'messi'
@@ -247,7 +272,7 @@ class FunctionalTests(unittest.TestCase, MaxTestBase):
 
     def test_search_users_filter_displayName_non_accented(self):
         """
-            Accented username or displayname parts can only be searched with the accent provided.
+            Accented username or displayname parts can be searched without the accent.
         """
         username = 'sheldon.cooper'
         self.create_user(username, displayName='Sheldon Cooper Coupé')
@@ -255,7 +280,58 @@ class FunctionalTests(unittest.TestCase, MaxTestBase):
         res = self.testapp.get('/people', query, oauth2Header(username), status=200)
         result = json.loads(res.text)
 
-        self.assertEqual(len(result), 0)
+        self.assertEqual(result[0].get('username', ''), username)
+
+    def test_search_users_sorted_by_relevance(self):
+        """
+            Users whose username starts with the search go first, then the ones with
+            a word starting with it, and then the ones with the search anywhere else
+        """
+        self.create_user('anna.coop', displayName='Anna Coop')
+        self.create_user('coop', displayName='Coop')
+        self.create_user('cooper', displayName='Sheldon Cooper')
+        self.create_user('sheldon', displayName='Sheldon Cooper')
+        self.create_user('uncooperative', displayName='Uncooperative')
+        query = {'username': 'coop'}
+        res = self.testapp.get('/people', query, oauth2Header('coop'), status=200)
+
+        self.assertEqual([user['username'] for user in res.json], ['coop', 'cooper', 'anna.coop', 'sheldon', 'uncooperative'])
+
+    def test_search_users_sorted_by_relevance_across_pages(self):
+        """
+            Given users matching a search with different relevance
+            When I search them a page at a time
+            Then the exact username comes first, and the pages keep the relevance order
+        """
+        self.create_user('aaron.coop', displayName='Aaron Coop')
+        self.create_user('anna.coop', displayName='Anna Coop')
+        self.create_user('coop', displayName='Coop')
+        self.create_user('cooper', displayName='Sheldon Cooper')
+        self.create_user('sheldon', displayName='Sheldon Cooper')
+        self.create_user('uncooperative', displayName='Uncooperative')
+
+        found = []
+        query = {'username': 'coop', 'limit': 2}
+        while True:
+            res = self.testapp.get('/people', query, oauth2Header('coop'), status=200)
+            found.append([user['username'] for user in res.json])
+            if 'X-Has-Remaining-Items' not in res.headers:
+                break
+            query['cursor'] = res.headers['X-Continuation-Cursor']
+
+        self.assertEqual(found, [['coop', 'cooper'], ['aaron.coop', 'anna.coop'], ['sheldon', 'uncooperative']])
+        self.assertNotIn('X-Continuation-Cursor', res.headers)
+
+    def test_search_users_uses_search_field(self):
+        username = 'sheldon.cooper'
+        self.create_user(username, displayName='Sheldon Cooper Coupé')
+        self.modify_user(username, {"displayName": "Shelly"})
+
+        res = self.testapp.get('/people', {'username': 'coupe'}, oauth2Header(username), status=200)
+        self.assertEqual(len(res.json), 0)
+        res = self.testapp.get('/people', {'username': 'shel'}, oauth2Header(username), status=200)
+        self.assertEqual(res.json[0]['username'], username)
+        self.assertNotIn('_search', res.json[0])
 
     def test_get_all_users_with_regex_weird(self):
         username1 = 'victor.fernandez'
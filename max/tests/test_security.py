@@ -3,10 +3,8 @@ from max.tests import test_default_security_single
 from max.tests import test_manager
 from max.tests.base import MaxTestApp
 from max.tests.base import MaxTestBase
-from max.tests.base import mock_post
 from max.tests.base import oauth2Header
 
-from functools import partial
 from mock import patch
 from paste.deploy import loadapp
 
@@ -22,8 +20,7 @@ class FunctionalTests(unittest.TestCase, MaxTestBase):
         self.app = loadapp('config:tests.ini', relative_to=conf_dir)
         self.reset_database(self.app)
         self.app.registry.max_store.security.insert(test_default_security_single)
-        self.patched_post = patch('requests.post', new=partial(mock_post, self))
-        self.patched_post.start()
+        self.patch_post()
         self.testapp = MaxTestApp(self)
 
         self.create_user(test_manager)
@@ -79,3 +76,51 @@ class FunctionalTests(unittest.TestCase, MaxTestBase):
         self.testapp.delete('/admin/security/roles/%s/users/%s' % ('Manager', test_manager2), "", oauth2Header(test_manager), status=204)
         self.testapp.get('/activities', "", oauth2Header(test_manager2), status=403)
 
+    def test_security_changed_by_other_process_reloaded(self):
+        from max.utils.cache import VersionTracker
+        test_manager2 = 'messi'
+        self.create_user(test_manager2)
+        self.app.registry.max_security_refresher.tracker.poll_interval = 0
+        self.testapp.get('/activities', "", oauth2Header(test_manager2), status=403)
+
+        # Another process grants the role and bumps the security version
+        self.app.registry.max_store.security.update({}, {'$push': {'roles.Manager': test_manager2}})
+        VersionTracker('security').bump(self.app.registry.max_store)
+
+        self.testapp.get('/activities', "", oauth2Header(test_manager2), status=200)
+        self.assertTrue(self.app.registry.max_security.has_role(test_manager2, 'Manager'))
+
+    def test_security_concurrent_saves_keep_both_changes(self):
+        from max.resources import loadMAXSecurity
+        security = loadMAXSecurity(self.app.registry)
+        other = loadMAXSecurity(self.app.registry)
+
+        security.add_user_to_role('messi', 'Manager')
+        other.add_user_to_role('xavi', 'NonVisible')
+        security.save()
+        other.save()
+
+        stored = self.app.registry.max_store.security.find_one()
+        self.assertItemsEqual(stored['roles']['Manager'], [test_manager, 'messi'])
+        self.assertEqual(stored['roles']['NonVisible'], ['xavi'])
+
+    def test_security_versioned_save_fails_if_modified_meanwhile(self):
+        from max.exceptions import ConcurrentModification
+        from max.models import Security
+        from max.resources import loadMAXSecurity
+
+        with patch.object(Security, 'version_field', '_version'), patch.dict(Security.schema, {'_version': {}}):
+            security = loadMAXSecurity(self.app.registry)
+            other = loadMAXSecurity(self.app.registry)
+
+            security.add_user_to_role('messi', 'Manager')
+            security.save()
+            other.add_user_to_role('xavi', 'Manager')
+            self.assertRaises(ConcurrentModification, other.save)
+
+            security.add_user_to_role('xavi', 'Manager')
+            security.save()
+
+        stored = self.app.registry.max_store.security.find_one()
+        self.assertEqual(stored['_version'], 2)
+        self.assertItemsEqual(stored['roles']['Manager'], [test_manager, 'messi', 'xavi'])
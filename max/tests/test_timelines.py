@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+from max.tests import test_default_security
+from max.tests import test_manager
+from max.tests.base import MaxTestApp
+from max.tests.base import MaxTestBase
+from max.tests.base import oauth2Header
+
+from hashlib import sha1
+from paste.deploy import loadapp
+
+import os
+import unittest
+
+
+class FunctionalTests(unittest.TestCase, MaxTestBase):
+
+    def setUp(self):
+        conf_dir = os.path.dirname(__file__)
+        self.app = loadapp('config:tests.ini', relative_to=conf_dir)
+        self.reset_database(self.app)
+        self.app.registry.max_store.security.insert(test_default_security)
+        self.app.registry.max_settings['max_materialized_timelines'] = 'true'
+        self.patch_post()
+        self.testapp = MaxTestApp(self)
+
+        self.create_user(test_manager)
+
+    # BEGIN TESTS
+
+    def test_timeline_from_materialized_feed(self):
+        """
+            Given a user created with materialized timelines enabled
+            When I post an activity and someone else posts in a context i'm subscribed to
+            Then both activities are in my materialized feed and in my timeline
+        """
+        from .mockers import create_context, subscribe_context
+        from .mockers import user_status, user_status_context
+        username = 'messi'
+        username_not_me = 'xavi'
+        self.create_user(username)
+        self.create_user(username_not_me)
+        self.create_context(create_context)
+        self.admin_subscribe_user_to_context(username, subscribe_context)
+        self.admin_subscribe_user_to_context(username_not_me, subscribe_context)
+        own = self.create_activity(username, user_status).json
+        other = self.create_activity(username_not_me, user_status_context).json
+
+        feed = self.exec_mongo_query('timelines', 'find', {'owner': username, 'activity': {'$ne': None}})
+        res = self.testapp.get('/people/%s/timeline' % username, "", oauth2Header(username), status=200)
+
+        self.assertEqual(len(feed), 2)
+        self.assertEqual([activity['id'] for activity in res.json], [other['id'], own['id']])
+
+    def test_timeline_materialized_feed_pagination(self):
+        """
+            Given a user with a materialized timeline
+            When I get the timeline in pages
+            Then i get all the activities in the same order as the regular timeline
+            And only the first page tells there are remaining activities
+        """
+        from .mockers import user_status
+        username = 'messi'
+        self.create_user(username)
+        activities = [self.create_activity(username, user_status, note=str(index)).json['id'] for index in range(5)]
+
+        first_page = self.testapp.get('/people/%s/timeline?limit=3' % username, "", oauth2Header(username), status=200)
+        second_page = self.testapp.get('/people/%s/timeline?limit=3&before=%s' % (username, first_page.json[-1]['id']), "", oauth2Header(username), status=200)
+
+        self.assertEqual([activity['id'] for activity in first_page.json + second_page.json], list(reversed(activities)))
+        self.assertEqual(first_page.headers['X-Has-Remaining-Items'], '1')
+        self.assertNotIn('X-Has-Remaining-Items', second_page.headers)
+
+    def test_timeline_materialized_feed_unsubscribe(self):
+        """
+            Given a user with a materialized timeline subscribed to a context
+            When the user is unsubscribed from the context
+            Then the context activities from other users are removed from the timeline
+            And the user own activities in the context are preserved
+        """
+        from .mockers import create_context, subscribe_context
+        from .mockers import user_status_context
+        username = 'messi'
+        username_not_me = 'xavi'
+        self.create_user(username)
+        self.create_user(username_not_me)
+        self.create_context(create_context)
+        self.admin_subscribe_user_to_context(username, subscribe_context)
+        self.admin_subscribe_user_to_context(username_not_me, subscribe_context)
+        own = self.create_activity(username, user_status_context).json
+        self.create_activity(username_not_me, user_status_context)
+
+        self.admin_unsubscribe_user_from_context(username, sha1(create_context['url']).hexdigest())
+        res = self.testapp.get('/people/%s/timeline' % username, "", oauth2Header(username), status=200)
+
+        self.assertEqual([activity['id'] for activity in res.json], [own['id']])
+
+    def test_timeline_materialized_feed_subscribe(self):
+        """
+            Given a user with a materialized timeline
+            When the user subscribes to a context with previous activity
+            Then the context activities are added to the timeline
+        """
+        from .mockers import create_context, subscribe_context
+        from .mockers import user_status_context
+        username = 'messi'
+        username_not_me = 'xavi'
+        self.create_user(username)
+        self.create_user(username_not_me)
+        self.create_context(create_context)
+        self.admin_subscribe_user_to_context(username_not_me, subscribe_context)
+        other = self.create_activity(username_not_me, user_status_context).json
+
+        self.admin_subscribe_user_to_context(username, subscribe_context)
+        res = self.testapp.get('/people/%s/timeline' % username, "", oauth2Header(username), status=200)
+
+        self.assertEqual([activity['id'] for activity in res.json], [other['id']])
+
+    def test_timeline_materialized_feed_subscribe_most_recent(self):
+        """
+            Given a context with several activities
+            When its activities are added to the feed of a new subscriber
+            Then only the most recent ones are added
+        """
+        from max.timelines import TimelineFeeds
+        from .mockers import create_context, subscribe_context
+        from .mockers import user_status_context
+        username = 'messi'
+        username_not_me = 'xavi'
+        self.create_user(username)
+        self.create_user(username_not_me)
+        self.create_context(create_context)
+        self.admin_subscribe_user_to_context(username_not_me, subscribe_context)
+        self.create_activity(username_not_me, user_status_context)
+        last = self.create_activity(username_not_me, user_status_context, note='last').json
+
+        TimelineFeeds(self.app.registry.max_store).add_context(username, sha1(create_context['url']).hexdigest(), limit=1)
+        feed = self.exec_mongo_query('timelines', 'find', {'owner': username, 'activity': {'$ne': None}})
+
+        self.assertEqual([str(entry['activity']) for entry in feed], [last['id']])
+
+    def test_timeline_materialized_feed_delete_activity(self):
+        """
+            Given a user with a materialized timeline
+            When I delete one of my activities
+            Then the activity is removed from my feed and from my timeline
+        """
+        from .mockers import user_status
+        username = 'messi'
+        self.create_user(username)
+        activity = self.create_activity(username, user_status).json
+
+        self.testapp.delete('/activities/%s' % activity['id'], '', oauth2Header(username), status=204)
+        feed = self.exec_mongo_query('timelines', 'find', {'owner': username, 'activity': {'$ne': None}})
+        res = self.testapp.get('/people/%s/timeline' % username, "", oauth2Header(username), status=200)
+
+        self.assertEqual(feed, [])
+        self.assertEqual(res.json, [])
+
+    def test_timeline_without_materialized_feed(self):
+        """
+            Given a user created before enabling materialized timelines
+            When I get the user timeline
+            Then the timeline is served with the regular query
+            And once the feed is built the timeline is the same
+        """
+        from max.timelines import TimelineFeeds
+        from .mockers import user_status
+        username = 'messi'
+        self.app.registry.max_settings['max_materialized_timelines'] = 'false'
+        self.create_user(username)
+        activity = self.create_activity(username, user_status).json
+        self.app.registry.max_settings['max_materialized_timelines'] = 'true'
+
+        regular = self.testapp.get('/people/%s/timeline' % username, "", oauth2Header(username), status=200)
+        feeds = TimelineFeeds(self.app.registry.max_store)
+        feeds.build(self.app.registry.max_store.users.find_one({'username': username}))
+        materialized = self.testapp.get('/people/%s/timeline' % username, "", oauth2Header(username), status=200)
+
+        self.assertEqual([item['id'] for item in regular.json], [activity['id']])
+        self.assertEqual([item['id'] for item in materialized.json], [activity['id']])
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+from max.tests import test_default_security
+from max.tests import test_manager
+from max.tests.base import MaxTestApp
+from max.tests.base import MaxTestBase
+from max.tests.base import oauth2Header
+
+from mock import patch
+from paste.deploy import loadapp
+from pymongo.collection import Collection
+
+import json
+import os
+import unittest
+
+
+class FunctionalTests(unittest.TestCase, MaxTestBase):
+
+    def setUp(self):
+        conf_dir = os.path.dirname(__file__)
+        self.app = loadapp('config:tests.ini', relative_to=conf_dir)
+        self.reset_database(self.app)
+        self.app.registry.max_store.security.insert(test_default_security)
+        self.app.registry.max_settings['max_unit_of_work'] = True
+        self.patch_post()
+        self.testapp = MaxTestApp(self)
+
+        self.create_user(test_manager)
+
+    # BEGIN TESTS
+
+    def test_create_group_conversation(self):
+        """
+            Given the unit of work is enabled
+            When I create a group conversation
+            Then the conversation, subscriptions and message are inserted in bulk
+            And the reads made meanwhile see them
+        """
+        from .mockers import group_message
+        sender = 'messi'
+        self.create_user(sender)
+        self.create_user('xavi')
+        self.create_user('shakira')
+
+        inserted = []
+        collection_insert = Collection.insert
+
+        def recording_insert(collection, *args, **kwargs):
+            inserted.append(collection.name)
+            return collection_insert(collection, *args, **kwargs)
+
+        with patch.object(Collection, 'insert', recording_insert):
+            res = self.testapp.post('/conversations', json.dumps(group_message), oauth2Header(sender), status=201)
+
+        self.assertEqual([name for name in inserted if name in ['conversations', 'activity', 'messages']], [])
+        cid = res.json['contexts'][0]['id']
+        self.assertEqual(len(self.exec_mongo_query('activity', 'find', {'verb': 'subscribe', 'object.id': cid})), 3)
+        self.assertEqual(len(self.exec_mongo_query('messages', 'find', {'contexts.id': cid})), 1)
+
+        for username in ['messi', 'xavi', 'shakira']:
+            res = self.testapp.get('/conversations', '', oauth2Header(username), status=200)
+            self.assertEqual(len(res.json), 1)
+            self.assertEqual(res.json[0]['lastMessage']['content'], group_message['object']['content'])
+
+    def test_failed_request_discards_pending_writes(self):
+        """
+            Given the unit of work is enabled
+            When a request fails after some writes
+            Then the writes not flushed yet are not made
+        """
+        from .mockers import group_message
+        sender = 'messi'
+        self.create_user(sender)
+        self.create_user('xavi')
+        self.create_user('shakira')
+
+        with patch('max.rest.conversations.RabbitNotifications') as notifications:
+            notifications.return_value.add_conversation.side_effect = Exception('Broken')
+            self.testapp.post('/conversations', json.dumps(group_message), oauth2Header(sender), status=500)
+
+        self.assertEqual(len(self.exec_mongo_query('messages', 'find', {})), 0)
+
+    def test_failed_request_discards_outbox_entries(self):
+        """
+            Given the unit of work and the notifications outbox are enabled
+            When a request fails after storing a notification on the outbox
+            Then the notification is not stored, as the rest of the writes
+        """
+        from .mockers import group_message
+        sender = 'messi'
+        self.create_user(sender)
+        self.create_user('xavi')
+        self.create_user('shakira')
+        self.app.registry.max_settings['max_notifications_outbox'] = 'true'
+
+        with patch('max.rabbitmq.RabbitMessage.prepare') as prepare:
+            prepare.side_effect = Exception('Broken')
+            self.testapp.post('/conversations', json.dumps(group_message), oauth2Header(sender), status=500)
+
+        self.assertEqual(len(self.exec_mongo_query('messages', 'find', {})), 0)
+        self.assertEqual(self.exec_mongo_query('outbox', 'find', {}), [])
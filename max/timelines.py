@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""
+    Materialized user timelines
+
+    When ``max.materialized_timelines`` is enabled, every visible post is fanned out
+    on write to the feed of each user that would see it on his timeline: the author,
+    the users following the author and the users subscribed to the activity context.
+
+    Feeds are stored in the ``timelines`` collection, one entry per (owner, activity):
+
+        {
+            'owner': 'username',
+            'activity': ObjectId('...'),
+            'context': 'context hash or None',
+            'actor': 'author username or None'
+        }
+
+    so a timeline page can be read with a single range scan over (owner, activity)
+    instead of the $or query built by ``max.rest.timeline.timelineQuery``.
+
+    New subscribers of a context get only its ``FEED_CONTEXT_ACTIVITIES`` most recent
+    activities on their feed. Older ones are added when the feed is rebuilt.
+
+    Each materialized feed has also a marker entry with ``activity: None``. Only users
+    with a marker get new activities fanned out, and users without one are served by the
+    regular timeline query, so feeds are never partial: they're created either on user
+    creation or by the backfill (``max.timelines`` script).
+"""
+from max.resources import getMAXSettings
+
+from pyramid.settings import asbool
+
+from pymongo import DESCENDING
+
+TIMELINES_COLLECTION = 'timelines'
+FEED_INSERT_BATCH_SIZE = 1000
+FEED_CONTEXT_ACTIVITIES = 1000
+TIMELINE_ACTIVITY_QUERY = {
+    'verb': 'post',
+    'visible': {'$ne': False}
+}
+
+
+def materialized_timelines_enabled(request):
+    """
+        Checks if materialized timelines are enabled on settings
+    """
+    return asbool(getMAXSettings(request).get('max_materialized_timelines', False))
+
+
+class TimelineFeeds(object):
+    """
+        Maintains the materialized feeds of users timelines.
+
+        Operates on the raw pymongo database, so it can be used both from models
+        and from scripts without a request.
+    """
+
+    def __init__(self, database):
+        self.database = database
+        self.collection = database[TIMELINES_COLLECTION]
+
+    @staticmethod
+    def feed_entry(owner, activity):
+        """
+            Builds the entry that represents an activity in the feed of owner
+        """
+        contexts = activity.get('contexts') or [{}]
+        return {
+            'owner': owner,
+            'activity': activity['_id'],
+            'context': contexts[0].get('hash'),
+            'actor': activity['actor'].get('username')
+        }
+
+    @staticmethod
+    def is_timeline_activity(activity):
+        """
+            Checks if an activity has to appear on users timelines
+        """
+        return activity.get('verb') == 'post' and activity.get('visible', True) is not False
+
+    def _insert(self, entries):
+        """
+            Inserts feed entries in batches
+        """
+        for start in range(0, len(entries), FEED_INSERT_BATCH_SIZE):
+            self.collection.insert(entries[start:start + FEED_INSERT_BATCH_SIZE])
+
+    def audience(self, activity):
+        """
+            Returns the usernames whose timeline includes the activity
+        """
+        owners = set()
+        actor_username = activity['actor'].get('username')
+        if activity['actor'].get('objectType') == 'person' and actor_username:
+            owners.add(actor_username)
+            followers = self.database.users.find({'following.username': actor_username}, {'username': 1})
+            owners.update([follower['username'] for follower in followers])
+
+        context_hash = (activity.get('contexts') or [{}])[0].get('hash')
+        if context_hash:
+            subscribers = self.database.users.find({'subscribedTo.hash': context_hash}, {'username': 1})
+            owners.update([subscriber['username'] for subscriber in subscribers])
+
+        return owners
+
+    def fanout(self, activity):
+        """
+            Adds a newly created activity to the feed of all its audience
+        """
+        if not self.is_timeline_activity(activity):
+            return
+        audience = list(self.audience(activity))
+        with_feed = self.collection.find({'owner': {'$in': audience}, 'activity': None}, {'owner': 1})
+        self._insert([self.feed_entry(entry['owner'], activity) for entry in with_feed])
+
+    def create(self, username):
+        """
+            Marks the start of a materialized feed for a user
+        """
+        self.collection.update({'owner': username, 'activity': None}, {'$set': {'owner': username, 'activity': None}}, upsert=True)
+
+    def has_feed(self, username):
+        """
+            Checks if the user has a materialized feed. Users without one
+            are served with the regular timeline query until backfilled.
+        """
+        return self.collection.find_one({'owner': username, 'activity': None}, {'_id': 1}) is not None
+
+    def page(self, username, limit, before=None, after=None):
+        """
+            Returns the ids of a page of activities from a user feed, newest first
+        """
+        query = {'owner': username, 'activity': {'$ne': None}}
+        if before:
+            query['activity'] = {'$lt': before}
+        elif after:
+            query['activity'] = {'$gt': after}
+
+        cursor = self.collection.find(query, {'activity': 1, '_id': 0}).sort([('activity', DESCENDING)]).limit(limit)
+        return [entry['activity'] for entry in cursor]
+
+    def add_context(self, username, context_hash, limit=FEED_CONTEXT_ACTIVITIES):
+        """
+            Adds the most recent activities of a context to the feed of a new subscriber
+        """
+        if not self.has_feed(username):
+            return
+        query = dict(TIMELINE_ACTIVITY_QUERY)
+        query['contexts.hash'] = context_hash
+        activities = list(self.database.activity.find(query, {'actor': 1, 'contexts.hash': 1}).sort([('_id', DESCENDING)]).limit(limit))
+        if not activities:
+            return
+
+        already_in_feed = self.collection.find(
+            {'owner': username, 'activity': {'$in': [activity['_id'] for activity in activities]}},
+            {'activity': 1})
+        already_in_feed = set([entry['activity'] for entry in already_in_feed])
+        self._insert([self.feed_entry(username, activity) for activity in activities if activity['_id'] not in already_in_feed])
+
+    def remove_context(self, username, context_hash, keep_actors=[]):
+        """
+            Removes the activities of a context from the feed of an unsubscribed user,
+            preserving the activities of the actors that the user still follows.
+        """
+        self.collection.remove({'owner': username, 'context': context_hash, 'actor': {'$nin': list(keep_actors)}})
+
+    def remove(self, username):
+        """
+            Removes the whole feed of a user
+        """
+        self.collection.remove({'owner': username})
+
+    def rename_context(self, old_hash, new_hash):
+        """
+            Keeps feed entries pointing to a context whose url (and hash) changed
+        """
+        self.collection.update({'context': old_hash}, {'$set': {'context': new_hash}}, multi=True)
+
+    def remove_activities(self, activity_ids):
+        """
+            Removes activities from all feeds
+        """
+        self.collection.remove({'activity': {'$in': list(activity_ids)}})
+
+    def repair(self, username, activity_ids):
+        """
+            Drops the entries of a feed pointing to activities that are no
+            longer visible on timelines (deleted or hidden)
+        """
+        query = dict(TIMELINE_ACTIVITY_QUERY)
+        query['_id'] = {'$in': list(activity_ids)}
+        existing = set([activity['_id'] for activity in self.database.activity.find(query, {'_id': 1})])
+        stale = [activity_id for activity_id in activity_ids if activity_id not in existing]
+        if stale:
+            self.collection.remove({'owner': username, 'activity': {'$in': stale}})
+        return stale
+
+    def build(self, user):
+        """
+            (Re)builds the whole feed of a user from the activity collection.
+            Returns the number of entries in the new feed.
+        """
+        followed_usernames = [followed['username'] for followed in user.get('following', [])]
+        followed_usernames.append(user['username'])
+        subscribed_hashes = [subscription['hash'] for subscription in user.get('subscribedTo', []) if subscription.get('hash')]
+
+        query = dict(TIMELINE_ACTIVITY_QUERY)
+        query['$or'] = [{'actor.username': {'$in': followed_usernames}}]
+        if subscribed_hashes:
+            query['$or'].append({'contexts.hash': {'$in': subscribed_hashes}})
+
+        activities = self.database.activity.find(query, {'actor': 1, 'contexts.hash': 1})
+        entries = [self.feed_entry(user['username'], activity) for activity in activities]
+
+        self.collection.remove({'owner': user['username']})
+        self._insert(entries)
+        self.create(user['username'])
+        return len(entries)
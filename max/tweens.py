@@ -176,3 +176,23 @@ def deprecation_wrapper_factory(handler, registry):
         else:
             return response
     return deprecation_wrapper_tween
+
+
+def unit_of_work_factory(handler, registry):
+    """
+        Flushes the writes queued on the unit of work of the request when the view
+        ends, or discards them if it fails. Requests that didn't use the database
+        have nothing to flush.
+    """
+    def unit_of_work_tween(request):
+        try:
+            response = handler(request)
+        except Exception:
+            if 'db' in request.__dict__:
+                request.db.unit_of_work.discard()
+            raise
+
+        if 'db' in request.__dict__:
+            request.db.flush()
+        return response
+    return unit_of_work_tween
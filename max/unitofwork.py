@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+    Unit of work
+
+    When ``max.unit_of_work`` is enabled, the inserts, saves, updates and removes made
+    through the request database are not sent right away. They are queued, and flushed
+    when the view ends by the unit of work tween, as one ordered bulk operation per
+    collection, collections in the order they were first written.
+
+    Pending writes are flushed before any other operation on the request database, so
+    the reads made through it see all the writes made before. Code that reads the
+    database by other means must flush the pending writes with ``request.db.flush()``
+    first, as jobs and caches invalidation do.
+
+    Queued writes return what pymongo returns for unacknowledged writes: the _id of the
+    inserted and saved documents, None for updates and removes. Writes that need their
+    result are made on ``collection.immediate()``. Writes pending when the view fails
+    are discarded. Rabbitmq notifications are still sent during the view, so they can
+    reach the clients just before the writes they refer to are flushed, unless the
+    notifications outbox is enabled, as its entries are queued with the writes.
+"""
+from bson import ObjectId
+from collections import OrderedDict
+from contextlib import contextmanager
+from pyramid.settings import asbool
+
+# Collection methods that are queued, any other flushes the pending writes
+QUEUED_WRITE_METHODS = ['insert', 'save', 'update', 'remove']
+
+
+def unit_of_work_enabled(settings):
+    """
+        Checks if writes are queued until the end of the request
+    """
+    return asbool(settings.get('max_unit_of_work', False))
+
+
+def document_copy(value):
+    """
+        Copies a document as it would be sent at the time it's queued,
+        so later changes on the objects it was made of are not written.
+    """
+    if isinstance(value, dict):
+        return dict([(key, document_copy(item)) for key, item in value.iteritems()])
+    if isinstance(value, (list, tuple)):
+        return [document_copy(item) for item in value]
+    return value
+
+
+def is_replacement(document):
+    return not [key for key in document if key.startswith('$')]
+
+
+class UnitOfWork(object):
+    """
+        Writes of a request waiting to be flushed
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.pending = OrderedDict()
+
+    def queue(self, collection, operation):
+        self.pending.setdefault(collection.name, (collection, []))[1].append(operation)
+
+    def insert(self, collection, doc_or_docs, *args, **kwargs):
+        documents = doc_or_docs if isinstance(doc_or_docs, list) else [doc_or_docs]
+        ids = []
+        for document in documents:
+            oid = document.get('_id')
+            if oid is None:
+                oid = document['_id'] = ObjectId()
+            queued = document_copy(document)
+            queued['_id'] = oid
+            self.queue(collection, ('insert', queued))
+            ids.append(oid)
+        return ids if isinstance(doc_or_docs, list) else ids[0]
+
+    def save(self, collection, document, *args, **kwargs):
+        if document.get('_id') is None:
+            return self.insert(collection, document)
+        self.queue(collection, ('update', {'_id': document['_id']}, document_copy(document), True, False))
+        return document['_id']
+
+    def update(self, collection, spec, document, upsert=False, manipulate=False, safe=None, multi=False, **kwargs):
+        self.queue(collection, ('update', document_copy(spec), document_copy(document), upsert, multi))
+
+    def remove(self, collection, spec_or_id=None, safe=None, multi=True, **kwargs):
+        if spec_or_id is None:
+            spec = {}
+        elif isinstance(spec_or_id, dict):
+            spec = document_copy(spec_or_id)
+        else:
+            spec = {'_id': spec_or_id}
+        self.queue(collection, ('remove', spec, multi))
+
+    def flush(self):
+        """
+            Sends the pending writes, one ordered bulk operation per collection
+        """
+        pending, self.pending = self.pending, OrderedDict()
+        for collection, operations in pending.values():
+            bulk = collection.initialize_ordered_bulk_op()
+            for operation in operations:
+                if operation[0] == 'insert':
+                    bulk.insert(operation[1])
+                elif operation[0] == 'update':
+                    spec, document, upsert, multi = operation[1:]
+                    selected = bulk.find(spec).upsert() if upsert else bulk.find(spec)
+                    if is_replacement(document):
+                        selected.replace_one(document)
+                    elif multi:
+                        selected.update(document)
+                    else:
+                        selected.update_one(document)
+                else:
+                    spec, multi = operation[1:]
+                    if multi:
+                        bulk.find(spec).remove()
+                    else:
+                        bulk.find(spec).remove_one()
+            bulk.execute()
+
+    def discard(self):
+        self.pending = OrderedDict()
+
+    @contextmanager
+    def suspended(self):
+        """
+            Makes the writes inside right away, after flushing the pending ones
+        """
+        enabled = self.enabled
+        self.flush()
+        self.enabled = False
+        try:
+            yield
+        finally:
+            self.enabled = enabled
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 from max.exceptions import InvalidSearchParams
+from max.utils.cursors import decode_cursor
 from max.utils.dates import date_filter_parser
 
 from pyramid.settings import asbool
@@ -87,6 +88,10 @@ def searchParams(request):
     if 'before' in params and 'after' in params:
         raise InvalidSearchParams('only one offset filter is allowed, after or before')
 
+    cursor = request.params.get('cursor')
+    if cursor:
+        params['cursor'] = decode_cursor(cursor)
+
     if 'date_filter' in request.params:
         date_filter = date_filter_parser(request.params.get('date_filter', ''))
         params['date_filter'] = date_filter
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+    Process level caches
+"""
+from collections import OrderedDict
+
+import threading
+import time
+
+CACHE_VERSIONS_COLLECTION = 'cache_versions'
+VERSION_POLL_INTERVAL = 5
+
+
+class LRUCache(object):
+    """
+        Thread safe dict with a maximum size, that discards the least recently used
+        items when full. Items older than ttl seconds are discarded when read.
+    """
+
+    def __init__(self, size, ttl=None):
+        self.size = size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.items = OrderedDict()
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.items.pop(key, None)
+            if entry is None:
+                return default
+            stored, value = entry
+            if self.ttl is not None and time.time() - stored > self.ttl:
+                return default
+            # Move to the end, as the most recently used
+            self.items[key] = entry
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = (time.time(), value)
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            entry = self.items.pop(key, None)
+            return default if entry is None else entry[1]
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+    def __len__(self):
+        return len(self.items)
+
+
+class VersionTracker(object):
+    """
+        Version of a cache shared by all processes, stored on the
+        ``cache_versions`` collection as {'_id': name, 'version': 3}.
+
+        Each process reads it at most once every poll_interval seconds, and bumps
+        it when it changes what's cached, so the other processes discard their copies.
+    """
+
+    def __init__(self, name, poll_interval=VERSION_POLL_INTERVAL):
+        self.name = name
+        self.poll_interval = poll_interval
+        self.version = None
+        self.checked = 0
+
+    def current(self, database):
+        """
+            Returns the shared version, as read on the last poll
+        """
+        if self.version is None or time.time() - self.checked > self.poll_interval:
+            document = database[CACHE_VERSIONS_COLLECTION].find_one({'_id': self.name})
+            self.version = document['version'] if document else 0
+            self.checked = time.time()
+        return self.version
+
+    def bump(self, database):
+        """
+            Increments the shared version and returns it
+        """
+        document = database[CACHE_VERSIONS_COLLECTION].find_and_modify(
+            query={'_id': self.name},
+            update={'$inc': {'version': 1}},
+            upsert=True,
+            new=True
+        )
+        self.version = document['version']
+        self.checked = time.time()
+        return self.version
+
+    def reset(self):
+        self.version = None
+        self.checked = 0
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+from max.exceptions import InvalidSearchParams
+
+from bson import json_util
+from pymongo import DESCENDING
+
+import base64
+
+
+def encode_cursor(values):
+    """
+        Encodes the sort key values of the last item of a page into an
+        opaque continuation cursor.
+    """
+    return base64.urlsafe_b64encode(json_util.dumps(values))
+
+
+def decode_cursor(cursor):
+    """
+        Decodes a continuation cursor into the list of sort key values
+        of the last item of the previous page.
+
+        Raises InvalidSearchParams if the cursor is malformed.
+    """
+    try:
+        values = json_util.loads(base64.urlsafe_b64decode(str(cursor)))
+    except:
+        raise InvalidSearchParams('cursor is not a valid continuation cursor')
+
+    if not isinstance(values, list):
+        raise InvalidSearchParams('cursor is not a valid continuation cursor')
+    return values
+
+
+def sort_key_values(item, sort_params):
+    """
+        Extracts the values of the sort key fields from a raw database item.
+    """
+    values = []
+    for field, direction in sort_params:
+        value = item
+        for part in field.split('.'):
+            value = value.get(part, None) if isinstance(value, dict) else None
+        values.append(value)
+    return values
+
+
+def keyset_condition(sort_params, values):
+    """
+        Builds the condition that matches the items that come after the item
+        whose sort key is ``values`` when sorting by ``sort_params``.
+
+        The result is an $or with one clause for each sort field, matching the
+        items that are equal on the previous fields and come after on that one.
+        Missing and null values are taken into account as mongodb sorts them:
+        before any other value, so last on descending sorts.
+    """
+    clauses = []
+    for position, (field, direction) in enumerate(sort_params):
+        prefix = dict([(sort_params[index][0], values[index]) for index in range(position)])
+
+        value = values[position]
+        if direction == DESCENDING:
+            following = [] if value is None else [{'$lt': value}, None]
+        else:
+            following = [{'$ne': None}] if value is None else [{'$gt': value}]
+
+        for condition in following:
+            clause = dict(prefix)
+            clause[field] = condition
+            clauses.append(clause)
+
+    return {'$or': clauses}
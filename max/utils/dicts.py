@@ -158,3 +158,63 @@ def flatten(data, filter_method=None, reverse=False, **kwargs):
                 newitems.append(flatten(item, **kwargs))
         data = newitems
     return data
+
+
+def differs(value, other):
+    """
+        Compares two values of a document, as unequal if they
+        can't be compared, as naive and aware datetimes.
+    """
+    try:
+        return value != other
+    except TypeError:
+        return True
+
+
+def document_changes(saved, current, skip=(), prefix=''):
+    """
+        Returns the $set and $unset operations needed to update a stored document
+        to the current one, as a dict of dotted paths -> values and a list of paths.
+
+        Nested dicts present on both are compared key by key, so only their changed
+        keys are set. Any other changed value, including lists, is set as a whole.
+        Keys in skip are ignored.
+    """
+    sets = {}
+    unsets = []
+    for key, value in current.iteritems():
+        if key in skip:
+            continue
+        path = prefix + key
+        if key not in saved:
+            sets[path] = value
+        elif isinstance(value, dict) and isinstance(saved[key], dict):
+            nested_sets, nested_unsets = document_changes(saved[key], value, prefix=path + '.')
+            sets.update(nested_sets)
+            unsets.extend(nested_unsets)
+        elif differs(value, saved[key]):
+            sets[path] = value
+
+    for key in saved:
+        if key not in current and key not in skip:
+            unsets.append(prefix + key)
+    return sets, unsets
+
+
+def apply_changes(document, sets, unsets):
+    """
+        Applies the operations returned by document_changes to a document
+    """
+    for path, value in sets.iteritems():
+        parts = path.split('.')
+        target = document
+        for part in parts[:-1]:
+            target = target.setdefault(part, {})
+        target[parts[-1]] = deepcopy(value)
+
+    for path in unsets:
+        parts = path.split('.')
+        target = document
+        for part in parts[:-1]:
+            target = target.get(part, {})
+        target.pop(parts[-1], None)
@@ -50,10 +50,18 @@ setup(name='max',
       tests_require=requires + test_requires,
       test_suite="max.tests",
       extras_require={
-          'test': ['WebTest', 'mock', 'HTTPretty', 'manuel', 'pyramid-beaker']
+          'test': ['WebTest', 'mock', 'HTTPretty', 'manuel', 'pyramid-beaker'],
+          'jwt': ['PyJWT', 'cryptography']
       },
       entry_points="""
       [paste.app_factory]
       main = max:main
+
+      [console_scripts]
+      max.timelines = max.scripts.timelines:main
+      max.mongoindexes = max.scripts.mongoindexes:main
+      max.outbox = max.scripts.outbox:main
+      max.jobs = max.scripts.jobs:main
+      max.keywords = max.scripts.keywords:main
       """,
       )